@@ -1,11 +1,24 @@
 import pandas as pd
 import networkx as nx
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS # 이 줄을 추가합니다.
-from path_service import create_pathfinding_model, find_closest_node, find_paths_circular
-from visualization import create_visualization
+from path_service import create_pathfinding_model, find_closest_node, find_closest_nodes, find_paths_circular, \
+    slot_safety_profile, apply_safety_delta, scores_version
+from visualization import render_route_map, render_template_html
+from run_manager import store_routes, get_route, start_running_session, get_running_session, record_fixes, \
+    finish_running_session, configure_route_scoring
+from route_encoding import WAYPOINT_ENCODINGS, encode_route
+from geometry import zoom_tolerance_m
+import live_hub
+from model_registry import ModelRegistry
+from data_store import prefer_columnar
+from safety_pipeline import population_source
+from concurrent.futures import ThreadPoolExecutor
 import os
 import json
+import math
+import threading
+import datetime
 
 app = Flask(__name__)
 CORS(app) # 이 줄을 추가하여 모든 도메인에서의 요청을 허용합니다.
@@ -14,15 +27,148 @@ CORS(app) # 이 줄을 추가하여 모든 도메인에서의 요청을 허용
 # Load the graph and safety score data once when the server starts
 DATA_DIR = 'data'
 GRAPHML_FILE = os.path.join(DATA_DIR, 'dalseo_real_graph.graphml')
+# Served graph. GRAPH_FILE may name an array graph built by graph_builder.py (.npz) instead;
+# it is never picked up automatically, since its nodes and edges differ from the graphml
+GRAPH_FILE = os.environ.get('GRAPH_FILE', GRAPHML_FILE)
 NODES_CSV_FILE = os.path.join(DATA_DIR, 'nodes_final_with_safety_score.csv')
+EDGES_CSV_FILE = os.path.join(DATA_DIR, 'dalseo_edges_corrected.csv')
+FACILITY_CSV_FILE = os.path.join(DATA_DIR, 'nodes_with_facility_counts.csv')
+FLOATING_POP_DIR = os.path.join(DATA_DIR, 'floating_pop')
+# Rasters built from FLOATING_POP_DIR by population_raster.py; the CSVs are used when missing.
+# The scores in NODES_CSV_FILE must come from the same source (re-run safety_pipeline.py)
+FLOATING_POP_RASTER = os.path.join(DATA_DIR, 'floating_pop.npz')
 
-G_with_scores = create_pathfinding_model(GRAPHML_FILE, NODES_CSV_FILE)
+# Edge weight table written by safety_pipeline.py; edges use its edge-level safety when present
+EDGE_WEIGHTS_FILE = os.path.join(DATA_DIR, 'edge_weights.csv')
 
-if G_with_scores:
+# Admin endpoints require this token in the X-Admin-Token header; without it they are disabled
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Batch recommendation limits
+BATCH_MAX_ITEMS = 500
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
+
+# Live crew streams open at once in this process. Each holds a server thread while connected,
+# so keep this below the server's thread count (GUNICORN_THREADS) to leave threads for the API
+MAX_LIVE_STREAMS = int(os.environ.get('MAX_LIVE_STREAMS', 192))
+# Seconds a viewer turned away at the limit is asked to wait before reconnecting
+LIVE_RETRY_AFTER_S = 30
+_live_streams = threading.BoundedSemaphore(MAX_LIVE_STREAMS)
+
+def load_model():
+    """
+    Builds the pathfinding model from the data files (also used for hot reloads).
+    Up-to-date Parquet conversions of the tables are used instead of the CSVs when present.
+    """
+    if GRAPH_FILE.endswith('.npz'):
+        # The array graph carries its own street geometry
+        graph_file, edges_file = GRAPH_FILE, None
+    else:
+        graph_file, edges_file = GRAPH_FILE, prefer_columnar(EDGES_CSV_FILE)
+    edge_weights = prefer_columnar(EDGE_WEIGHTS_FILE)
+    return create_pathfinding_model(graph_file, prefer_columnar(NODES_CSV_FILE), edges_file,
+                                    prefer_columnar(FACILITY_CSV_FILE),
+                                    population_source(FLOATING_POP_DIR, FLOATING_POP_RASTER),
+                                    edge_weights if os.path.exists(edge_weights) else None)
+
+# The served model; endpoints take models.current() once per request
+models = ModelRegistry(load_model)
+try:
+    models.load()
     print("Graph and safety data loaded successfully.")
-else:
-    print("Failed to load graph and safety data. Exiting.")
+except ValueError as e:
+    print(f"Failed to load graph and safety data. Exiting. ({e})")
     exit()
+# Stored routes report the scores of the served model's safety data
+configure_route_scoring(models.current)
+
+def geometry_options(params, start_lat):
+    """
+    Reads the street geometry options of a recommendation request.
+    'simplify_tolerance_m' sets the Douglas-Peucker tolerance directly; otherwise
+    'zoom' derives it from the map zoom level. Returns (geometry, tolerance_m).
+    """
+    if not params.get('geometry'):
+        return False, 0
+
+    tolerance_m = params.get('simplify_tolerance_m')
+    zoom = params.get('zoom')
+    if tolerance_m is not None:
+        if not isinstance(tolerance_m, (int, float)) or tolerance_m < 0:
+            raise ValueError("simplify_tolerance_m must be a non-negative number")
+        return True, tolerance_m
+    if zoom is not None:
+        if not isinstance(zoom, (int, float)) or not 0 <= zoom <= 22:
+            raise ValueError("zoom must be a number between 0 and 22")
+        return True, zoom_tolerance_m(zoom, start_lat)
+    return True, 0
+
+def start_hour(params):
+    """
+    Reads the optional 'start_time' of a recommendation request, either "HH:MM" or an
+    ISO 8601 datetime in local time. Returns the hour of day as a float, or None.
+    """
+    value = params.get('start_time')
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError("start_time must be \"HH:MM\" or an ISO 8601 datetime")
+    try:
+        if 'T' in value:
+            parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).time()
+        else:
+            parsed = datetime.time.fromisoformat(value)
+    except ValueError:
+        raise ValueError("start_time must be \"HH:MM\" or an ISO 8601 datetime")
+    return parsed.hour + parsed.minute / 60
+
+def build_recommendation(G, start_node_id, distance_km, pace_min_per_km, encoding=None, geometry=False, tolerance_m=0,
+                         hour=None):
+    """
+    Finds the circular paths for a snapped start node of model G and adds time estimates.
+    If hour is given, safety is scored for that time of day when a time slot covers it.
+    Only the canonical route content is stored; time estimates, time-slot scores and geometry
+    are returned with this response alone. Only the returned copies are encoded.
+    """
+    paths_data = find_paths_circular(G, start_node_id, distance_km,
+                                     geometry=geometry, tolerance_m=tolerance_m,
+                                     profile=slot_safety_profile(G, hour), street_geometry=True)
+
+    # Calculate estimated time and pace for each route
+    for route in paths_data.get("routes", []):
+        route_distance = route['distance_km']
+        estimated_time_min = round(route_distance * pace_min_per_km, 2)
+        route['estimated_time_min'] = estimated_time_min
+        route['pace_min_per_km'] = pace_min_per_km
+
+    # Keep the routes so maps, favorites and sessions can refer to them by ID; the full street
+    # geometry is stored for off-route checks and maps but not sent with the response
+    store_routes(paths_data.get("routes", []), scores_version(G))
+    for route in paths_data.get("routes", []):
+        route.pop('street_geometry', None)
+
+    if encoding:
+        paths_data = {"routes": [encode_route(route, encoding) for route in paths_data.get("routes", [])]}
+    return paths_data
+
+def admin_denied():
+    """
+    Returns an error response if the request lacks the admin token, else None.
+    Every admin request is denied when no token is configured.
+    """
+    if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({"error": "Admin token required"}), 403
+    return None
+
+def recommendation_error(e):
+    """
+    Maps an exception raised while recommending routes to an error message and status code.
+    """
+    if isinstance(e, ValueError):
+        return str(e), 400
+    if isinstance(e, nx.NetworkXNoPath):
+        return "No path could be found with the given criteria.", 404
+    return "An unexpected error occurred: " + str(e), 500
 
 @app.route('/api/routes/recommend', methods=['POST'])
 def recommend_routes():
@@ -37,38 +183,306 @@ def recommend_routes():
     start_point = data.get('start_point')
     distance_km = data.get('distance_km')
     pace_min_per_km = data.get('pace_min_per_km')
+    encoding = data.get('encoding')
 
     if not all([start_point, distance_km, pace_min_per_km]):
         return jsonify({"error": "Missing required parameters"}), 400
 
+    if encoding is not None and encoding not in WAYPOINT_ENCODINGS:
+        return jsonify({"error": f"encoding must be one of {', '.join(WAYPOINT_ENCODINGS)}"}), 400
+
     start_lat, start_lon = start_point
-    start_node_id = find_closest_node(G_with_scores, start_lat, start_lon)
+    try:
+        geometry, tolerance_m = geometry_options(data, start_lat)
+        hour = start_hour(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # One model version for the whole request, even if a reload swaps it meanwhile
+    G = models.current()
+    start_node_id = find_closest_node(G, start_lat, start_lon)
 
     if not start_node_id:
         return jsonify({"error": "Could not find a starting node close to the provided coordinates"}), 404
 
     try:
-        paths_data = find_paths_circular(G_with_scores, start_node_id, distance_km)
+        paths_data = build_recommendation(G, start_node_id, distance_km, pace_min_per_km, encoding,
+                                          geometry, tolerance_m, hour)
+        return jsonify(paths_data), 200
 
-        # Calculate estimated time and pace for each route
-        for route in paths_data.get("routes", []):
-            route_distance = route['distance_km']
-            estimated_time_min = round(route_distance * pace_min_per_km, 2)
-            route['estimated_time_min'] = estimated_time_min
-            route['pace_min_per_km'] = pace_min_per_km
+    except Exception as e:
+        message, status = recommendation_error(e)
+        return jsonify({"error": message}), status
 
-        # Generate HTML visualization file
-        output_html_file = 'path_visualization.html'
-        create_visualization(paths_data, output_html_file)
+@app.route('/api/routes/recommend/batch', methods=['POST'])
+def recommend_routes_batch():
+    """
+    API endpoint to recommend circular paths for many (start_point, distance) requests at once.
+    Start points are snapped in one spatial-index query, items sharing a start node run
+    together so they reuse its shortest-path trees, and results keep the input order.
+    """
+    data = request.get_json(silent=True)
 
-        return jsonify(paths_data), 200
+    if not data or not isinstance(data, dict) or not isinstance(data.get('requests'), list):
+        return jsonify({"error": "Request body must be a JSON object with a 'requests' list"}), 400
+
+    items = data['requests']
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"A batch may contain at most {BATCH_MAX_ITEMS} requests"}), 400
+
+    results = [None] * len(items)
+    valid = []
+    # Start points and (distance_km, pace_min_per_km) converted to numbers, by item index
+    points = {}
+    amounts = {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"error": "Each request must be a JSON object", "status": 400}
+            continue
+
+        start_point = item.get('start_point')
+        if not all([start_point, item.get('distance_km'), item.get('pace_min_per_km')]):
+            results[i] = {"error": "Missing required parameters", "status": 400}
+            continue
+        if not isinstance(start_point, (list, tuple)) or len(start_point) != 2:
+            results[i] = {"error": "start_point must be a [lat, lon] pair", "status": 400}
+            continue
+        try:
+            points[i] = (float(start_point[0]), float(start_point[1]))
+        except (TypeError, ValueError):
+            results[i] = {"error": "start_point must hold numeric coordinates", "status": 400}
+            continue
+        try:
+            amounts[i] = (float(item['distance_km']), float(item['pace_min_per_km']))
+        except (TypeError, ValueError):
+            amounts[i] = None
+        if amounts[i] is None or not all(math.isfinite(x) and x > 0 for x in amounts[i]):
+            results[i] = {"error": "distance_km and pace_min_per_km must be positive numbers", "status": 400}
+            continue
+        if item.get('encoding') is not None and item['encoding'] not in WAYPOINT_ENCODINGS:
+            results[i] = {"error": f"encoding must be one of {', '.join(WAYPOINT_ENCODINGS)}", "status": 400}
+            continue
+        try:
+            geometry_options(item, points[i][0])
+            start_hour(item)
+        except ValueError as e:
+            results[i] = {"error": str(e), "status": 400}
+            continue
+
+        valid.append(i)
+
+    # Snap every start point in one vectorized query and group items by start node
+    G = models.current()
+    start_nodes = find_closest_nodes(G, [points[i] for i in valid])
+    groups = {}
+    for i, start_node_id in zip(valid, start_nodes):
+        if not start_node_id:
+            results[i] = {"error": "Could not find a starting node close to the provided coordinates", "status": 404}
+            continue
+        groups.setdefault(start_node_id, []).append(i)
+
+    def run_group(start_node_id, indices):
+        for i in indices:
+            item = items[i]
+            try:
+                geometry, tolerance_m = geometry_options(item, points[i][0])
+                results[i] = build_recommendation(G, start_node_id, *amounts[i],
+                                                  item.get('encoding'), geometry, tolerance_m, start_hour(item))
+            except Exception as e:
+                message, status = recommendation_error(e)
+                results[i] = {"error": message, "status": status}
+
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = [executor.submit(run_group, start_node_id, indices) for start_node_id, indices in groups.items()]
+        for future in futures:
+            future.result()
+
+    return jsonify({"results": results}), 200
+
+@app.route('/api/routes/<route_id>', methods=['GET'])
+def route_data(route_id):
+    """
+    API endpoint that returns a stored route, used by map pages that load their data remotely.
+    """
+    route = get_route(route_id)
+    if not route:
+        return jsonify({"error": "Route not found"}), 404
+    return jsonify(route), 200
+
+@app.route('/api/routes/<route_id>/map', methods=['GET'])
+def route_map(route_id):
+    """
+    API endpoint that renders the map page of a stored route on demand.
+    Pages are cached by route content hash, which is also sent as the ETag.
+    Query parameters:
+      renderer=folium  render with Folium instead of the static template (debugging)
+      data=remote      return the static shell that fetches the route from /api/routes/<route_id>
+    """
+    route = get_route(route_id)
+    if not route:
+        return jsonify({"error": "Route not found"}), 404
 
+    if request.args.get('data') == 'remote':
+        html = render_template_html(None, route_url=f"/api/routes/{route_id}")
+        return Response(html, mimetype='text/html')
+
+    try:
+        html, content_hash = render_route_map(route, renderer=request.args.get('renderer', 'template'))
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
-    except nx.NetworkXNoPath:
-        return jsonify({"error": "No path could be found with the given criteria."}), 404
-    except Exception as e:
-        return jsonify({"error": "An unexpected error occurred: " + str(e)}), 500
+
+    if request.if_none_match.contains(content_hash):
+        return Response(status=304)
+
+    response = Response(html, mimetype='text/html')
+    response.set_etag(content_hash)
+    return response
+
+@app.route('/api/sessions', methods=['POST'])
+def start_session():
+    """
+    API endpoint to start a running session on a stored route.
+    """
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a valid JSON object"}), 400
+
+    route_id = data.get('route_id')
+    pace_min_per_km = data.get('planned_pace_min_per_km')
+    if not all([route_id, pace_min_per_km]):
+        return jsonify({"error": "Missing required parameters"}), 400
+
+    session_data = start_running_session(route_id, pace_min_per_km, data.get('crew_post_id'))
+    if not session_data:
+        return jsonify({"error": "Route not found"}), 404
+    return jsonify(session_data), 201
+
+@app.route('/api/sessions/<session_id>', methods=['GET'])
+def session_status(session_id):
+    """
+    API endpoint that returns a running session with its latest location.
+    """
+    session_data = get_running_session(session_id)
+    if not session_data:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify(session_data), 200
+
+@app.route('/api/sessions/<session_id>/fixes', methods=['POST'])
+def ingest_session_fixes(session_id):
+    """
+    API endpoint that appends a batch of GPS fixes to a running session's trace.
+    Body: {"fixes": [[timestamp, lat, lon], ...]} with timestamps in epoch seconds.
+    The response says whether the runner has left the selected route.
+    """
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data, dict) or 'fixes' not in data:
+        return jsonify({"error": "Request body must be a JSON object with a 'fixes' list"}), 400
+
+    try:
+        result = record_fixes(session_id, data['fixes'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except LookupError as e:
+        # Part of the stored trace is gone; the session cannot be continued
+        return jsonify({"error": str(e)}), 409
+
+    if result is None:
+        return jsonify({"error": "No running session with this ID"}), 404
+
+    return jsonify(dict(result, session_id=session_id)), 200
+
+@app.route('/api/sessions/<session_id>/finish', methods=['POST'])
+def finish_session(session_id):
+    """
+    API endpoint that finishes a running session and returns its statistics.
+    """
+    try:
+        stats = finish_running_session(session_id, models.current())
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 409
+    if not stats:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify(stats), 200
+
+@app.route('/api/crews/<crew_post_id>/live', methods=['GET'])
+def crew_live(crew_post_id):
+    """
+    Server-sent event stream of the live positions of the sessions running for a crew post.
+    Each 'position' event carries the latest update of one session; a comment line is sent
+    as a keep-alive when nothing happens.
+    The stream keeps its server thread for as long as the viewer is connected, so at most
+    MAX_LIVE_STREAMS are served at once and further viewers get a 503 with Retry-After;
+    see the gunicorn settings in the Dockerfile.
+    """
+    if not _live_streams.acquire(blocking=False):
+        response = jsonify({"error": "Too many live viewers, try again later"})
+        response.headers['Retry-After'] = str(LIVE_RETRY_AFTER_S)
+        return response, 503
+    subscriber = live_hub.subscribe(crew_post_id)
+    closed = threading.Lock()
+
+    def close():
+        # Runs once when the server closes the response, even if the stream never started
+        if closed.acquire(blocking=False):
+            live_hub.unsubscribe(subscriber)
+            _live_streams.release()
+
+    def stream():
+        yield ": connected\n\n"
+        while True:
+            updates = live_hub.next_updates(subscriber, timeout=15.0)
+            if not updates:
+                yield ": keep-alive\n\n"
+                continue
+            for update in updates:
+                yield f"event: position\ndata: {json.dumps(update, separators=(',', ':'))}\n\n"
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(close)
+    return response
+
+@app.route('/api/admin/safety-delta', methods=['POST'])
+def safety_delta():
+    """
+    Admin endpoint that applies a safety delta written by safety_pipeline's incremental run
+    (new node safety scores after a facility data update) without restarting the server.
+    """
+    denied = admin_denied()
+    if denied:
+        return denied
+
+    delta = request.get_json(silent=True)
+    try:
+        result = apply_safety_delta(models.current(), delta)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result), 200
+
+@app.route('/api/admin/model', methods=['GET'])
+def model_status():
+    """
+    Admin endpoint that returns the served model version and the state of reloading.
+    """
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify(models.status()), 200
+
+@app.route('/api/admin/model/reload', methods=['POST'])
+def reload_model():
+    """
+    Admin endpoint that reloads the graph and safety data files in the background.
+    The new model is validated and swapped in atomically; requests already running finish
+    on the old one. Poll GET /api/admin/model for the result.
+    """
+    denied = admin_denied()
+    if denied:
+        return denied
+    if not models.reload_async():
+        return jsonify({"error": "A reload is already running"}), 409
+    return jsonify(models.status()), 202
 
 
 if __name__ == '__main__':
@@ -77,4 +491,4 @@ if __name__ == '__main__':
         print("Error: 'data' directory not found. Please create it and place your data files inside.")
         exit()
 
-    app.run(debug=True, host='0.0.0.0') # 이 부분을 수정
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0') # 이 부분을 수정
@@ -0,0 +1,150 @@
+# Columnar storage of the node and edge tables.
+# The CSVs (BOM headers, WKT geometry strings, untyped columns) are converted once to Parquet
+# with typed columns and WKB geometry, which loads without any text parsing. Every reader in
+# the repo goes through read_table, so either format can be passed wherever a table is expected.
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+# Column types of the converted tables; other columns are stored as strings
+NODE_COLUMN_TYPES = {
+    'osmid': 'int64', 'y': 'float64', 'x': 'float64', 'street_count': 'int16',
+    'convenience_store_count': 'float64', 'cctv_count': 'float64', 'police_count': 'float64',
+    'lighting_count': 'float64', 'population': 'float64', 'safety_score': 'float64'
+}
+EDGE_COLUMN_TYPES = {
+    'u': 'int64', 'v': 'int64', 'key': 'int16', 'length': 'float64', 'maxspeed': 'float64', 'oneway': 'bool'
+}
+
+# GeoParquet names of shapely geometry type ids
+GEOMETRY_TYPE_NAMES = ['Point', 'LineString', 'LinearRing', 'Polygon', 'MultiPoint', 'MultiLineString',
+                       'MultiPolygon', 'GeometryCollection']
+
+# Tables converted by the CLI: csv name -> column types
+TABLES = {
+    'nodes_final_with_safety_score.csv': NODE_COLUMN_TYPES,
+    'nodes_with_facility_counts.csv': NODE_COLUMN_TYPES,
+    'dalseo_edges_corrected.csv': EDGE_COLUMN_TYPES
+}
+
+
+def is_columnar(path):
+    return path.endswith('.parquet')
+
+
+def columnar_path(csv_path):
+    """Returns the Parquet path that goes with a CSV path."""
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+def prefer_columnar(csv_path):
+    """
+    Returns the converted Parquet file of a CSV if it exists and is at least as new as
+    the CSV, else the CSV itself, so a re-generated CSV is never shadowed by a stale copy.
+    """
+    parquet_path = columnar_path(csv_path)
+    if os.path.exists(parquet_path) and (not os.path.exists(csv_path)
+                                         or os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path)):
+        return parquet_path
+    return csv_path
+
+
+def read_table(path, columns=None, dtype=None):
+    """
+    Reads a node or edge table from CSV or Parquet.
+    columns limits the columns read (Parquet reads only those column chunks).
+    Geometry comes back as WKT strings from CSV and WKB bytes from Parquet;
+    use geometry_coords to get coordinates from either.
+    """
+    if is_columnar(path):
+        table = pd.read_parquet(path, columns=columns)
+        return table.astype(dtype) if dtype else table
+    return pd.read_csv(path, encoding='utf-8-sig', usecols=columns, dtype=dtype)
+
+
+def write_table(table, path, column_types=None):
+    """
+    Writes a table as CSV (with the BOM the repo's CSVs carry) or as Parquet.
+    For Parquet, column_types are applied, a WKT 'geometry' column is stored as WKB
+    and GeoParquet metadata is added.
+    """
+    if not is_columnar(path):
+        table.to_csv(path, index=False, encoding='utf-8-sig')
+        return
+
+    table = table.copy()
+    for column, column_type in (column_types or {}).items():
+        if column in table.columns:
+            table[column] = table[column].astype(column_type)
+    for column in table.columns:
+        if column != 'geometry' and column not in (column_types or {}) and table[column].dtype == object:
+            table[column] = table[column].astype('string')
+
+    metadata = {}
+    if 'geometry' in table.columns:
+        geometries = _geometries(table['geometry'])
+        table['geometry'] = shapely.to_wkb(geometries)
+        types = sorted(set(shapely.get_type_id(geometries[~shapely.is_missing(geometries)]).tolist()))
+        metadata[b'geo'] = json.dumps({
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": [GEOMETRY_TYPE_NAMES[t] for t in types]}}
+        }).encode()
+
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    arrow_table = arrow_table.replace_schema_metadata({**(arrow_table.schema.metadata or {}), **metadata})
+    tmp_path = path + '.tmp'
+    pq.write_table(arrow_table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+
+def _geometries(geometry):
+    """Parses a geometry column of WKT strings or WKB bytes; missing values become None."""
+    values = geometry.to_numpy(dtype=object)
+    present = pd.notna(values)
+    values = np.where(present, values, None)
+    if present.any() and isinstance(values[present][0], bytes):
+        return shapely.from_wkb(values)
+    return shapely.from_wkt(values)
+
+
+def geometry_coords(geometry):
+    """
+    Returns the (x, y) coordinates of a geometry column (WKT strings or WKB bytes) as one
+    stacked array, and the number of points of each geometry.
+    """
+    geometries = _geometries(geometry)
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    return coords, np.bincount(index, minlength=len(geometries))
+
+
+def convert(csv_path, parquet_path=None, column_types=None):
+    """Converts one CSV table to Parquet. Returns the Parquet path."""
+    parquet_path = parquet_path or columnar_path(csv_path)
+    write_table(read_table(csv_path), parquet_path, column_types)
+    return parquet_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the node and edge CSVs to Parquet.")
+    parser.add_argument('--data-dir', default='data')
+    args = parser.parse_args()
+
+    for name, column_types in TABLES.items():
+        csv_path = os.path.join(args.data_dir, name)
+        if not os.path.exists(csv_path):
+            continue
+        parquet_path = convert(csv_path, column_types=column_types)
+        print(f"{csv_path} ({os.path.getsize(csv_path) // 1024} KB) -> "
+              f"{parquet_path} ({os.path.getsize(parquet_path) // 1024} KB)")
+
+
+if __name__ == '__main__':
+    main()
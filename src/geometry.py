@@ -0,0 +1,130 @@
+import numpy as np
+from data_store import read_table, geometry_coords
+
+# Web Mercator ground resolution at zoom 0 on the equator, in meters per pixel
+METERS_PER_PIXEL_Z0 = 156543.03392
+EARTH_RADIUS_M = 6371008.8
+
+def _parse_linestrings(wkt):
+    """
+    Parses a Series of 'LINESTRING (lon lat, ...)' strings in one pass.
+    Returns the (lat, lon) coordinates of all lines stacked together and
+    the number of points in each line.
+    """
+    bodies = wkt.str.replace(r'^[^(]*\(\s*', '', regex=True).str.rstrip(') ')
+    counts = bodies.str.count(',').to_numpy() + 1
+
+    values = np.array(' '.join(bodies.str.replace(',', ' ', regex=False)).split(), dtype=np.float64)
+    lon_lat = values.reshape(-1, 2)
+    return lon_lat[:, ::-1].copy(), counts
+
+def load_edge_geometry(edges_csv_file):
+    """
+    Loads edge geometries from the edges table (CSV with WKT or Parquet with WKB)
+    into one packed coordinate buffer.
+    Returns a dict with:
+      coords      (N, 2) float array of (lat, lon) for all edges back to back
+      offsets     edge i covers coords[offsets[i]:offsets[i + 1]]
+      edge_index  maps (u, v) node ID strings to the edge number, oriented from u to v
+    Where the CSV holds parallel edges between the same nodes, the shortest one is kept.
+    """
+    df_edges = read_table(edges_csv_file, columns=['u', 'v', 'length', 'geometry'], dtype={'u': str, 'v': str})
+    df_edges = df_edges.dropna(subset=['geometry'])
+    df_edges = df_edges.sort_values('length', kind='stable').drop_duplicates(['u', 'v'])
+    df_edges = df_edges.sort_index()
+
+    if isinstance(df_edges['geometry'].iloc[0], bytes):
+        lon_lat, counts = geometry_coords(df_edges['geometry'])
+        coords = lon_lat[:, ::-1].copy()
+    else:
+        coords, counts = _parse_linestrings(df_edges['geometry'])
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    edge_index = {(u, v): i for i, (u, v) in enumerate(zip(df_edges['u'], df_edges['v']))}
+    return {"coords": coords, "offsets": offsets, "edge_index": edge_index}
+
+def edge_coords(edge_geometry, u, v):
+    """
+    Returns the (lat, lon) points of the edge from u to v, or None if it has no stored geometry.
+    Edges only stored in the opposite direction are returned reversed.
+    """
+    coords, offsets, edge_index = edge_geometry['coords'], edge_geometry['offsets'], edge_geometry['edge_index']
+
+    i = edge_index.get((u, v))
+    if i is not None:
+        return coords[offsets[i]:offsets[i + 1]]
+
+    i = edge_index.get((v, u))
+    if i is not None:
+        return coords[offsets[i]:offsets[i + 1]][::-1]
+    return None
+
+def path_geometry(G, path, edge_geometry):
+    """
+    Assembles the full street geometry of a node path by slicing the packed buffer.
+    Hops without stored geometry fall back to a straight line between the nodes.
+    """
+    if not path:
+        return np.empty((0, 2))
+
+    pieces = [np.array([[G.nodes[path[0]]['lat'], G.nodes[path[0]]['lon']]], dtype=np.float64)]
+    for u, v in zip(path[:-1], path[1:]):
+        segment = edge_coords(edge_geometry, u, v) if edge_geometry else None
+        if segment is None:
+            segment = np.array([[G.nodes[v]['lat'], G.nodes[v]['lon']]], dtype=np.float64)
+        else:
+            # The first point of each edge repeats the last point of the previous one
+            segment = segment[1:]
+        pieces.append(segment)
+    return np.concatenate(pieces)
+
+def zoom_tolerance_m(zoom, lat):
+    """
+    Returns the simplification tolerance for a web map zoom level: the ground size of one pixel.
+    """
+    return METERS_PER_PIXEL_Z0 * np.cos(np.radians(lat)) / (2 ** zoom)
+
+def simplify_line(coords, tolerance_m):
+    """
+    Simplifies a (lat, lon) line with the Douglas-Peucker algorithm.
+    Points are projected to local meters so the tolerance is a ground distance.
+    Distances for each split are computed for the whole span at once.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if tolerance_m <= 0 or len(coords) < 3:
+        return coords
+
+    # Equirectangular projection around the line's mean latitude
+    lat0 = np.radians(coords[:, 0].mean())
+    xy = np.radians(coords[:, ::-1]) * EARTH_RADIUS_M
+    xy[:, 0] *= np.cos(lat0)
+
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(coords) - 1)]
+
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        a, b = xy[start], xy[end]
+        points = xy[start + 1:end]
+        ab = b - a
+        ab_len2 = ab @ ab
+        if ab_len2 == 0:
+            dists = np.hypot(*(points - a).T)
+        else:
+            # Distance to the segment, clamped at its ends
+            t = np.clip(((points - a) @ ab) / ab_len2, 0, 1)
+            dists = np.hypot(*(points - (a + t[:, None] * ab)).T)
+
+        i = int(np.argmax(dists))
+        if dists[i] > tolerance_m:
+            split = start + 1 + i
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return coords[keep]
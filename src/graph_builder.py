@@ -0,0 +1,375 @@
+# Offline build of the pathfinding graph from the cached Overpass response.
+# The osmnx cache in cache/ holds the raw street data of the district and its boundary. The
+# builder streams the Overpass elements, keeps the walkable ways, clips them to the boundary,
+# joins the segments between intersections into edges with their street geometry, and writes
+# the graph as plain arrays (.npz), so no network access, osmnx or graphml round-trip is needed.
+# The result is not the served graph: osmnx simplifies and cleans the network in ways not
+# reproduced here, so node and edge sets differ from dalseo_real_graph.graphml (see compare_graphs).
+
+import argparse
+import io
+import json
+import os
+import time
+import zipfile
+
+import networkx as nx
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+EARTH_RADIUS_M = 6371008.8
+
+CACHE_DIR = 'cache'
+# osmnx names its cache files by query hash; these are the Overpass response and the boundary
+OVERPASS_CACHE_FILE = os.path.join(CACHE_DIR, '8899e4eaae315a5f7b565e9add220ee7cc8e8144.json')
+BOUNDARY_CACHE_FILE = os.path.join(CACHE_DIR, '1592ce44a1dd38c5093c7efe8fc1ea50ee749fcc.json')
+
+# Ways not walkable, as in osmnx's 'walk' network filter
+EXCLUDED_HIGHWAYS = {'abandoned', 'bus_guideway', 'construction', 'cycleway', 'motor', 'planned', 'platform',
+                     'proposed', 'raceway', 'motorway', 'motorway_link'}
+EXCLUDED_ACCESS = {'private', 'no'}
+ALLOWED_FOOT = {'yes', 'designated', 'permissive'}
+
+# Bytes read from the Overpass response at a time
+READ_CHUNK_SIZE = 1 << 16
+
+# Fixed timestamp of the .npz members, so the same input always gives the same bytes
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def iter_elements(overpass_file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yields the elements of an Overpass JSON response one at a time, decoding the
+    'elements' array incrementally from fixed-size chunks instead of loading the whole document.
+    """
+    decoder = json.JSONDecoder()
+    with open(overpass_file, encoding='utf-8') as f:
+        buffer = ''
+        start = -1
+        while start < 0:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+            key = buffer.find('"elements"')
+            start = buffer.find('[', key) if key >= 0 else -1
+        pos = start + 1
+
+        while True:
+            # Skip separators between elements
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buffer):
+                    break
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                buffer, pos = chunk, 0
+            if buffer[pos] == ']':
+                return
+
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element continues in the next chunk
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield element
+            buffer, pos = buffer[end:], 0
+
+
+def is_walkable(tags):
+    """Returns whether pedestrians may use a way with these OSM tags."""
+    if tags.get('highway') is None or tags['highway'] in EXCLUDED_HIGHWAYS or tags.get('area') == 'yes':
+        return False
+    if tags.get('foot') == 'no' or tags.get('service') == 'private':
+        return False
+    return tags.get('access') not in EXCLUDED_ACCESS or tags.get('foot') in ALLOWED_FOOT
+
+
+def read_overpass(overpass_file):
+    """
+    Streams the Overpass response into arrays.
+    Returns node ids, lat and lon (sorted by id), and the walkable ways as sorted way ids,
+    their highway and name tags, and their node ids packed back to back
+    (way i covers way_nodes[way_offsets[i]:way_offsets[i + 1]]).
+    """
+    node_ids, lats, lons = [], [], []
+    ways = []
+    for element in iter_elements(overpass_file):
+        if element['type'] == 'node':
+            node_ids.append(element['id'])
+            lats.append(element['lat'])
+            lons.append(element['lon'])
+        elif element['type'] == 'way' and is_walkable(element.get('tags', {})):
+            ways.append((element['id'], element.get('tags', {}), element['nodes']))
+
+    node_ids = np.array(node_ids, dtype=np.int64)
+    order = np.argsort(node_ids, kind='stable')
+    ways.sort(key=lambda way: way[0])
+    lengths = np.array([len(way[2]) for way in ways], dtype=np.int64)
+    way_offsets = np.zeros(len(ways) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=way_offsets[1:])
+    return {
+        "node_ids": node_ids[order],
+        "lat": np.array(lats, dtype=np.float64)[order],
+        "lon": np.array(lons, dtype=np.float64)[order],
+        "way_ids": np.array([way[0] for way in ways], dtype=np.int64),
+        "highway": [way[1]['highway'] for way in ways],
+        "name": [way[1].get('name', '') for way in ways],
+        "way_nodes": np.fromiter((node for way in ways for node in way[2]), dtype=np.int64,
+                                 count=int(way_offsets[-1])),
+        "way_offsets": way_offsets
+    }
+
+
+def read_boundary(boundary_file):
+    """Reads the district polygon from the cached Nominatim response."""
+    with open(boundary_file, encoding='utf-8') as f:
+        return shapely.geometry.shape(json.load(f)[0]['geojson'])
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distances in meters between arrays of points (degrees)."""
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def street_segments(osm, boundary):
+    """
+    Splits the walkable ways into node-to-node segments, keeps those with both ends inside
+    the boundary and in the largest connected part of the network, and merges segments
+    shared by several ways (the way with the lowest id is kept).
+    Returns the (a, b) node positions of each segment with a < b, and the way of each.
+    """
+    node_ids, way_nodes, way_offsets = osm['node_ids'], osm['way_nodes'], osm['way_offsets']
+    positions = np.searchsorted(node_ids, way_nodes)
+    positions = np.minimum(positions, len(node_ids) - 1)
+    known = node_ids[positions] == way_nodes
+
+    # A segment joins consecutive nodes of the same way
+    way_of = np.repeat(np.arange(len(way_offsets) - 1), np.diff(way_offsets))
+    same_way = way_of[:-1] == way_of[1:]
+    a, b = positions[:-1], positions[1:]
+    keep = same_way & known[:-1] & known[1:] & (a != b)
+
+    inside = shapely.contains_xy(boundary, osm['lon'], osm['lat'])
+    keep &= inside[a] & inside[b]
+    a, b, ways = np.minimum(a, b)[keep], np.maximum(a, b)[keep], way_of[:-1][keep]
+
+    # Ways are sorted by id, so the first occurrence of a segment belongs to the lowest way id
+    pairs, first = np.unique(np.column_stack((a, b)), axis=0, return_index=True)
+    a, b, ways = pairs[:, 0], pairs[:, 1], ways[first]
+
+    n = len(node_ids)
+    adjacency = coo_matrix((np.ones(len(a)), (a, b)), shape=(n, n))
+    _, labels = connected_components(adjacency, directed=False)
+    used = np.bincount(np.concatenate((a, b)), minlength=n) > 0
+    largest = np.argmax(np.bincount(labels[used]))
+    in_largest = labels[a] == largest
+    return a[in_largest], b[in_largest], ways[in_largest]
+
+
+def join_segments(a, b, n_nodes):
+    """
+    Joins chains of segments through nodes with exactly two neighbours into edges between
+    intersections and dead ends. Chains are walked in node order, so the result is deterministic.
+    Returns the node positions of every edge back to back (edge i covers
+    nodes[offsets[i]:offsets[i + 1]]) and the segment each edge starts with.
+    """
+    degree = np.bincount(np.concatenate((a, b)), minlength=n_nodes)
+    # Adjacency lists of node positions, each entry paired with its segment number
+    ends = np.concatenate((a, b))
+    others = np.concatenate((b, a))
+    segments = np.tile(np.arange(len(a)), 2)
+    order = np.lexsort((others, ends))
+    ends, others, segments = ends[order], others[order], segments[order]
+    starts = np.searchsorted(ends, np.arange(n_nodes + 1))
+
+    is_end = (degree > 0) & (degree != 2)
+    visited = np.zeros(len(a), dtype=bool)
+    nodes, offsets, first_segments = [], [0], []
+
+    def walk(start, k):
+        chain = [start]
+        segment, current = segments[k], others[k]
+        first_segments.append(segment)
+        while True:
+            visited[segment] = True
+            chain.append(current)
+            if is_end[current] or current == start:
+                break
+            # Continue through the other segment of a degree-2 node
+            k = starts[current] if segments[starts[current]] != segment else starts[current] + 1
+            segment, current = segments[k], others[k]
+        nodes.extend(chain)
+        offsets.append(len(nodes))
+
+    for start in np.flatnonzero(is_end):
+        for k in range(starts[start], starts[start + 1]):
+            if not visited[segments[k]]:
+                walk(start, k)
+    # Rings of degree-2 nodes only, started at their lowest node
+    for start in np.flatnonzero(degree == 2):
+        for k in range(starts[start], starts[start + 1]):
+            if not visited[segments[k]]:
+                walk(start, k)
+
+    return np.array(nodes, dtype=np.int64), np.array(offsets, dtype=np.int64), np.array(first_segments, dtype=np.int64)
+
+
+def build_graph(overpass_file=OVERPASS_CACHE_FILE, boundary_file=BOUNDARY_CACHE_FILE):
+    """
+    Builds the walkable street graph of the district from the cached responses.
+    Returns the graph arrays:
+      node_ids, lat, lon       nodes that are intersections or dead ends, sorted by OSM id
+      u, v                     node positions of each edge (u <= v in node order)
+      length                   edge length in meters along the street geometry
+      osmid, highway, name     way id and tags of each edge
+      coords, offsets          (lat, lon) street geometry of each edge from u to v, back to back
+    """
+    osm = read_overpass(overpass_file)
+    a, b, ways = street_segments(osm, read_boundary(boundary_file))
+    chain_nodes, offsets, first_segments = join_segments(a, b, len(osm['node_ids']))
+
+    # Edge lengths along the geometry, summed per edge over consecutive point pairs
+    lat, lon = osm['lat'][chain_nodes], osm['lon'][chain_nodes]
+    steps = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    steps[offsets[1:-1] - 1] = 0  # pairs spanning two edges
+    length = np.add.reduceat(np.append(steps, 0), offsets[:-1])
+
+    # Orient every edge from its lower to its higher end node
+    u_pos, v_pos = chain_nodes[offsets[:-1]], chain_nodes[offsets[1:] - 1]
+    flip = u_pos > v_pos
+    for i in np.flatnonzero(flip):
+        chain_nodes[offsets[i]:offsets[i + 1]] = chain_nodes[offsets[i]:offsets[i + 1]][::-1].copy()
+    u_pos, v_pos = np.minimum(u_pos, v_pos), np.maximum(u_pos, v_pos)
+
+    # Sort edges by end nodes, then by length, so parallel edges come shortest first
+    order = np.lexsort((length, v_pos, u_pos))
+    counts = np.diff(offsets)[order]
+    chain_nodes = np.concatenate([chain_nodes[offsets[i]:offsets[i + 1]] for i in order])
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Keep only the nodes that end an edge; the others are part of the geometry
+    graph_nodes, node_index = np.unique(np.concatenate((u_pos, v_pos)), return_inverse=True)
+    edge_ways = ways[first_segments[order]]
+    return {
+        "node_ids": osm['node_ids'][graph_nodes],
+        "lat": osm['lat'][graph_nodes],
+        "lon": osm['lon'][graph_nodes],
+        "u": node_index[:len(u_pos)][order],
+        "v": node_index[len(u_pos):][order],
+        "length": length[order],
+        "osmid": osm['way_ids'][edge_ways],
+        "highway": np.array([osm['highway'][w] for w in edge_ways], dtype=str),
+        "name": np.array([osm['name'][w] for w in edge_ways], dtype=str),
+        "coords": np.column_stack((osm['lat'][chain_nodes], osm['lon'][chain_nodes])),
+        "offsets": offsets
+    }
+
+
+def save_graph(path, arrays):
+    """
+    Writes graph arrays to an .npz file with fixed member timestamps, so rebuilding from the
+    same input gives a byte-identical file. The file is replaced atomically.
+    """
+    tmp_path = path + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name in sorted(arrays):
+            buffer = io.BytesIO()
+            np.lib.format.write_array(buffer, np.asarray(arrays[name]), allow_pickle=False)
+            info = zipfile.ZipInfo(name + '.npy', date_time=ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, buffer.getvalue())
+    os.replace(tmp_path, path)
+
+
+def load_graph(path):
+    """
+    Loads a graph written by save_graph as an undirected graph with string node ids,
+    node coordinates ('y', 'x') and edge 'length', 'osmid', 'highway' and 'name'.
+    Of parallel edges the shortest is kept. The street geometry is attached as
+    G.graph['edge_geometry'] in the packed format of geometry.load_edge_geometry.
+    """
+    with np.load(path) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+
+    node_ids = arrays['node_ids'].astype(str)
+    G = nx.Graph()
+    G.add_nodes_from((node_id, {'y': float(lat), 'x': float(lon)})
+                     for node_id, lat, lon in zip(node_ids, arrays['lat'], arrays['lon']))
+
+    edge_index = {}
+    # Edges are sorted shortest first within equal end nodes, so the first one wins
+    for i, (u, v) in enumerate(zip(node_ids[arrays['u']], node_ids[arrays['v']])):
+        if G.has_edge(u, v):
+            continue
+        G.add_edge(u, v, length=float(arrays['length'][i]), osmid=int(arrays['osmid'][i]),
+                   highway=str(arrays['highway'][i]), name=str(arrays['name'][i]))
+        edge_index[(u, v)] = i
+
+    G.graph['edge_geometry'] = {"coords": arrays['coords'], "offsets": arrays['offsets'], "edge_index": edge_index}
+    return G
+
+
+def compare_graphs(G, reference):
+    """
+    Compares the node and edge sets of two undirected graphs with string node ids.
+    Returns the nodes and edges missing from G or extra in G, and the largest length
+    difference in meters over the edges both have (the shortest of parallel edges).
+    """
+    def edge_lengths(graph):
+        lengths = {}
+        for u, v, data in graph.edges(data=True):
+            key = frozenset((str(u), str(v)))
+            lengths[key] = min(lengths.get(key, np.inf), float(data.get('length', 0)))
+        return lengths
+
+    nodes, reference_nodes = set(map(str, G.nodes)), set(map(str, reference.nodes))
+    edges, reference_edges = edge_lengths(G), edge_lengths(reference)
+    shared = edges.keys() & reference_edges.keys()
+    return {
+        "missing_nodes": len(reference_nodes - nodes),
+        "extra_nodes": len(nodes - reference_nodes),
+        "missing_edges": len(reference_edges.keys() - edges.keys()),
+        "extra_edges": len(edges.keys() - reference_edges.keys()),
+        "max_length_diff_m": max((abs(edges[key] - reference_edges[key]) for key in shared), default=0.0)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the graph from the cached Overpass response.")
+    parser.add_argument('--overpass', default=OVERPASS_CACHE_FILE)
+    parser.add_argument('--boundary', default=BOUNDARY_CACHE_FILE)
+    parser.add_argument('--out', default=os.path.join('data', 'dalseo_graph.npz'))
+    parser.add_argument('--reference', default=os.path.join('data', 'dalseo_real_graph.graphml'),
+                        help="Served graph to compare the result with")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    arrays = build_graph(args.overpass, args.boundary)
+    save_graph(args.out, arrays)
+    print(f"{args.out}: {len(arrays['node_ids'])} nodes, {len(arrays['u'])} edges, "
+          f"{len(arrays['coords'])} geometry points ({time.perf_counter() - started:.2f} s)")
+
+    if args.reference and os.path.exists(args.reference):
+        diff = compare_graphs(load_graph(args.out), nx.read_graphml(args.reference))
+        print(f"compared with {args.reference}: {diff['missing_nodes']} nodes and {diff['missing_edges']} edges "
+              f"missing, {diff['extra_nodes']} nodes and {diff['extra_edges']} edges extra, "
+              f"shared edge lengths differ by up to {diff['max_length_diff_m']:.1f} m")
+        if any(diff.values()):
+            print("The result does not match the served graph; set GRAPH_FILE to serve it anyway.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+# Contraction of degree-2 chains in the search graph.
+# Nodes with exactly two neighbours (bends along a street) only pass a search through.
+# Each chain of such nodes is replaced by one edge between the nodes at its ends, carrying
+# the original node sequence ('via') and the per-hop and summed length and weights. Searches run
+# on the contracted graph and the chains are expanded afterwards, so every node still gets its
+# exact distance and predecessor, as if the full graph had been searched. Searches by one of the
+# static edge attributes read the per-direction chain costs computed with the contraction (and
+# kept current by refresh_chains); other weights are evaluated per search.
+
+import argparse
+import heapq
+import os
+import random
+import time
+from itertools import count
+
+import networkx as nx
+import numpy as np
+
+# Edge attributes stored per hop and summed along a chain
+SUMMED_ATTRIBUTES = ('length', 'safe_only_weight', 'shortest_only_weight', 'hybrid_weight')
+
+
+def chain_values(G, nodes):
+    """
+    Returns the values of the SUMMED_ATTRIBUTES along a node sequence of G: the hop values
+    under 'hops' ({attribute: array}, missing values are inf as in a search) and the sums.
+    """
+    hops = {attr: np.array([G[x][y].get(attr, np.inf) for x, y in zip(nodes[:-1], nodes[1:])], dtype=np.float64)
+            for attr in SUMMED_ATTRIBUTES}
+    return dict({attr: float(values.sum()) for attr, values in hops.items()}, hops=hops)
+
+
+def contract_graph(G):
+    """
+    Contracts the chains of degree-2 nodes of an undirected graph.
+    A chain is left as it is when contracting it would create a self-loop (a loop street)
+    or a second edge between the same two nodes; rings made only of degree-2 nodes are kept too.
+    Returns {"graph": the contracted graph, "chain_of": interior node -> (a, b) contracted edge,
+    "chains": the (a, b) contracted edges, "paths": (a, b) -> node sequence from a to b,
+    "adjacency": neighbour lists used by contracted_tree, "static": the chain costs of each
+    of the SUMMED_ATTRIBUTES (see static_chain_costs)}.
+    Contracted edges have 'via' (the interior nodes, listed from 'via_from'), the
+    SUMMED_ATTRIBUTES per hop ('hops', from 'via_from') and summed; other edges carry no
+    attributes (search weights are read from G).
+    """
+    keep = [n for n in G if G.degree(n) != 2 or G.has_edge(n, n)]
+    C = nx.Graph()
+    C.add_nodes_from(keep)
+    C.add_edges_from((u, v) for u, v in G.edges if u in C and v in C)
+    chain_of = {}
+
+    for a in keep:
+        for n in G[a]:
+            if n in C or n in chain_of:
+                continue
+            via, previous, current = [], a, n
+            while current not in C:
+                via.append(current)
+                previous, current = current, next(x for x in G[current] if x != previous)
+            b = current
+
+            nodes = [a] + via + [b]
+            if b == a or C.has_edge(a, b):
+                C.add_edges_from(zip(nodes[:-1], nodes[1:]))
+                continue
+            C.add_edge(a, b, via=via, via_from=a, **chain_values(G, nodes))
+            for x in via:
+                chain_of[x] = (a, b)
+
+    # Rings not connected to any other node
+    for n in G:
+        if n not in C and n not in chain_of:
+            C.add_edges_from((n, x) for x in G[n])
+
+    # Search adjacency: (neighbour, edge data, contracted?) where the data of a plain edge
+    # is G's own attribute dict, so weight changes made on G are seen without a rebuild
+    adjacency = {u: [(v, data, True) if 'via' in data else (v, G[u][v], False) for v, data in C[u].items()]
+                 for u in C}
+    chains = sorted(set(chain_of.values()))
+    contraction = {"graph": C, "chain_of": chain_of, "chains": chains, "adjacency": adjacency,
+                   "paths": {(a, b): chain_nodes(C[a][b], a, b) for a, b in chains},
+                   "static": {attr: {"chains": {}, "crossings": {}} for attr in SUMMED_ATTRIBUTES}}
+    static_chain_costs(contraction, chains)
+    return contraction
+
+
+def static_chain_costs(contraction, edges):
+    """
+    Stores the costs of the given contracted edges for searches by each of the
+    SUMMED_ATTRIBUTES, which are the same in both directions: under
+    contraction['static'][attribute], 'chains' maps (a, b) to (nodes, forward hop costs,
+    backward hop costs) oriented from a, and 'crossings' maps both directions to the cost
+    of crossing the chain and the last interior node passed.
+    """
+    C = contraction['graph']
+    for a, b in edges:
+        data, nodes = C[a][b], contraction['paths'][a, b]
+        for attr, static in contraction['static'].items():
+            forward = data['hops'][attr] if data['via_from'] == a else data['hops'][attr][::-1]
+            static['chains'][a, b] = (nodes, forward, forward)
+            static['crossings'][a, b] = (data[attr], nodes[-2])
+            static['crossings'][b, a] = (data[attr], nodes[1])
+
+
+def chain_nodes(data, a, b):
+    """Returns the full node sequence of the contracted edge (a, b) in the direction from a to b."""
+    via = data['via'] if data['via_from'] == a else data['via'][::-1]
+    return [a] + via + [b]
+
+
+def refresh_chains(G, node_ids):
+    """
+    Recomputes the stored attributes of the contracted edges whose chains touch the given
+    nodes, after the weights of the edges at those nodes changed. Returns the number refreshed.
+    """
+    contraction = G.graph.get('contraction')
+    if contraction is None:
+        return 0
+    C, chain_of = contraction['graph'], contraction['chain_of']
+
+    edges = set()
+    for node_id in node_ids:
+        if node_id in chain_of:
+            edges.add(chain_of[node_id])
+        elif node_id in C:
+            edges.update((node_id, x) for x, data in C[node_id].items() if 'via' in data)
+    for a, b in edges:
+        data = C[a][b]
+        # Hop values are listed from 'via_from'
+        start = data['via_from']
+        data.update(chain_values(G, chain_nodes(data, start, b if start == a else a)))
+    static_chain_costs(contraction, [edge if edge in contraction['paths'] else edge[::-1] for edge in edges])
+    return len(edges)
+
+
+def contracted_tree(G, source, weight, attribute=None):
+    """
+    Shortest-path tree from source computed on the contracted graph and expanded back
+    to every node of G. weight is a function (u, v, data) on the edges of G, as for networkx.
+    attribute names the edge attribute weight returns when it is one of SUMMED_ATTRIBUTES
+    in both directions; the chain costs are then read from the contracted edges.
+    Returns the predecessor map {node: predecessor} over G (the source has none).
+    """
+    contraction = G.graph['contraction']
+    chain_of, adjacency = contraction['chain_of'], contraction['adjacency']
+    stored = attribute in SUMMED_ATTRIBUTES
+
+    if stored:
+        chains = contraction['static'][attribute]['chains']
+        crossings = contraction['static'][attribute]['crossings']
+    else:
+        # Hop costs of every chain in both directions. Other weights may depend on the direction
+        # (time-slot weights use the safety of the node an edge leads to), so they are evaluated here
+        chains, crossings = {}, {}
+        for (a, b), nodes in contraction['paths'].items():
+            hops = list(zip(nodes[:-1], nodes[1:]))
+            forward = np.array([weight(x, y, G[x][y]) for x, y in hops], dtype=np.float64)
+            backward = np.array([weight(y, x, G[x][y]) for x, y in hops], dtype=np.float64)
+            chains[a, b] = (nodes, forward, backward)
+            # Cost of crossing the chain and the last interior node passed, in both directions
+            crossings[a, b] = (float(forward.sum()), nodes[-2])
+            crossings[b, a] = (float(backward.sum()), nodes[1])
+
+    def chain(a, b):
+        """Returns the nodes, forward and backward hop costs of a chain, oriented from a."""
+        if (a, b) in chains:
+            return chains[a, b]
+        nodes, forward, backward = chains[b, a]
+        return nodes[::-1], backward[::-1], forward[::-1]
+
+    dist, pred, seen = {}, {}, {}
+    heap, counter = [], count()
+    if source in adjacency:
+        seeds = [(source, 0.0, None)]
+    else:
+        # Start inside a chain: enter the contracted graph at both of its ends
+        nodes, forward, backward = chain(*chain_of[source])
+        j = nodes.index(source)
+        seeds = [(nodes[0], backward[:j].sum(), nodes[1]), (nodes[-1], forward[j:].sum(), nodes[-2])]
+    for node, cost, first_hop in seeds:
+        seen[node] = cost
+        pred[node] = first_hop
+        heapq.heappush(heap, (cost, next(counter), node))
+
+    while heap:
+        d, _, u = heapq.heappop(heap)
+        if u in dist:
+            continue
+        dist[u] = d
+        for v, data, contracted in adjacency[u]:
+            if contracted:
+                cost, last_hop = crossings[u, v]
+                cost += d
+            elif stored:
+                # Plain edges are G's own attribute dicts
+                cost, last_hop = d + data.get(attribute, np.inf), u
+            else:
+                cost, last_hop = d + weight(u, v, data), u
+            if v not in dist and (v not in seen or cost < seen[v]):
+                seen[v] = cost
+                pred[v] = last_hop
+                heapq.heappush(heap, (cost, next(counter), v))
+
+    tree = {node: p for node, p in pred.items() if p is not None and node != source}
+
+    # Interior nodes take the cheaper way in from either end of their chain
+    for (a, b), (nodes, forward, backward) in chains.items():
+        from_a = dist.get(a, np.inf) + np.concatenate(([0.0], np.cumsum(forward)))
+        from_b = dist.get(b, np.inf) + np.concatenate((np.cumsum(backward[::-1])[::-1], [0.0]))
+        if source in chain_of and chain_of[source] in ((a, b), (b, a)):
+            j = nodes.index(source)
+            direct = np.full(len(nodes), np.inf)
+            direct[j:] = np.concatenate(([0.0], np.cumsum(forward[j:])))
+            direct[:j + 1] = np.concatenate((np.cumsum(backward[:j][::-1])[::-1], [0.0]))
+        else:
+            j, direct = None, None
+        for i in range(1, len(nodes) - 1):
+            if i == j:
+                continue
+            if direct is not None and direct[i] <= min(from_a[i], from_b[i]):
+                tree[nodes[i]] = nodes[i - 1] if i > j else nodes[i + 1]
+            elif from_a[i] <= from_b[i] and np.isfinite(from_a[i]):
+                tree[nodes[i]] = nodes[i - 1]
+            elif np.isfinite(from_b[i]):
+                tree[nodes[i]] = nodes[i + 1]
+    return tree
+
+
+def tree_cost(tree, weight, G, source, target):
+    """Cost of the tree path from source to target (None if unreachable)."""
+    total, node = 0.0, target
+    while node != source:
+        if node not in tree:
+            return None
+        total += weight(tree[node], node, G[tree[node]][node])
+        node = tree[node]
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Contract degree-2 chains and check searches against the full graph.")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--graph', default=None, help="graphml or array graph (default: the served graph)")
+    parser.add_argument('--sources', type=int, default=50, help="Random start nodes to compare")
+    args = parser.parse_args()
+
+    from data_store import prefer_columnar
+    from path_service import create_pathfinding_model, edge_weight
+
+    graph_file = args.graph or os.path.join(args.data_dir, 'dalseo_real_graph.graphml')
+    G = create_pathfinding_model(graph_file, prefer_columnar(os.path.join(args.data_dir, 'nodes_final_with_safety_score.csv')))
+    contraction = G.graph['contraction']
+    C = contraction['graph']
+    print(f"{graph_file}: {G.number_of_nodes()} -> {C.number_of_nodes()} nodes, "
+          f"{G.number_of_edges()} -> {C.number_of_edges()} edges, {len(contraction['chain_of'])} contracted")
+
+    sources = random.Random(0).sample(list(G.nodes), min(args.sources, G.number_of_nodes()))
+    for weight_name in ('safe_only_weight', 'shortest_only_weight', 'hybrid_weight'):
+        weight = edge_weight(G, weight_name)
+        full_s = contracted_s = 0.0
+        mismatched_paths = worst = 0
+        for source in sources:
+            started = time.perf_counter()
+            pred, distance = nx.dijkstra_predecessor_and_distance(G, source, weight=weight)
+            full_s += time.perf_counter() - started
+            full = {node: preds[0] for node, preds in pred.items() if preds}
+
+            started = time.perf_counter()
+            tree = contracted_tree(G, source, weight, weight_name)
+            contracted_s += time.perf_counter() - started
+
+            if tree.keys() != full.keys():
+                raise SystemExit(f"{weight_name}: reachable nodes differ from {source}")
+            for node in full:
+                cost = tree_cost(tree, weight, G, source, node)
+                worst = max(worst, abs(cost - distance[node]) / max(distance[node], 1e-9))
+                mismatched_paths += tree[node] != full[node]
+        print(f"{weight_name}: full {full_s / len(sources) * 1000:.1f} ms, "
+              f"contracted {contracted_s / len(sources) * 1000:.1f} ms per search, "
+              f"max relative cost difference {worst:.1e}, {mismatched_paths} equal-cost predecessor choices differ")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Publish/subscribe hub for live crew views.
+# Position updates of running sessions are published to a crew post's topic and fanned out
+# to its subscribers on a dedicated asyncio event loop, so the ingestion path only pays for
+# handing one update to the loop, however many viewers are watching.
+
+import asyncio
+import threading
+from collections import OrderedDict
+
+# Updates pending per subscriber; when full, the oldest pending update is dropped
+SUBSCRIBER_QUEUE_SIZE = 64
+
+_loop = None
+_loop_lock = threading.Lock()
+# Only touched from the event loop thread: crew_post_id -> set of subscribers
+_topics = {}
+
+
+class Subscriber:
+    """
+    One viewer of a crew post. Pending updates are keyed by session, so rapid updates of
+    the same runner coalesce into the latest one, and the queue is bounded with drop-oldest.
+    """
+
+    def __init__(self, crew_post_id):
+        self.crew_post_id = crew_post_id
+        self.pending = OrderedDict()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def offer(self, session_id, update):
+        if session_id in self.pending:
+            # Coalesce: keep the newest update, at the position of the latest arrival
+            del self.pending[session_id]
+        elif len(self.pending) >= SUBSCRIBER_QUEUE_SIZE:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        self.pending[session_id] = update
+        self.ready.set()
+
+    def drain(self):
+        updates = list(self.pending.values())
+        self.pending.clear()
+        self.ready.clear()
+        return updates
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='live-hub', daemon=True)
+            thread.start()
+            _loop = loop
+        return _loop
+
+
+def _publish(crew_post_id, session_id, update):
+    for subscriber in _topics.get(crew_post_id, ()):
+        subscriber.offer(session_id, update)
+
+
+def publish(crew_post_id, session_id, update):
+    """
+    Publishes a session's update to everyone watching a crew post.
+    Safe to call from any thread; the fan-out itself runs on the hub's event loop.
+    """
+    _get_loop().call_soon_threadsafe(_publish, crew_post_id, session_id, update)
+
+
+async def _subscribe(crew_post_id):
+    subscriber = Subscriber(crew_post_id)
+    _topics.setdefault(crew_post_id, set()).add(subscriber)
+    return subscriber
+
+
+async def _unsubscribe(subscriber):
+    subscribers = _topics.get(subscriber.crew_post_id)
+    if subscribers is not None:
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del _topics[subscriber.crew_post_id]
+
+
+async def _next_updates(subscriber, timeout):
+    try:
+        await asyncio.wait_for(subscriber.ready.wait(), timeout)
+    except asyncio.TimeoutError:
+        return []
+    return subscriber.drain()
+
+
+def subscribe(crew_post_id):
+    """Registers a new viewer of a crew post and returns its subscriber."""
+    return asyncio.run_coroutine_threadsafe(_subscribe(crew_post_id), _get_loop()).result()
+
+
+def unsubscribe(subscriber):
+    """Removes a viewer."""
+    asyncio.run_coroutine_threadsafe(_unsubscribe(subscriber), _get_loop()).result()
+
+
+def next_updates(subscriber, timeout=15.0):
+    """
+    Blocks until the subscriber has updates or the timeout passes.
+    Returns the pending updates (an empty list on timeout).
+    """
+    future = asyncio.run_coroutine_threadsafe(_next_updates(subscriber, timeout), _get_loop())
+    return future.result(timeout + 5)
+
+
+def subscriber_count(crew_post_id):
+    """Returns how many viewers are watching a crew post."""
+    async def count():
+        return len(_topics.get(crew_post_id, ()))
+    return asyncio.run_coroutine_threadsafe(count(), _get_loop()).result()
@@ -0,0 +1,390 @@
+# HMM map-matching of GPS traces onto the pathfinding graph.
+# Candidate positions come from a prebuilt spatial index over edge segments, transition
+# costs from bounded shortest paths between candidates, and the most likely sequence of
+# positions is found with the Viterbi algorithm.
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import numpy as np
+from scipy.spatial import cKDTree
+
+from geometry import edge_coords
+from path_service import path_edge_lengths
+
+EARTH_RADIUS_M = 6371008.8
+
+# Standard deviation of GPS noise, in meters (emission model)
+GPS_SIGMA_M = 10.0
+# Scale of the difference between route and straight-line distance (transition model)
+TRANSITION_BETA_M = 30.0
+# Edges farther than this from a fix are not candidates for it
+CANDIDATE_RADIUS_M = 40.0
+# At most this many candidate edges are kept per fix
+MAX_CANDIDATES = 8
+# Shortest-path searches between candidates stop at this multiple of the straight-line
+# distance between the fixes, plus a fixed allowance
+MAX_ROUTE_FACTOR = 3.0
+MAX_ROUTE_EXTRA_M = 300.0
+
+
+def _project(lat, lon, lat0):
+    """Equirectangular projection to local meters around latitude lat0 (degrees)."""
+    x = EARTH_RADIUS_M * np.radians(lon) * np.cos(np.radians(lat0))
+    y = EARTH_RADIUS_M * np.radians(lat)
+    return np.column_stack((x, y))
+
+
+def build_segment_index(G):
+    """
+    Splits every graph edge into straight segments (using the street geometry when the
+    graph has it) and builds a KD-tree over the segment midpoints in local meters.
+    Edges are oriented from u to v as listed by G.edges; positions along an edge are
+    measured from u. The index is stored on the graph as G.graph['segment_index'].
+    """
+    arrays = G.graph['arrays']
+    node_pos = arrays['node_pos']
+    edge_geometry = G.graph.get('edge_geometry')
+    lat0 = float(np.nanmean(arrays['lat']))
+
+    edge_u, edge_v, lines = [], [], []
+    for u, v in G.edges():
+        line = edge_coords(edge_geometry, u, v) if edge_geometry else None
+        if line is None:
+            line = np.array([[G.nodes[u]['lat'], G.nodes[u]['lon']], [G.nodes[v]['lat'], G.nodes[v]['lon']]])
+        edge_u.append(node_pos[u])
+        edge_v.append(node_pos[v])
+        lines.append(line)
+
+    counts = np.array([len(line) - 1 for line in lines])
+    points = _project(*np.concatenate(lines).T, lat0)
+    line_start = np.concatenate(([0], np.cumsum(counts + 1)[:-1]))
+
+    # Segment k of edge e runs from points[line_start[e] + k] to the next point
+    seg_edge = np.repeat(np.arange(len(lines)), counts)
+    seg_first = np.repeat(line_start, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    seg_a = points[seg_first]
+    seg_b = points[seg_first + 1]
+    seg_len = np.hypot(*(seg_b - seg_a).T)
+
+    # Offset of every segment start from the start of its edge
+    cum = np.cumsum(seg_len)
+    edge_total = np.add.reduceat(seg_len, np.cumsum(counts) - counts)
+    seg_offset = cum - seg_len - np.repeat(np.cumsum(edge_total) - edge_total, counts)
+
+    G.graph['segment_index'] = {
+        "lat0": lat0,
+        "tree": cKDTree((seg_a + seg_b) / 2),
+        "max_half_len": float(seg_len.max() / 2) if len(seg_len) else 0.0,
+        "seg_a": seg_a,
+        "seg_b": seg_b,
+        "seg_len": seg_len,
+        "seg_edge": seg_edge,
+        "seg_offset": seg_offset,
+        "edge_u": np.array(edge_u, dtype=np.int64),
+        "edge_v": np.array(edge_v, dtype=np.int64),
+        "edge_length": edge_total
+    }
+    return G.graph['segment_index']
+
+
+def find_candidates(index, xy):
+    """
+    Finds the candidate positions of every fix: the closest point of each nearby edge,
+    keeping the MAX_CANDIDATES closest edges.
+    Returns one (edges, positions, distances, points) tuple of arrays per fix.
+    """
+    radius = CANDIDATE_RADIUS_M + index['max_half_len']
+    nearby = index['tree'].query_ball_point(xy, r=radius)
+
+    candidates = []
+    for p, segs in zip(xy, nearby):
+        segs = np.asarray(segs, dtype=np.int64)
+        if len(segs) == 0:
+            candidates.append(None)
+            continue
+
+        a, b, length = index['seg_a'][segs], index['seg_b'][segs], index['seg_len'][segs]
+        ab = b - a
+        t = np.clip(np.einsum('ij,ij->i', p - a, ab) / np.maximum(length ** 2, 1e-12), 0, 1)
+        proj = a + t[:, None] * ab
+        dist = np.hypot(*(p - proj).T)
+
+        # Best segment per edge, then the closest edges overall
+        edges = index['seg_edge'][segs]
+        order = np.lexsort((dist, edges))
+        first = order[np.concatenate(([True], edges[order][1:] != edges[order][:-1]))]
+        first = first[dist[first] <= CANDIDATE_RADIUS_M]
+        if len(first) == 0:
+            candidates.append(None)
+            continue
+        first = first[np.argsort(dist[first])[:MAX_CANDIDATES]]
+
+        positions = index['seg_offset'][segs[first]] + t[first] * length[first]
+        candidates.append((edges[first], positions, dist[first], proj[first]))
+    return candidates
+
+
+def _node_distances(G, node_ids, source, cutoff, cache):
+    """
+    Bounded shortest-path lengths from a node as (reached node indices, lengths) arrays sorted
+    by node index, reusing an earlier search with a larger cutoff.
+    """
+    cached = cache.get(source)
+    if cached is None or cached[0] < cutoff:
+        lengths = nx.single_source_dijkstra_path_length(G, node_ids[source], cutoff=cutoff, weight='length')
+        node_pos = G.graph['arrays']['node_pos']
+        reached = np.fromiter((node_pos[n] for n in lengths), dtype=np.int64, count=len(lengths))
+        dist = np.fromiter(lengths.values(), dtype=np.float64, count=len(lengths))
+        order = np.argsort(reached)
+        cached = cache[source] = (cutoff, reached[order], dist[order])
+    return cached[1], cached[2]
+
+
+def _route_distances(G, index, node_ids, prev, cur, cutoff, cache):
+    """
+    Network distance between every pair of (previous, current) candidates, traveling
+    through either end of each edge, or directly along the edge when both are on the same one.
+    Returns the distance matrix and, per pair, which ends were used (for path reconstruction).
+    """
+    prev_edges, prev_pos = prev[0], prev[1]
+    cur_edges, cur_pos = cur[0], cur[1]
+
+    # Cost to leave the previous edge through u / v, and to enter the current edge from u / v
+    prev_nodes = np.column_stack((index['edge_u'][prev_edges], index['edge_v'][prev_edges]))
+    prev_cost = np.column_stack((prev_pos, index['edge_length'][prev_edges] - prev_pos))
+    cur_nodes = np.column_stack((index['edge_u'][cur_edges], index['edge_v'][cur_edges]))
+    cur_cost = np.column_stack((cur_pos, index['edge_length'][cur_edges] - cur_pos))
+
+    # One bounded search per distinct end node, looked up for all current ends at once
+    sources, source_of = np.unique(prev_nodes.ravel(), return_inverse=True)
+    targets = cur_nodes.ravel()
+    from_source = np.empty((len(sources), len(targets)))
+    for k, source in enumerate(sources):
+        reached, lengths = _node_distances(G, node_ids, source, cutoff, cache)
+        pos = np.minimum(np.searchsorted(reached, targets), len(reached) - 1)
+        from_source[k] = np.where(reached[pos] == targets, lengths[pos], np.inf)
+    between = from_source[source_of].reshape(len(prev_edges), 2, len(cur_edges), 2)
+
+    total = prev_cost[:, :, None, None] + between + cur_cost[None, None, :, :]
+    flat = total.transpose(0, 2, 1, 3).reshape(len(prev_edges), len(cur_edges), 4)
+    ends = flat.argmin(axis=2)
+    dist = flat.min(axis=2)
+
+    same_edge = prev_edges[:, None] == cur_edges[None, :]
+    along = np.abs(prev_pos[:, None] - cur_pos[None, :])
+    direct = same_edge & (along <= dist)
+    dist = np.where(direct, along, dist)
+    ends = np.where(direct, -1, ends)
+    return dist, ends
+
+
+def _viterbi(G, index, node_ids, xy, candidates):
+    """
+    Runs the Viterbi algorithm over the fixes that have candidates. A fix that no
+    candidate of the previous fix can reach starts a new chain.
+    Returns the chosen candidate per fix and the transitions between chosen candidates
+    as (prev_fix, prev_candidate, fix, candidate, ends, distance) tuples in trace order.
+    """
+    chains = []
+    back = {}
+    scores = None
+    prev_step = None
+    cache = {}
+
+    for step, cand in enumerate(candidates):
+        if cand is None:
+            continue
+        emission = -0.5 * (cand[2] / GPS_SIGMA_M) ** 2
+
+        if scores is not None:
+            straight = float(np.hypot(*(xy[step] - xy[prev_step])))
+            cutoff = MAX_ROUTE_FACTOR * straight + MAX_ROUTE_EXTRA_M
+            dist, ends = _route_distances(G, index, node_ids, candidates[prev_step], cand, cutoff, cache)
+
+            # Every column of the (previous, current) score matrix is maximized at once
+            total = scores[:, None] - np.abs(dist - straight) / TRANSITION_BETA_M
+            best = total.argmax(axis=0)
+            cols = np.arange(len(best))
+            new_scores = total[best, cols] + emission
+            if np.isfinite(new_scores).any():
+                back[step] = (prev_step, best, ends[best, cols], dist[best, cols])
+                scores = new_scores
+                prev_step = step
+                chains[-1]["steps"].append(step)
+                chains[-1]["scores"] = scores
+                continue
+
+        scores = emission
+        prev_step = step
+        chains.append({"steps": [step], "scores": scores})
+
+    chosen = {}
+    transitions = []
+    for chain in chains:
+        steps = chain["steps"]
+        j = int(np.argmax(chain["scores"]))
+        chosen[steps[-1]] = j
+        chain_transitions = []
+        for step in reversed(steps[1:]):
+            prev_step, best, ends, dist = back[step]
+            i = int(best[j])
+            chain_transitions.append((prev_step, i, step, j, int(ends[j]), float(dist[j])))
+            chosen[prev_step] = i
+            j = i
+        transitions.extend(reversed(chain_transitions))
+    return chosen, transitions
+
+
+def _route_node_pairs(G, route_waypoints):
+    """Returns the set of undirected node index pairs a planned route runs along."""
+    tree, tree_node_ids = G.graph['node_index']
+    dist, nearest = tree.query(np.asarray(route_waypoints, dtype=np.float64))
+    node_pos = G.graph['arrays']['node_pos']
+    nodes = [node_pos[tree_node_ids[i]] for i in nearest]
+    return {frozenset(pair) for pair in zip(nodes[:-1], nodes[1:])}
+
+
+def match_trace(G, trace, route_waypoints=None):
+    """
+    Matches an (n, 3) trace of (timestamp, lat, lon) onto the graph.
+    Returns the matched position of every fix (None where no edge is near), the edges
+    traveled in order with their safety, the matched distance, a length-weighted safety
+    score and, when route_waypoints is given, the share of matched fixes on that route.
+    """
+    index = G.graph.get('segment_index') or build_segment_index(G)
+    arrays = G.graph['arrays']
+    node_ids = arrays['node_ids']
+
+    trace = np.asarray(trace, dtype=np.float64).reshape(-1, 3)
+    xy = _project(trace[:, 1], trace[:, 2], index['lat0'])
+    candidates = find_candidates(index, xy)
+    chosen, transitions = _viterbi(G, index, node_ids, xy, candidates)
+
+    # Matched positions back in (lat, lon)
+    cos_lat0 = np.cos(np.radians(index['lat0']))
+    matched_points = [None] * len(trace)
+    for step, j in chosen.items():
+        x, y = candidates[step][3][j]
+        matched_points[step] = [float(np.degrees(y / EARTH_RADIUS_M)),
+                                float(np.degrees(x / (EARTH_RADIUS_M * cos_lat0)))]
+
+    # Edges traveled, in order: candidate edges joined by the shortest paths between them
+    def edge_nodes(e):
+        return int(index['edge_u'][e]), int(index['edge_v'][e])
+
+    traveled = []
+
+    def add_edge(u, v):
+        if not traveled or {u, v} != set(traveled[-1]):
+            traveled.append((u, v))
+
+    arriving = {t[2]: t for t in transitions}
+    distance_m = 0.0
+    for step in sorted(set(chosen) | set(arriving)):
+        if step not in arriving:
+            add_edge(*edge_nodes(candidates[step][0][chosen[step]]))
+            continue
+
+        prev_step, i, _, j, ends, dist = arriving[step]
+        distance_m += dist
+        prev_edge, cur_edge = candidates[prev_step][0][i], candidates[step][0][j]
+        if ends >= 0:
+            a = edge_nodes(prev_edge)[ends // 2]
+            b = edge_nodes(cur_edge)[ends % 2]
+            path = nx.shortest_path(G, node_ids[a], node_ids[b], weight='length')
+            path_pos = [arrays['node_pos'][n] for n in path]
+            for u, v in zip(path_pos[:-1], path_pos[1:]):
+                add_edge(u, v)
+        add_edge(*edge_nodes(cur_edge))
+
+    lengths = np.array([path_edge_lengths(arrays, np.array(edge))[0] for edge in traveled])
+    safety = np.array([(arrays['safety'][u] + arrays['safety'][v]) / 2 for u, v in traveled])
+    edges = [{"u": node_ids[u], "v": node_ids[v], "length_m": round(float(l), 1), "safety_score": round(float(s), 2)}
+             for (u, v), l, s in zip(traveled, lengths, safety)]
+
+    adherence = None
+    if route_waypoints and chosen:
+        planned = _route_node_pairs(G, route_waypoints)
+        on_route = [frozenset(edge_nodes(candidates[step][0][j])) in planned for step, j in chosen.items()]
+        adherence = round(float(np.mean(on_route)), 3)
+
+    return {
+        "matched_points": matched_points,
+        "matched_ratio": round(len(chosen) / len(trace), 3) if len(trace) else 0,
+        "edges": edges,
+        "distance_km": round(distance_m / 1000, 3),
+        "safety_score": round(float(np.average(safety, weights=lengths)), 2) if lengths.sum() > 0 else 0,
+        "route_adherence": adherence
+    }
+
+
+# --- Bulk matching with a process pool ---
+
+_worker_graph = None
+
+
+def _init_worker(graphml_file, nodes_csv_file, edges_csv_file):
+    """Loads the model once per worker process."""
+    global _worker_graph
+    from path_service import create_pathfinding_model
+    _worker_graph = create_pathfinding_model(graphml_file, nodes_csv_file, edges_csv_file)
+    build_segment_index(_worker_graph)
+
+
+def _match_job(job):
+    session_id, trace, route_waypoints = job
+    try:
+        return session_id, match_trace(_worker_graph, trace, route_waypoints)
+    except Exception as e:
+        return session_id, {"error": str(e)}
+
+
+def match_sessions(jobs, graphml_file, nodes_csv_file, edges_csv_file=None, workers=None):
+    """
+    Matches a backlog of traces in parallel. jobs is an iterable of
+    (session_id, trace, route_waypoints) tuples; every worker process loads the model once.
+    Returns a dict of session_id -> match result (or {"error": ...}).
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(graphml_file, nodes_csv_file, edges_csv_file)) as executor:
+        return dict(executor.map(_match_job, jobs, chunksize=4))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Map-match recorded session traces onto the Dalseo graph.")
+    parser.add_argument('session_ids', nargs='+', help="IDs of the sessions to match")
+    parser.add_argument('--store', default=os.path.join('data', 'run_store.sqlite3'),
+                        help="SQLite run store the sessions were recorded in")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    import json
+    import trace_ingest
+    from data_store import prefer_columnar
+    from storage import SQLiteBackend
+
+    store = SQLiteBackend(args.store)
+    trace_ingest.set_store(store)
+
+    jobs = []
+    for session_id in args.session_ids:
+        session_data = store.get("sessions", session_id) or {}
+        route = store.get("routes", session_data.get("route_id", "")) or {}
+        jobs.append((session_id, trace_ingest.get_trace(session_id), route.get("waypoints")))
+
+    results = match_sessions(jobs,
+                             os.path.join(args.data_dir, 'dalseo_real_graph.graphml'),
+                             prefer_columnar(os.path.join(args.data_dir, 'nodes_final_with_safety_score.csv')),
+                             prefer_columnar(os.path.join(args.data_dir, 'dalseo_edges_corrected.csv')),
+                             workers=args.workers)
+    for session_id, result in results.items():
+        result = {k: v for k, v in result.items() if k != 'matched_points'}
+        print(session_id, json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Versioned registry of the served pathfinding model.
+# A new graph and its safety data are loaded and validated on a background thread while the
+# current model keeps serving, then swapped in with a single reference assignment. Requests
+# take a local reference to the model once, so in-flight requests finish on the version they
+# started with, and every cache kept on the old graph (shortest-path trees, time-slot
+# profiles, spatial indexes) goes away with it.
+
+import datetime
+import threading
+
+import numpy as np
+
+from path_service import BALANCED_WEIGHT
+
+
+class ModelRegistry:
+    """
+    Holds the current model and reloads it in the background.
+    loader is a function that builds a new model (a graph) or returns None on failure.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._model = None
+        self._version = 0
+        self._lock = threading.Lock()
+        self._reloader = None
+        self.loaded_at = None
+        self.last_error = None
+
+    def current(self):
+        """Returns the current model. Callers should keep this reference for the whole request."""
+        return self._model
+
+    @property
+    def version(self):
+        return self._version
+
+    def load(self):
+        """
+        Loads, validates and swaps in a new model on the calling thread.
+        Raises ValueError if the new model is invalid; the current model is kept then.
+        Returns the new version.
+        """
+        try:
+            G = self._loader()
+            validate_model(G)
+        except Exception as e:
+            self.last_error = str(e)
+            raise ValueError(f"Model reload failed: {e}") from e
+
+        with self._lock:
+            self._version += 1
+            G.graph['model_version'] = self._version
+            # Swap: requests that already hold the old model keep using it
+            self._model = G
+            self.loaded_at = datetime.datetime.utcnow().isoformat() + 'Z'
+            self.last_error = None
+            return self._version
+
+    def reload_async(self):
+        """
+        Starts loading a new model on a background thread.
+        Returns False if a reload is already running.
+        """
+        with self._lock:
+            if self._reloader is not None and self._reloader.is_alive():
+                return False
+
+            def run():
+                try:
+                    self.load()
+                except ValueError as e:
+                    print(e)
+
+            self._reloader = threading.Thread(target=run, name='model-reload', daemon=True)
+            self._reloader.start()
+            return True
+
+    def reloading(self):
+        return self._reloader is not None and self._reloader.is_alive()
+
+    def status(self):
+        """Returns the current version, when it was loaded, and the state of reloading."""
+        G = self._model
+        return {
+            "version": self._version,
+            "loaded_at": self.loaded_at,
+            "reloading": self.reloading(),
+            "last_error": self.last_error,
+            "nodes": G.number_of_nodes() if G is not None else 0,
+            "edges": G.number_of_edges() if G is not None else 0
+        }
+
+
+def validate_model(G):
+    """
+    Checks that a freshly loaded model can serve requests: it has nodes and edges, its
+    node index and arrays were built, safety scores are finite and on the 100-point
+    scale, and every edge has finite, non-negative search weights.
+    Raises ValueError describing the first problem found.
+    """
+    if G is None:
+        raise ValueError("the graph or safety data could not be loaded")
+    if G.number_of_nodes() == 0 or G.number_of_edges() == 0:
+        raise ValueError("the graph has no nodes or edges")
+    if G.graph.get('node_index') is None or G.graph.get('arrays') is None:
+        raise ValueError("the node index or graph arrays are missing")
+
+    safety = G.graph['arrays']['safety']
+    if not np.isfinite(safety).all() or safety.min() < 0 or safety.max() > 100 + 1e-6:
+        raise ValueError("node safety scores are not finite values between 0 and 100")
+    if not (safety > 0).any():
+        raise ValueError("every node has a safety score of 0")
+
+    located = np.isfinite(G.graph['arrays']['lat']).mean()
+    if located < 0.9:
+        raise ValueError(f"only {located:.0%} of the nodes have coordinates")
+
+    for u, v, data in G.edges(data=True):
+        for weight in ('safe_only_weight', 'shortest_only_weight', BALANCED_WEIGHT):
+            value = data.get(weight)
+            if value is None or not np.isfinite(value) or value < 0:
+                raise ValueError(f"edge ({u}, {v}) has an invalid {weight}: {value}")
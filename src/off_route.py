@@ -0,0 +1,158 @@
+# Live off-route detection for running sessions.
+# Every route gets a precomputed segment index and a spatial grid over its polyline, and every
+# runner keeps the last segment they were matched to. A new fix is first checked against the
+# next few segments after that one, and only falls back to the grid when the runner is not there.
+
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+# A fix farther than this from the route is off the route
+OFF_ROUTE_THRESHOLD_M = 40.0
+# Consecutive off-route fixes needed before the runner is reported as off the route
+OFF_ROUTE_CONFIRM_FIXES = 3
+# Segments searched around the last matched one before using the grid
+SEARCH_BEHIND_SEGMENTS = 2
+SEARCH_AHEAD_SEGMENTS = 20
+# Side of the grid cells, in meters
+GRID_CELL_M = 100.0
+# Number of route indexes kept in memory
+ROUTE_INDEX_CACHE_SIZE = 512
+
+_route_indexes = OrderedDict()
+_runners = {}
+_lock = threading.Lock()
+
+
+def _project(lat, lon, lat0):
+    x = EARTH_RADIUS_M * np.radians(lon) * math.cos(math.radians(lat0))
+    y = EARTH_RADIUS_M * np.radians(lat)
+    return np.column_stack((x, y))
+
+
+def build_route_index(route):
+    """
+    Precomputes the segments of a route (its street geometry if present, else its waypoints)
+    in local meters, and a grid mapping each cell to the segments passing within
+    OFF_ROUTE_THRESHOLD_M of it.
+    """
+    line = np.asarray(route.get('geometry') or route['waypoints'], dtype=np.float64)
+    lat0 = float(line[:, 0].mean())
+    points = _project(line[:, 0], line[:, 1], lat0)
+    if len(points) == 1:
+        points = np.vstack((points, points))
+
+    a, b = points[:-1], points[1:]
+    lo = np.floor((np.minimum(a, b) - OFF_ROUTE_THRESHOLD_M) / GRID_CELL_M).astype(np.int64)
+    hi = np.floor((np.maximum(a, b) + OFF_ROUTE_THRESHOLD_M) / GRID_CELL_M).astype(np.int64)
+
+    grid = {}
+    for k in range(len(a)):
+        for cx in range(lo[k, 0], hi[k, 0] + 1):
+            for cy in range(lo[k, 1], hi[k, 1] + 1):
+                grid.setdefault((cx, cy), []).append(k)
+
+    return {
+        "lat0": lat0,
+        "a": a,
+        "ab": b - a,
+        "len2": np.maximum(np.einsum('ij,ij->i', b - a, b - a), 1e-12),
+        "grid": {cell: np.array(segments, dtype=np.int64) for cell, segments in grid.items()}
+    }
+
+
+def get_route_index(route_id, route):
+    """Returns the cached index of a route, building it on first use."""
+    with _lock:
+        index = _route_indexes.get(route_id)
+        if index is not None:
+            _route_indexes.move_to_end(route_id)
+            return index
+
+    index = build_route_index(route)
+    with _lock:
+        _route_indexes[route_id] = index
+        while len(_route_indexes) > ROUTE_INDEX_CACHE_SIZE:
+            _route_indexes.popitem(last=False)
+    return index
+
+
+def _nearest(index, p, segments):
+    """Returns (segment, distance) of the closest of the given segments to point p."""
+    a, ab = index['a'][segments], index['ab'][segments]
+    t = np.clip(np.einsum('ij,ij->i', p - a, ab) / index['len2'][segments], 0, 1)
+    dist = np.hypot(*(p - (a + t[:, None] * ab)).T)
+    k = int(np.argmin(dist))
+    return int(segments[k]), float(dist[k])
+
+
+def check_fix(index, state, lat, lon):
+    """
+    Checks one fix against a route and updates the runner state in place.
+    state holds the last matched segment and the count of consecutive off-route fixes.
+    Returns the distance from the route in meters (None if no route segment is near).
+    """
+    p = _project(np.array([lat]), np.array([lon]), index['lat0'])[0]
+    n_segments = len(index['a'])
+
+    # Amortized O(1): the runner is usually on one of the next few segments
+    last = state['segment']
+    window = np.arange(max(last - SEARCH_BEHIND_SEGMENTS, 0), min(last + SEARCH_AHEAD_SEGMENTS, n_segments))
+    segment, dist = _nearest(index, p, window)
+
+    if dist > OFF_ROUTE_THRESHOLD_M:
+        # Rejoined somewhere else, or really off the route: look in the fix's grid cell
+        cell = tuple(np.floor(p / GRID_CELL_M).astype(np.int64))
+        nearby = index['grid'].get(cell)
+        if nearby is None:
+            dist = None
+        else:
+            grid_segment, grid_dist = _nearest(index, p, nearby)
+            if grid_dist < dist:
+                segment, dist = grid_segment, grid_dist
+
+    if dist is not None and dist <= OFF_ROUTE_THRESHOLD_M:
+        state['segment'] = segment
+        state['off_count'] = 0
+    else:
+        state['off_count'] += 1
+    state['off_route'] = state['off_count'] >= OFF_ROUTE_CONFIRM_FIXES
+    state['distance_m'] = round(dist, 1) if dist is not None else None
+    return dist
+
+
+def check_fixes(session_id, route_id, route, fixes):
+    """
+    Checks a batch of (timestamp, lat, lon) fixes of a session against its route.
+    Returns the runner's status after the last fix.
+    """
+    index = get_route_index(route_id, route)
+    with _lock:
+        state = _runners.setdefault(session_id, {"segment": 0, "off_count": 0, "off_route": False,
+                                                 "distance_m": 0.0})
+    # Only this session's own fix batches touch its state
+    for _, lat, lon in fixes:
+        check_fix(index, state, lat, lon)
+    return route_status(state)
+
+
+def route_status(state):
+    """Returns the public part of a runner state."""
+    return {"off_route": state['off_route'], "distance_from_route_m": state['distance_m']}
+
+
+def get_status(session_id):
+    """Returns the latest off-route status of a session, or None if it has no checked fixes."""
+    with _lock:
+        state = _runners.get(session_id)
+        return route_status(state) if state else None
+
+
+def forget_session(session_id):
+    """Drops the state of a session that has finished."""
+    with _lock:
+        _runners.pop(session_id, None)
@@ -1,24 +1,51 @@
-import pandas as pd
+import numpy as np
 import networkx as nx
 import os
 import random
-import math
+import threading
+from collections import OrderedDict
+from scipy.spatial import cKDTree
+from route_encoding import encode_route
+from geometry import load_edge_geometry, path_geometry, simplify_line
+from data_store import read_table
+from graph_builder import load_graph
+from graph_contraction import contract_graph, contracted_tree, refresh_chains
+import safety_pipeline
 
 # Define constants for pathfinding weights
 SAFE_WEIGHT = 'safety_cost'
 SHORTEST_WEIGHT = 'length'
 BALANCED_WEIGHT = 'hybrid_weight'
 
+# Number of shortest-path trees kept per graph for reuse across requests
+PATH_TREE_CACHE_SIZE = 64
+
+# Length of the stretch used to find the least safe part of a route
+WORST_STRETCH_M = 500
+
+# Neighbouring time slots further apart than this (hours) are not interpolated
+SLOT_MAX_GAP_H = 4
+# Interpolation fractions are rounded to 1 / SLOT_BLEND_STEPS, so blended profiles can be cached
+SLOT_BLEND_STEPS = 4
+
 # Load the graph and add safety scores
-def create_pathfinding_model(graphml_file, nodes_csv_file):
+def create_pathfinding_model(graphml_file, nodes_csv_file, edges_csv_file=None, facility_csv_file=None,
+                             floating_pop=None, edge_weights_file=None):
     """
     Load graph and node data, and add safety scores to the graph.
+    The graph may be a graphml file or an array graph built by graph_builder (.npz), whose
+    own street geometry is used when no edges table is given. The node and edge tables may be CSV or their Parquet conversions (see data_store).
+    If edges_csv_file is given, the street geometry of each edge is loaded as well.
+    If facility_csv_file and floating_pop (slot CSV directory or population raster) are
+    given, a safety score per time slot is precomputed too (see build_slot_safety).
+    If edge_weights_file (the pipeline's edge weight table) is given, edges take their
+    precomputed edge-level weights from it (see load_edge_costs).
     Returns a graph with safety scores as node attributes.
     """
     try:
         # Load the graph and node data
-        G = nx.read_graphml(graphml_file)
-        df_nodes = pd.read_csv(nodes_csv_file)
+        G = load_graph(graphml_file) if graphml_file.endswith('.npz') else nx.read_graphml(graphml_file)
+        df_nodes = read_table(nodes_csv_file)
 
         # Normalize the safety score to a 100-point scale
         max_safety_score = df_nodes['safety_score'].max()
@@ -40,24 +67,27 @@ def create_pathfinding_model(graphml_file, nodes_csv_file):
             else:
                 # Assign a default safety score for nodes not in the CSV
                 G.nodes[node_id]['safety_score'] = 0
-                G.nodes[node_id]['lat'] = None
-                G.nodes[node_id]['lon'] = None
+                G.nodes[node_id]['lat'] = data.get('y')
+                G.nodes[node_id]['lon'] = data.get('x')
 
         # Add weights to edges
         for u, v, data in G.edges(data=True):
-            v_safety_score = G.nodes[v]['safety_score']
-
-            # --- WEIGHT CALCULATION ---
-            # Safe Path Weight: A very aggressive penalty for lower scores
-            # Using 1 / (score + small_epsilon) to heavily favor high-score nodes
-            data['safe_only_weight'] = 1 / (v_safety_score + 1e-6)
-
-            # Shortest Path Weight: Purely based on length
-            data['shortest_only_weight'] = data.get('length', 1)
-
-            # Balanced Path Weight:
-            # 안전 점수(safe_only_weight)와 길이를 1:9 비율로 섞어 안전 점수가 낮도록 유도
-            data[BALANCED_WEIGHT] = (data['safe_only_weight'] * 0.1) + (data['shortest_only_weight'] * 0.9)
+            set_edge_weights(data, G.nodes[v]['safety_score'])
+        if edge_weights_file:
+            load_edge_costs(G, edge_weights_file)
+
+        build_node_index(G)
+        build_graph_arrays(G)
+        # Searches run on the graph with its degree-2 chains contracted (see graph_contraction)
+        G.graph['contraction'] = None if G.is_directed() else contract_graph(G)
+        G.graph['edge_geometry'] = load_edge_geometry(edges_csv_file) if edges_csv_file \
+            else G.graph.get('edge_geometry')
+        G.graph['slot_safety'] = build_slot_safety(G, facility_csv_file, floating_pop) \
+            if facility_csv_file and floating_pop else None
+        G.graph['max_safety_score'] = float(max_safety_score)
+        G.graph['weights_version'] = 0
+        G.graph['path_trees'] = OrderedDict()
+        G.graph['path_trees_lock'] = threading.Lock()
 
     except FileNotFoundError as e:
         print(f"Error: File not found - {e}")
@@ -68,45 +98,455 @@ def create_pathfinding_model(graphml_file, nodes_csv_file):
 
     return G
 
+def set_edge_weights(data, v_safety_score):
+    """
+    Sets the search weights of an edge from the safety score of its target node.
+    """
+    # --- WEIGHT CALCULATION ---
+    # Safe Path Weight: A very aggressive penalty for lower scores
+    # Using 1 / (score + small_epsilon) to heavily favor high-score nodes
+    data['safe_only_weight'] = 1 / (v_safety_score + 1e-6)
+
+    # Shortest Path Weight: Purely based on length
+    data['shortest_only_weight'] = data.get('length', 1)
+
+    # Balanced Path Weight:
+    # 안전 점수(safe_only_weight)와 길이를 1:9 비율로 섞어 안전 점수가 낮도록 유도
+    data[BALANCED_WEIGHT] = (data['safe_only_weight'] * 0.1) + (data['shortest_only_weight'] * 0.9)
+
+def load_edge_costs(G, edge_weights_file):
+    """
+    Sets the search weights of the edges from the edge-level safety precomputed by
+    safety_pipeline (sampled along each edge's geometry), instead of the target node's score.
+    The edges keep it as 'edge_safety'. Edges missing from the table, or all edges when the
+    table predates edge-level safety, keep their target-node weights.
+    Returns the number of edges updated.
+    """
+    weights = read_table(edge_weights_file, dtype={'u': str, 'v': str})
+    if 'edge_safety' not in weights.columns:
+        return 0
+    # Of parallel edges, the shortest is the one in the graph
+    weights = weights.sort_values('length', kind='stable').drop_duplicates(['u', 'v'])
+
+    updated = 0
+    for u, v, safety in zip(weights['u'], weights['v'], weights['edge_safety'].to_numpy(dtype=np.float64)):
+        if not np.isnan(safety) and G.has_edge(u, v):
+            data = G[u][v]
+            set_edge_weights(data, float(safety))
+            data['edge_safety'] = float(safety)
+            updated += 1
+    return updated
+
+def apply_safety_delta(G, delta):
+    """
+    Applies a safety delta written by safety_pipeline (incremental re-scoring) to a
+    loaded model: node safety scores, the weights of the edges leading to changed nodes,
+    the safety arrays and the time-slot matrix. New arrays are built first and swapped in
+    with single assignments, and cached shortest-path trees are dropped by bumping the
+    weights version they are keyed by. Edge attributes are patched in place, so a search
+    already running may see part of the change; its tree is stored under the old version
+    and never reused. Edges with precomputed edge-level safety (see load_edge_costs) take
+    their new 'edge_safety' from the delta's 'edges' list instead of the node scores.
+    Raises ValueError on a malformed delta.
+    Returns the number of nodes and edges updated.
+    """
+    nodes = delta.get('nodes') if isinstance(delta, dict) else None
+    max_safety_score = delta.get('max_safety_score') if isinstance(delta, dict) else None
+    if not isinstance(nodes, dict) or not isinstance(max_safety_score, (int, float)) or max_safety_score <= 0:
+        raise ValueError("A safety delta needs a 'nodes' object and a positive 'max_safety_score'")
+
+    arrays = G.graph.get('arrays') or build_graph_arrays(G)
+    node_pos = arrays['node_pos']
+    try:
+        updates = {node_pos[str(node_id)]: (float(record['safety_score']), float(record.get('facility_score', 0)))
+                   for node_id, record in nodes.items() if str(node_id) in node_pos}
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Every delta node needs a numeric 'safety_score'")
+    try:
+        edge_updates = [(str(u), str(v), float(edge_safety)) for u, v, edge_safety in delta.get('edges', [])]
+    except (TypeError, ValueError):
+        raise ValueError("Every delta edge needs to be [u, v, edge_safety]")
+
+    # Raw scores on the current scale, patched, then rescaled to the new maximum
+    raw = arrays['safety'] * G.graph.get('max_safety_score', 100) / 100
+    positions = np.fromiter(updates, dtype=np.int64, count=len(updates))
+    raw[positions] = [updates[i][0] for i in positions]
+    safety = raw / max_safety_score * 100
+    changed = np.flatnonzero(~np.isclose(safety, arrays['safety'], rtol=0, atol=1e-9))
+
+    slot_safety = G.graph.get('slot_safety')
+    if slot_safety is not None and len(positions):
+        facility = slot_safety['facility'].copy()
+        facility[positions] = [updates[i][1] for i in positions]
+        slot_safety = dict(slot_safety, facility=facility, profiles={},
+                           matrix=slot_matrix(facility, slot_safety['population'], slot_safety['known']))
+
+    lock = G.graph.setdefault('path_trees_lock', threading.Lock())
+    with lock:
+        node_ids = arrays['node_ids']
+        changed_ids = {node_ids[i] for i in changed}
+        for node_id in changed_ids:
+            G.nodes[node_id]['safety_score'] = float(safety[node_pos[node_id]])
+
+        updated_edges = set()
+        for u, v, data in G.edges(changed_ids, data=True) if changed_ids else ():
+            if 'edge_safety' in data:
+                continue
+            # Weights follow the orientation the model was built with (see create_pathfinding_model)
+            target = v if G.is_directed() or node_pos[v] > node_pos[u] else u
+            set_edge_weights(data, G.nodes[target]['safety_score'])
+            updated_edges.add((u, v))
+        # Edge-level safety is already on the delta's 100-point scale; applied in order as on load
+        edge_nodes = set()
+        for u, v, edge_safety in edge_updates:
+            if G.has_edge(u, v) and 'edge_safety' in G[u][v]:
+                data = G[u][v]
+                set_edge_weights(data, edge_safety)
+                data['edge_safety'] = edge_safety
+                updated_edges.add((u, v) if G.is_directed() or node_pos[v] > node_pos[u] else (v, u))
+                edge_nodes.update((u, v))
+        refresh_chains(G, changed_ids | edge_nodes)
+
+        G.graph['arrays'] = dict(arrays, safety=safety)
+        G.graph['slot_safety'] = slot_safety
+        G.graph['max_safety_score'] = float(max_safety_score)
+        G.graph['weights_version'] = G.graph.get('weights_version', 0) + 1
+        G.graph['path_trees'].clear()
+
+    return {"nodes_updated": len(changed), "edges_updated": len(updated_edges),
+            "weights_version": G.graph['weights_version']}
+
+def build_node_index(G):
+    """
+    Builds a KD-tree over the (lat, lon) coordinates of the graph nodes.
+    The index is stored on the graph so start points can be snapped in bulk.
+    """
+    node_ids = [node_id for node_id, data in G.nodes(data=True)
+                if data.get('lat') is not None and data.get('lon') is not None]
+    coords = [(G.nodes[node_id]['lat'], G.nodes[node_id]['lon']) for node_id in node_ids]
+    G.graph['node_index'] = (cKDTree(coords), node_ids) if coords else None
+    return G.graph['node_index']
+
+def build_graph_arrays(G):
+    """
+    Builds integer-indexed numpy arrays of node coordinates, safety scores and
+    edge lengths, so route statistics can be computed with array gathers.
+    Edges are looked up by the sorted key (u_index * n_nodes + v_index).
+    The arrays are stored on the graph as G.graph['arrays'].
+    """
+    node_ids = list(G.nodes)
+    node_pos = {node_id: i for i, node_id in enumerate(node_ids)}
+    n_nodes = len(node_ids)
+
+    def node_values(attr):
+        return np.array([np.nan if G.nodes[n].get(attr) is None else G.nodes[n][attr] for n in node_ids],
+                        dtype=np.float64)
+
+    edges = [(node_pos[u], node_pos[v], data.get('length', 1)) for u, v, data in G.edges(data=True)]
+    edge_u = np.array([e[0] for e in edges], dtype=np.int64)
+    edge_v = np.array([e[1] for e in edges], dtype=np.int64)
+    edge_length = np.array([e[2] for e in edges], dtype=np.float64)
+    if not G.is_directed():
+        edge_u, edge_v = np.concatenate([edge_u, edge_v]), np.concatenate([edge_v, edge_u])
+        edge_length = np.concatenate([edge_length, edge_length])
+
+    edge_keys = edge_u * n_nodes + edge_v
+    order = np.argsort(edge_keys, kind='stable')
+
+    G.graph['arrays'] = {
+        "node_ids": node_ids,
+        "node_pos": node_pos,
+        "lat": node_values('lat'),
+        "lon": node_values('lon'),
+        "safety": np.nan_to_num(node_values('safety_score')),
+        "edge_keys": edge_keys[order],
+        "edge_length": edge_length[order]
+    }
+    return G.graph['arrays']
+
+def build_slot_safety(G, facility_csv_file, floating_pop):
+    """
+    Precomputes the safety score of every node for each floating-population time slot
+    with safety_pipeline, rescaled to 100 per slot like the static score.
+    floating_pop is a directory of slot CSVs or a population raster file.
+    Returns {"slots", "centers" (hours), "facility" and "population" (the two parts of
+    the raw scores), "known", "matrix" (nodes x slots, node order of G.graph['arrays']),
+    "profiles"} or None if there are no slot files.
+    """
+    if not safety_pipeline.population_slots(floating_pop):
+        return None
+
+    arrays = G.graph.get('arrays') or build_graph_arrays(G)
+    nodes = safety_pipeline.load_facility_nodes(facility_csv_file)
+    nodes.index = nodes['osmid'].astype(str)
+    nodes = nodes.reindex(arrays['node_ids'])
+    known = nodes['osmid'].notna().to_numpy()
+    nodes[safety_pipeline.FACILITY_COLUMNS] = nodes[safety_pipeline.FACILITY_COLUMNS].fillna(0)
+
+    slots, population = safety_pipeline.slot_population(nodes, floating_pop)
+    facility = safety_pipeline.facility_scores(safety_pipeline.facility_features(nodes))
+    population = population * safety_pipeline.SAFETY_FEATURE_WEIGHTS['population']
+
+    return {
+        "slots": slots,
+        "centers": np.array([sum(safety_pipeline.slot_hours(slot)) / 2 for slot in slots]),
+        "facility": facility,
+        "population": population,
+        "known": known,
+        "matrix": slot_matrix(facility, population, known),
+        "profiles": {}
+    }
+
+def slot_matrix(facility, population, known):
+    """
+    Combines the facility part of every node's score with its per-slot population part
+    and rescales each slot to 100. Nodes without data score 0.
+    """
+    scores = np.where(known[:, None], facility[:, None] + population, 0)
+    peaks = scores.max(axis=0)
+    return np.divide(scores, peaks, out=np.zeros_like(scores), where=peaks > 0) * 100
+
+def slot_safety_profile(G, hour):
+    """
+    Returns the node safety profile for a start time given in hours (0-24):
+    the slot covering it, or a blend of the two neighbouring slots when the time
+    falls between them. Returns None when no slot is close enough, in which case
+    the static safety scores apply.
+    A profile is {"key", "slots": {slot: share}, "safety", "safe_weight"}; profiles are
+    built from the precomputed slot matrix once and then reused.
+    """
+    slot_safety = G.graph.get('slot_safety')
+    if slot_safety is None or hour is None:
+        return None
+
+    slots, centers = slot_safety['slots'], slot_safety['centers']
+    hour = hour % 24
+    # Circular distance from every slot center forward to the start time
+    after = (hour - centers) % 24
+    prev = int(np.argmin(after))
+    before = (centers - hour) % 24
+    nxt = int(np.argmin(before))
+    gap = after[prev] + before[nxt]
+
+    if prev == nxt or after[prev] == 0:
+        shares = {slots[prev]: 1.0}
+    elif gap <= SLOT_MAX_GAP_H:
+        fraction = round(after[prev] / gap * SLOT_BLEND_STEPS) / SLOT_BLEND_STEPS
+        shares = {slots[prev]: 1 - fraction, slots[nxt]: fraction}
+    else:
+        # Only a slot whose own window covers the start time applies
+        windows = {j: safety_pipeline.slot_hours(slots[j]) for j in (prev, nxt)}
+        covering = [j for j, (start, end) in windows.items() if start <= hour < end or start <= hour + 24 < end]
+        if not covering:
+            return None
+        shares = {slots[covering[0]]: 1.0}
+
+    shares = {slot: share for slot, share in shares.items() if share > 0}
+    key = tuple(sorted(shares.items()))
+    profiles = slot_safety['profiles']
+    profile = profiles.get(key)
+    if profile is None:
+        safety = sum(slot_safety['matrix'][:, slots.index(slot)] * share for slot, share in shares.items())
+        profile = profiles.setdefault(key, {
+            "key": key,
+            "slots": shares,
+            "safety": safety,
+            "safe_weight": 1 / (safety + 1e-6)
+        })
+    return profile
+
+def edge_weight(G, weight, profile=None):
+    """
+    Returns the search weight function for an edge attribute.
+    With a time-slot safety profile, the safety-based weights are computed from the
+    profile's node safety instead of the static edge attributes, by the same formulas.
+    """
+    if profile is None or weight == 'shortest_only_weight':
+        return lambda u, v, data: data.get(weight, float('inf'))
+
+    node_pos = G.graph['arrays']['node_pos']
+    safe_weight = profile['safe_weight']
+    if weight == BALANCED_WEIGHT:
+        return lambda u, v, data: safe_weight[node_pos[v]] * 0.1 + data.get('length', 1) * 0.9
+    return lambda u, v, data: safe_weight[node_pos[v]]
+
+def path_indices(arrays, path):
+    """
+    Converts a path of node IDs to an array of node indices.
+    """
+    node_pos = arrays['node_pos']
+    return np.fromiter((node_pos[node_id] for node_id in path), dtype=np.int64, count=len(path))
+
+def path_edge_lengths(arrays, indices):
+    """
+    Returns the length in meters of every hop of a path given as node indices.
+    """
+    keys = indices[:-1] * len(arrays['node_ids']) + indices[1:]
+    return arrays['edge_length'][np.searchsorted(arrays['edge_keys'], keys)]
+
+def route_statistics(arrays, indices, safety=None):
+    """
+    Computes route statistics from a path of node indices:
+    total distance, mean and minimum safety, the least safe stretch of
+    WORST_STRETCH_M meters, and the position of every full kilometer.
+    safety defaults to the static node safety scores.
+    """
+    if safety is None:
+        safety = arrays['safety']
+
+    hop_lengths = path_edge_lengths(arrays, indices)
+    cum_dist = np.concatenate(([0.0], np.cumsum(hop_lengths)))
+    total_m = cum_dist[-1]
+    node_safety = safety[indices]
+
+    # Least safe stretch: for every starting node, the mean safety of the nodes within the window
+    safety_sums = np.concatenate(([0.0], np.cumsum(node_safety)))
+    window_end = np.searchsorted(cum_dist, cum_dist + WORST_STRETCH_M, side='right')
+    window_end = np.minimum(window_end, len(indices))
+    starts = np.arange(len(indices))
+    window_mean = (safety_sums[window_end] - safety_sums[starts]) / (window_end - starts)
+    full = cum_dist + WORST_STRETCH_M <= total_m
+    candidates = np.flatnonzero(full) if full.any() else starts[:1]
+    worst = candidates[np.argmin(window_mean[candidates])]
+    worst_end = window_end[worst] - 1
+
+    # Kilometer markers, interpolated along the hop that crosses each full kilometer
+    marks = np.arange(1000.0, total_m, 1000.0)
+    hop = np.searchsorted(cum_dist, marks, side='right') - 1
+    frac = (marks - cum_dist[hop]) / hop_lengths[hop] if len(marks) else marks
+    lat, lon = arrays['lat'][indices], arrays['lon'][indices]
+    marker_lat = lat[hop] + (lat[hop + 1] - lat[hop]) * frac
+    marker_lon = lon[hop] + (lon[hop + 1] - lon[hop]) * frac
+
+    return {
+        "distance_m": float(total_m),
+        "mean_safety": float(node_safety.mean()) if len(node_safety) else 0.0,
+        "min_safety": float(node_safety.min()) if len(node_safety) else 0.0,
+        "worst_stretch": {
+            "start_km": round(float(cum_dist[worst]) / 1000, 2),
+            "end_km": round(float(cum_dist[worst_end]) / 1000, 2),
+            "safety_score": round(float(window_mean[worst]), 2)
+        },
+        "km_markers": np.column_stack((marker_lat, marker_lon)).tolist()
+    }
+
+def scores_version(G):
+    """
+    Identifies the safety data route scores computed on G come from: the model version
+    (bumped by reloads) and the weights version (bumped by safety deltas).
+    """
+    return f"{G.graph.get('model_version', 0)}.{G.graph.get('weights_version', 0)}"
+
+def route_scores(G, waypoints):
+    """
+    Recomputes the all-day safety_score, min_safety_score and worst_stretch of a stored
+    route from G's current safety scores. The waypoints are matched back to the graph nodes
+    they were taken from; returns None when one is not a node of G (the graph changed).
+    """
+    node_index = G.graph.get('node_index') or build_node_index(G)
+    if node_index is None or not waypoints:
+        return None
+    tree, node_ids = node_index
+    distances, nearest = tree.query(np.asarray(waypoints, dtype=np.float64))
+    if distances.max() > 1e-9:
+        return None
+
+    arrays = G.graph.get('arrays') or build_graph_arrays(G)
+    stats = route_statistics(arrays, path_indices(arrays, [node_ids[i] for i in nearest]))
+    return {
+        "safety_score": round(stats['mean_safety'], 2),
+        "min_safety_score": round(stats['min_safety'], 2),
+        "worst_stretch": stats['worst_stretch']
+    }
+
+def find_closest_nodes(G, points):
+    """
+    Finds the closest graph node for each (lat, lon) pair in a single KD-tree query.
+    Returns a list of node IDs in the same order as the input points.
+    """
+    if not points:
+        return []
+
+    node_index = G.graph.get('node_index') or build_node_index(G)
+    if node_index is None:
+        return [None] * len(points)
+
+    tree, node_ids = node_index
+    _, indices = tree.query(points)
+    return [node_ids[i] for i in indices]
+
 def find_closest_node(G, lat, lon):
     """
     Finds the node in the graph closest to the given coordinates.
     """
-    closest_node = None
-    min_dist = float('inf')
+    return find_closest_nodes(G, [(lat, lon)])[0]
+
+def shortest_path_tree(G, source, weight, profile=None):
+    """
+    Returns the predecessor map of the shortest-path tree rooted at source.
+    Trees are cached on the graph, keyed by (weights version, source, weight, safety profile),
+    so requests that share a start node and time slot reuse the same search instead of repeating it.
+    """
+    cache = G.graph.setdefault('path_trees', OrderedDict())
+    lock = G.graph.setdefault('path_trees_lock', threading.Lock())
+    uses_safety = profile is not None and weight != 'shortest_only_weight'
+    key = (G.graph.get('weights_version', 0), source, weight, profile['key'] if uses_safety else None)
+
+    with lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+    if G.graph.get('contraction') is not None:
+        # Static weights are the same both ways, so the stored chain costs can be used
+        tree = contracted_tree(G, source, edge_weight(G, weight, profile), None if uses_safety else weight)
+    else:
+        pred, _ = nx.dijkstra_predecessor_and_distance(G, source, weight=edge_weight(G, weight, profile))
+        tree = {node: preds[0] for node, preds in pred.items() if preds}
+
+    with lock:
+        cache[key] = tree
+        cache.move_to_end(key)
+        while len(cache) > PATH_TREE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return tree
+
+def tree_path(tree, source, target):
+    """
+    Walks a predecessor map back from target to source.
+    Returns the path as a list of node IDs, or None if target is unreachable.
+    """
+    if target == source:
+        return [source]
+    if target not in tree:
+        return None
 
-    for node_id, data in G.nodes(data=True):
-        if 'lat' in data and 'lon' in data:
-            dist = math.sqrt((data['lat'] - lat)**2 + (data['lon'] - lon)**2)
-            if dist < min_dist:
-                min_dist = dist
-                closest_node = node_id
-    return closest_node
+    path = [target]
+    while path[-1] != source:
+        path.append(tree[path[-1]])
+    path.reverse()
+    return path
 
-def find_paths_circular(G, start_node_id, desired_distance_km):
+def find_paths_circular(G, start_node_id, desired_distance_km, geometry=False, tolerance_m=0, profile=None,
+                        street_geometry=False):
     """
     Finds three distinct circular paths (safe, shortest, balanced) of a given distance.
     Returns a dictionary with formatted path data.
+    geometry, tolerance_m and street_geometry are passed on to format_route_data.
+    profile is a time-slot safety profile (see slot_safety_profile) used instead of
+    the static safety scores, for both the search and the reported scores.
     """
     if start_node_id not in G:
         raise ValueError("Start node not found in the graph.")
 
     desired_distance_m = desired_distance_km * 1000
+    arrays = G.graph.get('arrays') or build_graph_arrays(G)
 
-    # Define weight functions for A* algorithm
-    def safe_weight(u, v, data):
-        return data.get('safe_only_weight', float('inf'))
-
-    def shortest_weight(u, v, data):
-        return data.get('shortest_only_weight', float('inf'))
-
-    def balanced_weight(u, v, data):
-        return data.get(BALANCED_WEIGHT, float('inf'))
-
+    # Edge attributes used as search weights for each path type
     weights = {
-        'safe': safe_weight,
-        'shortest': shortest_weight,
-        'balanced': balanced_weight
+        'safe': 'safe_only_weight',
+        'shortest': 'shortest_only_weight',
+        'balanced': BALANCED_WEIGHT
     }
 
     found_paths = {}
@@ -117,6 +557,10 @@ def find_paths_circular(G, start_node_id, desired_distance_km):
 
     # Find three paths
     for path_type in path_types:
+        weight = weights[path_type]
+        # One shortest-path tree from the start serves every candidate intermediate node
+        tree = shortest_path_tree(G, start_node_id, weight, profile)
+
         path = None
         attempts = 0
         while path is None and attempts < 10:
@@ -130,10 +574,16 @@ def find_paths_circular(G, start_node_id, desired_distance_km):
 
                 try:
                     # Find path from start to intermediate
-                    path1 = nx.astar_path(G, source=start_node_id, target=intermediate_node, weight=weights[path_type])
+                    path1 = tree_path(tree, start_node_id, intermediate_node)
+                    if path1 is None:
+                        continue
 
                     # Find path from intermediate back to start
-                    path2 = nx.astar_path(G, source=intermediate_node, target=start_node_id, weight=weights[path_type])
+                    if G.is_directed():
+                        path2 = nx.astar_path(G, source=intermediate_node, target=start_node_id,
+                                              weight=edge_weight(G, weight, profile))
+                    else:
+                        path2 = path1[::-1]
 
                     full_path = path1 + path2[1:]
 
@@ -142,7 +592,7 @@ def find_paths_circular(G, start_node_id, desired_distance_km):
                         continue
 
                     # Calculate total path length
-                    path_length_m = sum(G.get_edge_data(u, v)['length'] for u, v in zip(full_path[:-1], full_path[1:]))
+                    path_length_m = path_edge_lengths(arrays, path_indices(arrays, full_path)).sum()
 
                     # Check if the distance is within an acceptable range (e.g., +/- 15%)
                     if desired_distance_m * 0.85 <= path_length_m <= desired_distance_m * 1.15:
@@ -158,35 +608,54 @@ def find_paths_circular(G, start_node_id, desired_distance_km):
                 found_paths[path_type] = path
                 break
 
-    return format_route_data(G, found_paths)
+    return format_route_data(G, found_paths, geometry=geometry, tolerance_m=tolerance_m, profile=profile,
+                             street_geometry=street_geometry)
 
-def format_route_data(G, paths):
+def format_route_data(G, paths, encoding=None, geometry=False, tolerance_m=0, profile=None, street_geometry=False):
     """
     Formats the found paths into a list of dictionaries suitable for the API response.
+    If encoding is given ('polyline' or 'e6'), waypoints are returned in that compact form.
+    If geometry is True, each route also carries its full street geometry, simplified
+    with Douglas-Peucker to tolerance_m meters.
+    With a time-slot safety profile, safety scores are reported for that time, the
+    route lists the slots used in 'safety_slots' and keeps the all-day scores in 'all_day_safety'.
+    If street_geometry is True, the unsimplified street geometry is added as 'street_geometry'.
     """
     routes = []
+    arrays = G.graph.get('arrays') or build_graph_arrays(G)
 
     for path_type, path in paths.items():
         if path:
-            distance_m = sum(G.get_edge_data(u, v)['length'] for u, v in zip(path[:-1], path[1:]))
-            distance_km = round(distance_m / 1000, 2)
-
-            # Calculate average safety score for the path
-            safety_scores = [G.nodes[node]['safety_score'] for node in path if 'safety_score' in G.nodes[node]]
-            avg_safety_score = round(sum(safety_scores) / len(safety_scores), 2) if safety_scores else 0
-
-            # Extract waypoints
-            waypoints = []
-            for node_id in path:
-                node_data = G.nodes[node_id]
-                waypoints.append([node_data['lat'], node_data['lon']])
+            indices = path_indices(arrays, path)
+            stats = route_statistics(arrays, indices, profile['safety'] if profile else None)
 
-            routes.append({
+            route = {
                 "type": path_type,
-                "distance_km": distance_km,
-                "safety_score": avg_safety_score,
+                "distance_km": round(stats['distance_m'] / 1000, 2),
+                "safety_score": round(stats['mean_safety'], 2),
+                "min_safety_score": round(stats['min_safety'], 2),
+                "worst_stretch": stats['worst_stretch'],
+                "km_markers": stats['km_markers'],
                 "estimated_time_min": 0, # To be calculated in app.py
-                "waypoints": waypoints
-            })
+                "waypoints": np.column_stack((arrays['lat'][indices], arrays['lon'][indices])).tolist()
+            }
+
+            if profile:
+                route["safety_slots"] = profile['slots']
+                all_day = route_statistics(arrays, indices)
+                route["all_day_safety"] = {
+                    "safety_score": round(all_day['mean_safety'], 2),
+                    "min_safety_score": round(all_day['min_safety'], 2),
+                    "worst_stretch": all_day['worst_stretch']
+                }
+
+            if geometry or street_geometry:
+                line = path_geometry(G, path, G.graph.get('edge_geometry'))
+                if geometry:
+                    route["geometry"] = simplify_line(line, tolerance_m).tolist()
+                if street_geometry:
+                    route["street_geometry"] = line.tolist()
+
+            routes.append(encode_route(route, encoding))
 
     return {"routes": routes}
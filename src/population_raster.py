@@ -0,0 +1,187 @@
+# Floating-population rasters.
+# The floating_pop/*.csv files are point grids on a slightly skewed lon/lat lattice, with a
+# different set of points per slot. They are converted once into aligned 2D rasters (one layer
+# per slot) sharing an affine transform, so node populations come from O(1) bilinear lookups.
+# The raster file is built here and not committed. Once it exists, the pipeline and the server
+# read population from it instead of the CSVs, so re-run safety_pipeline.py after building it.
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# All layers share one (2, 3) affine transform t from lattice (col, row) to coordinates:
+# lon = t[0] @ (col, row, 1), lat = t[1] @ (col, row, 1)
+
+
+def _lattice_steps(points):
+    """
+    Estimates the two lattice step vectors (column and row step, in lon/lat) from the
+    differences between every point and its nearest neighbours.
+    """
+    _, neighbours = cKDTree(points).query(points, k=5)
+    diffs = (points[neighbours[:, 1:]] - points[:, None, :]).reshape(-1, 2)
+    diffs = diffs[np.abs(diffs).max(axis=1) > 0]
+    # Orient every difference into the upper half plane of its dominant axis
+    diffs[diffs[:, 0] < -np.abs(diffs[:, 1])] *= -1
+    diffs[diffs[:, 1] < -np.abs(diffs[:, 0])] *= -1
+
+    along_lon = np.abs(diffs[:, 0]) >= np.abs(diffs[:, 1])
+    col_step = np.median(diffs[along_lon], axis=0)
+    row_step = np.median(diffs[~along_lon], axis=0)
+    return col_step, row_step
+
+
+def fit_transform(points):
+    """
+    Fits the affine transform of the lattice the (lon, lat) points lie on.
+    The origin is the lattice point of the lowest column and row, so every point
+    has non-negative indices. Returns the (2, 3) transform.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    col_step, row_step = _lattice_steps(points)
+    basis = np.column_stack((col_step, row_step))
+
+    # Integer lattice indices of every point, then a least-squares refit on all of them
+    indices = np.round(np.linalg.solve(basis, (points - points[0]).T).T)
+    indices -= indices.min(axis=0)
+    design = np.column_stack((indices, np.ones(len(indices))))
+    transform, _, _, _ = np.linalg.lstsq(design, points, rcond=None)
+    return transform.T
+
+
+def cell_indices(transform, lon, lat):
+    """Returns the fractional (col, row) lattice positions of lon/lat arrays."""
+    linear, origin = transform[:, :2], transform[:, 2]
+    offsets = np.column_stack((np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))) - origin
+    return np.linalg.solve(linear, offsets.T).T
+
+
+def rasterize(transform, lon, lat, values, shape=None):
+    """
+    Places point values on the lattice. Points falling on the same cell are summed
+    (the source grids repeat cells split between districts); cells without a point are NaN.
+    Returns a (rows, cols) float32 raster.
+    """
+    cols, rows = np.round(cell_indices(transform, lon, lat)).astype(np.int64).T
+    if shape is None:
+        shape = (int(rows.max()) + 1, int(cols.max()) + 1)
+    raster = np.full(shape, np.nan, dtype=np.float32)
+    flat = rows * shape[1] + cols
+    sums = np.bincount(flat, weights=values, minlength=shape[0] * shape[1])
+    present = np.bincount(flat, minlength=shape[0] * shape[1]) > 0
+    raster.reshape(-1)[present] = sums[present]
+    return raster
+
+
+def read_grid(csv_file):
+    """Reads a floating-population point grid as (lon, lat, population) arrays."""
+    grid = pd.read_csv(csv_file)
+    return grid['Lon'].to_numpy(), grid['Lat'].to_numpy(), grid['Populations'].to_numpy(dtype=np.float64)
+
+
+def build_rasters(slot_files):
+    """
+    Converts point grids ({slot: csv path}) to aligned rasters.
+    Returns {"slots": [...], "transform": (2, 3), "rasters": (slots, rows, cols)}.
+    """
+    grids = {slot: read_grid(csv_file) for slot, csv_file in slot_files.items()}
+    points = np.vstack([np.column_stack(grid[:2]) for grid in grids.values()])
+    transform = fit_transform(points)
+
+    cols, rows = np.round(cell_indices(transform, points[:, 0], points[:, 1])).astype(np.int64).T
+    shape = (int(rows.max()) + 1, int(cols.max()) + 1)
+    rasters = np.stack([rasterize(transform, *grid, shape=shape) for grid in grids.values()])
+    return {"slots": list(grids), "transform": transform, "rasters": rasters}
+
+
+def save_rasters(path, data):
+    """Writes rasters to a compressed .npz, replacing the file atomically."""
+    tmp_path = path + '.tmp.npz'
+    np.savez_compressed(tmp_path, slots=np.array(data['slots']), transform=data['transform'],
+                        rasters=data['rasters'])
+    os.replace(tmp_path, path)
+
+
+def load_rasters(path):
+    """Reads rasters written by save_rasters."""
+    with np.load(path) as npz:
+        return {"slots": npz['slots'].tolist(), "transform": npz['transform'], "rasters": npz['rasters']}
+
+
+def add_slot(data, slot, csv_file):
+    """
+    Adds (or replaces) one slot layer on the existing lattice. The rasters only grow
+    when the new grid reaches past their extent (a new region), by padding; existing
+    layers are never resampled. Returns the updated data.
+    """
+    lon, lat, population = read_grid(csv_file)
+    transform, rasters = data['transform'].copy(), data['rasters']
+    cols, rows = np.round(cell_indices(transform, lon, lat)).astype(np.int64).T
+
+    # Pad before the origin and after the far edge as needed, shifting the origin with it
+    pad_rows = (max(0, -int(rows.min())), max(0, int(rows.max()) + 1 - rasters.shape[1]))
+    pad_cols = (max(0, -int(cols.min())), max(0, int(cols.max()) + 1 - rasters.shape[2]))
+    if any(pad_rows) or any(pad_cols):
+        rasters = np.pad(rasters, ((0, 0), pad_rows, pad_cols), constant_values=np.nan)
+        transform[:, 2] -= transform[:, 0] * pad_cols[0] + transform[:, 1] * pad_rows[0]
+
+    layer = rasterize(transform, lon, lat, population, shape=rasters.shape[1:])
+    slots = list(data['slots'])
+    if slot in slots:
+        rasters = rasters.copy()
+        rasters[slots.index(slot)] = layer
+    else:
+        slots.append(slot)
+        rasters = np.concatenate((rasters, layer[None]))
+    return {"slots": slots, "transform": transform, "rasters": rasters}
+
+
+def bilinear(data, lat, lon):
+    """
+    Bilinearly interpolates every layer at the given coordinates.
+    Missing cells are left out and the remaining corner weights renormalized; points
+    with no valid corner get 0. Returns a (points, slots) array.
+    """
+    rasters = data['rasters']
+    n_slots, n_rows, n_cols = rasters.shape
+    pos = cell_indices(data['transform'], lon, lat)
+    col0 = np.clip(np.floor(pos[:, 0]).astype(np.int64), 0, n_cols - 2)
+    row0 = np.clip(np.floor(pos[:, 1]).astype(np.int64), 0, n_rows - 2)
+    fx = np.clip(pos[:, 0] - col0, 0, 1)
+    fy = np.clip(pos[:, 1] - row0, 0, 1)
+
+    total = np.zeros((len(pos), n_slots))
+    weight_sum = np.zeros((len(pos), n_slots))
+    for d_row, d_col, weight in ((0, 0, (1 - fx) * (1 - fy)), (0, 1, fx * (1 - fy)),
+                                 (1, 0, (1 - fx) * fy), (1, 1, fx * fy)):
+        values = rasters[:, row0 + d_row, col0 + d_col].T
+        valid = ~np.isnan(values)
+        total += np.where(valid, values, 0) * weight[:, None]
+        weight_sum += valid * weight[:, None]
+    return np.divide(total, weight_sum, out=np.zeros_like(total), where=weight_sum > 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert floating-population point grids to rasters.")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--out', default=None, help="Raster file (default: <data-dir>/floating_pop.npz)")
+    parser.add_argument('--add-slot', nargs=2, metavar=('SLOT', 'CSV'),
+                        help="Append one slot to an existing raster file instead of rebuilding it")
+    args = parser.parse_args()
+
+    out = args.out or os.path.join(args.data_dir, 'floating_pop.npz')
+    if args.add_slot:
+        data = add_slot(load_rasters(out), *args.add_slot)
+    else:
+        floating_pop_dir = os.path.join(args.data_dir, 'floating_pop')
+        data = build_rasters({os.path.splitext(name)[0]: os.path.join(floating_pop_dir, name)
+                              for name in sorted(os.listdir(floating_pop_dir)) if name.endswith('.csv')})
+    save_rasters(out, data)
+    print(f"{out}: slots {', '.join(data['slots'])}, raster {data['rasters'].shape[1]}x{data['rasters'].shape[2]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import numpy as np
+
+# Supported waypoint encodings for API responses
+#   polyline  Google encoded polyline string (1e-5 degree precision)
+#   e6        flat list of integer microdegrees, first point absolute, then deltas
+WAYPOINT_ENCODINGS = ('polyline', 'e6')
+
+# An int32 zigzag value never needs more than seven 5-bit chunks
+_MAX_CHUNKS = 7
+
+def _delta_ints(coords, factor):
+    """
+    Scales (lat, lon) pairs to integers and returns the row-wise deltas,
+    with the first row kept absolute.
+    """
+    values = np.rint(np.asarray(coords, dtype=np.float64).reshape(-1, 2) * factor).astype(np.int64)
+    return np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+
+def encode_polyline(coords, precision=5):
+    """
+    Encodes a sequence of (lat, lon) pairs with the Google polyline algorithm.
+    All points are encoded at once on the coordinate array instead of value by value.
+    """
+    if len(coords) == 0:
+        return ''
+
+    deltas = _delta_ints(coords, 10 ** precision).ravel()
+
+    # Zigzag-encode so negative deltas become small positive integers
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).astype(np.uint64)
+
+    # Split every value into 5-bit chunks, least significant first
+    shifts = np.arange(_MAX_CHUNKS, dtype=np.uint64) * np.uint64(5)
+    chunks = (zigzag[:, None] >> shifts) & np.uint64(0x1f)
+
+    # Number of chunks each value needs (at least one, even for zero)
+    lengths = np.maximum((zigzag[:, None] >> shifts > 0).sum(axis=1), 1)
+    positions = np.arange(_MAX_CHUNKS)
+    chunks[positions < (lengths - 1)[:, None]] |= np.uint64(0x20)
+
+    chars = (chunks[positions < lengths[:, None]] + np.uint64(63)).astype(np.uint8)
+    return chars.tobytes().decode('ascii')
+
+def decode_polyline(encoded, precision=5):
+    """
+    Decodes a Google encoded polyline string back into a list of [lat, lon] pairs.
+    """
+    data = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    if data.size == 0:
+        return []
+
+    # Each value ends at the first chunk without the continuation bit
+    ends = np.flatnonzero(data < 0x20)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    value_ids = np.repeat(np.arange(ends.size), ends - starts + 1)
+    shifts = 5 * (np.arange(data.size) - starts[value_ids])
+
+    zigzag = np.bincount(value_ids, weights=((data & 0x1f) << shifts)).astype(np.int64)
+    deltas = (zigzag >> 1) ^ -(zigzag & 1)
+    coords = np.cumsum(deltas.reshape(-1, 2), axis=0) / 10 ** precision
+    return coords.tolist()
+
+def encode_delta_e6(coords):
+    """
+    Encodes (lat, lon) pairs as a flat list of integer microdegrees:
+    the first point absolute, every following point as a delta from the previous one.
+    """
+    if len(coords) == 0:
+        return []
+    return _delta_ints(coords, 1e6).ravel().tolist()
+
+def encode_waypoints(waypoints, encoding):
+    """
+    Encodes a waypoint list with one of WAYPOINT_ENCODINGS.
+    Returns the waypoints unchanged when encoding is None.
+    """
+    if encoding is None:
+        return waypoints
+    if encoding == 'polyline':
+        return encode_polyline(waypoints)
+    if encoding == 'e6':
+        return encode_delta_e6(waypoints)
+    raise ValueError(f"Unsupported waypoint encoding: {encoding}")
+
+def encode_route(route, encoding):
+    """
+    Returns a copy of a formatted route with its waypoints (and geometry, if present) encoded.
+    The original route, which keeps plain coordinates, is not modified.
+    """
+    if encoding is None:
+        return route
+
+    encoded = dict(route)
+    encoded['waypoints'] = encode_waypoints(route['waypoints'], encoding)
+    if 'geometry' in route:
+        encoded['geometry'] = encode_waypoints(route['geometry'], encoding)
+    encoded['waypoints_encoding'] = encoding
+    return encoded
@@ -1,35 +1,188 @@
-# This file handles in-memory data management for the API.
-# In a real-world application, this data would be stored in a database (e.g., Firestore).
+# This file handles data management for the API: routes, favorites, running sessions and
+# crew route selections. Records are kept in a pluggable storage backend (see storage.py);
+# set RUN_STORE_BACKEND=sqlite to share them between workers and keep them across restarts.
 
 import uuid
 import datetime
+import hashlib
+import json
+from storage import create_backend
+from path_service import scores_version, route_scores
+import trace_ingest
+import off_route
+import live_hub
+from session_stats import compute_session_stats
 
-# In-memory storage for routes, favorites, and running sessions
-# In a real application, you would use a database for persistent storage.
-_STORE = {
-    "routes": {},
-    "favorites": {},
-    "sessions": {},
-    "selected_routes": {}
+# Recommended routes are transient until they are favorited or selected for a crew,
+# and sessions that stop receiving updates are dropped after a while
+ROUTE_TTL_S = 24 * 60 * 60
+SESSION_TTL_S = 12 * 60 * 60
+TRACE_TTL_S = 7 * 24 * 60 * 60
+
+COLLECTION_TTLS = {
+    "routes": ROUTE_TTL_S,
+    "route_scores": ROUTE_TTL_S,
+    "sessions": SESSION_TTL_S,
+    "trace_chunks": TRACE_TTL_S,
+    "trace_meta": TRACE_TTL_S
 }
 
-def store_routes(routes):
-    """Stores the generated routes in memory and returns them with a unique ID."""
+# Collections that are never expired or evicted
+PROTECTED_COLLECTIONS = ("favorites", "selected_routes", "route_crews")
+
+# Collections that expire but are never evicted to fit the memory budget: a trace loses
+# points if one of its chunks, or the metadata listing them, is dropped
+UNEVICTABLE_COLLECTIONS = ("trace_chunks", "trace_meta")
+
+# Collections whose records never change once written (routes are stored by content hash,
+# their scores for later safety data by route and scores version), so a worker may cache
+# them without seeing other workers' writes
+IMMUTABLE_COLLECTIONS = ("routes", "route_scores", "trace_chunks")
+
+# Route fields that depend only on the route itself. Only these are stored under the
+# content ID; pace, time estimates, time-slot scores and simplified geometry belong to one request
+ROUTE_CONTENT_FIELDS = ("type", "distance_km", "safety_score", "min_safety_score", "worst_stretch",
+                        "km_markers", "waypoints")
+
+# Route fields computed from the safety data, recomputed when it changes
+ROUTE_SCORE_FIELDS = ("safety_score", "min_safety_score", "worst_stretch")
+
+# How often the in-memory backend purges expired records in the background
+STORE_SWEEP_INTERVAL_S = 60
+
+_backend = create_backend(ttls=COLLECTION_TTLS, protected_collections=PROTECTED_COLLECTIONS,
+                          immutable_collections=IMMUTABLE_COLLECTIONS,
+                          unevictable_collections=UNEVICTABLE_COLLECTIONS)
+if hasattr(_backend, 'start_sweeper'):
+    _backend.start_sweeper(STORE_SWEEP_INTERVAL_S)
+trace_ingest.set_store(_backend)
+# Off-route state of a session goes when its idle trace buffer is released
+trace_ingest.on_release(off_route.forget_session)
+
+# Returns the served model, so stored route scores follow reloads and safety deltas
+_current_model = None
+
+def configure_store(backend):
+    """Replaces the storage backend, e.g. with a SQLite backend or one set up for tests."""
+    global _backend
+    _backend = backend
+    trace_ingest.set_store(backend)
+
+def configure_route_scoring(current_model):
+    """
+    Sets the function returning the served model (e.g. ModelRegistry.current). Routes read
+    afterwards carry the scores of that model's safety data (see get_route).
+    """
+    global _current_model
+    _current_model = current_model
+
+def _least_rotation(seq):
+    """Returns the start index of the lexicographically smallest rotation of seq (Booth's algorithm)."""
+    doubled = seq + seq
+    failure = [-1] * len(doubled)
+    k = 0
+    for j in range(1, len(doubled)):
+        item = doubled[j]
+        i = failure[j - k - 1]
+        while i != -1 and item != doubled[k + i + 1]:
+            if item < doubled[k + i + 1]:
+                k = j - i - 1
+            i = failure[i]
+        if item != doubled[k + i + 1]:
+            if item < doubled[k]:
+                k = j
+            failure[j - k] = -1
+        else:
+            failure[j - k] = i + 1
+    return k
+
+def route_content_id(route):
+    """
+    Returns a content hash of a route's waypoints that does not depend on where a loop
+    starts or which way it is run, so the same loop always gets the same ID.
+    """
+    points = [(round(lat * 1e6), round(lon * 1e6)) for lat, lon in route['waypoints']]
+    closed = len(points) > 1 and points[0] == points[-1]
+
+    if closed:
+        # Canonical loop: smallest rotation over both running directions
+        loop = points[:-1]
+        candidates = []
+        for seq in (loop, loop[::-1]):
+            k = _least_rotation(seq)
+            candidates.append(seq[k:] + seq[:k])
+        canonical = min(candidates)
+    else:
+        canonical = min(points, points[::-1])
+
+    payload = json.dumps({"closed": closed, "points": canonical}, separators=(',', ':'))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def route_content(route, version=None):
+    """
+    Returns the canonical record of a route: the ROUTE_CONTENT_FIELDS, with the all-day
+    safety scores when the route was scored for a time slot, the unsimplified street
+    geometry ('street_geometry') as 'geometry' for off-route checks and maps, and the
+    scores version of the safety data it was scored with.
+    """
+    content = {field: route[field] for field in ROUTE_CONTENT_FIELDS if field in route}
+    content.update(route.get('all_day_safety', {}))
+    if 'street_geometry' in route:
+        content['geometry'] = route['street_geometry']
+    content['route_id'] = route['route_id']
+    content['scores_version'] = version
+    return content
+
+def store_routes(routes, version=None):
+    """
+    Stores the generated routes under their content IDs and returns the IDs keyed by route type.
+    version is the scores version (see path_service.scores_version) of the model the routes
+    were scored on. A route that was stored before is left as it is (only its expiry is
+    refreshed), so a later request never changes a route that is already favorited or
+    selected; if it was scored on other safety data, the new scores are stored for version.
+    """
     route_ids = {}
     for route in routes:
-        # Generate a unique ID for each route
-        route_id = str(uuid.uuid4())
-        _STORE["routes"][route_id] = route
+        route_id = route_content_id(route)
+        route['route_id'] = route_id
         route_ids[route['type']] = route_id
 
+        content = route_content(route, version)
+        stored = _backend.update("routes", route_id, lambda current: current)
+        if stored is None:
+            _backend.put("routes", route_id, content)
+        elif version is not None and stored.get('scores_version') != version:
+            _backend.put("route_scores", f"{route_id}@{version}",
+                         {field: content[field] for field in ROUTE_SCORE_FIELDS if field in content})
     return route_ids
 
 def get_route(route_id):
-    """Retrieves a specific route by its ID."""
-    return _STORE["routes"].get(route_id)
+    """
+    Retrieves a specific route by its ID.
+    When the route was scored on other safety data than the served model's (a reload or a
+    safety delta since), its ROUTE_SCORE_FIELDS are those of the served model, recomputed
+    once per scores version and stored alongside the route.
+    """
+    route = _backend.get("routes", route_id)
+    G = _current_model() if _current_model else None
+    if route is None or G is None:
+        return route
+    version = scores_version(G)
+    if route.get('scores_version') == version:
+        return route
+
+    key = f"{route_id}@{version}"
+    scores = _backend.get("route_scores", key)
+    if scores is None:
+        scores = route_scores(G, route.get('waypoints'))
+        if scores is None:
+            # The route is not on the served graph any more; keep its stored scores
+            return route
+        _backend.put("route_scores", key, scores)
+    return dict(route, **scores, scores_version=version)
 
-def add_favorite(route_id, name):
-    """Adds a route to favorites."""
+def add_favorite(route_id, name, pace_min_per_km=None):
+    """Adds a route to favorites, with the time estimate for pace_min_per_km if given."""
     route = get_route(route_id)
     if not route:
         return None
@@ -42,14 +195,20 @@ def add_favorite(route_id, name):
         "distance_km": route['distance_km'],
         "category": route['type'],
         "safety_score": route['safety_score'],
-        "estimated_time_min": route['estimated_time_min'],
-        "pace_min_per_km": (route['estimated_time_min'] / route['distance_km']) if route['distance_km'] > 0 else 0
+        "estimated_time_min": round(route['distance_km'] * pace_min_per_km, 2) if pace_min_per_km else None,
+        "pace_min_per_km": pace_min_per_km
     }
-    _STORE["favorites"][favorite_id] = favorite_route
+    # Routes referenced by a favorite are no longer transient
+    _backend.pin("routes", route_id)
+    _backend.put("favorites", favorite_id, favorite_route)
     return favorite_route
 
-def start_running_session(route_id, planned_pace_min_per_km):
-    """Starts a new running session."""
+def start_running_session(route_id, planned_pace_min_per_km, crew_post_id=None):
+    """
+    Starts a new running session.
+    Position updates are broadcast live to the crew post the session runs for: crew_post_id
+    if given, otherwise every crew post that selected the route.
+    """
     route = get_route(route_id)
     if not route:
         return None
@@ -63,36 +222,118 @@ def start_running_session(route_id, planned_pace_min_per_km):
         "start_time": datetime.datetime.utcnow().isoformat() + 'Z',
         "current_location": route['waypoints'][0] # Start at the beginning
     }
-    _STORE["sessions"][session_id] = session_data
+    if crew_post_id:
+        session_data["crew_post_id"] = crew_post_id
+    _backend.put("sessions", session_id, session_data)
+
+    # Sessions on a route selected for a crew are kept until the crew is done with them
+    if _backend.get("route_crews", route_id):
+        _backend.pin("sessions", session_id)
     return session_data
 
 def update_running_session(session_id, data):
-    """Updates an existing running session."""
-    session_data = _STORE["sessions"].get(session_id)
+    """
+    Updates an existing running session.
+    A 'current_location' ([lat, lon], with an optional 'timestamp') is recorded in the
+    session's GPS trace instead of overwriting the previous location.
+    """
+    session_data = _backend.get("sessions", session_id)
+    if not session_data:
+        return session_data
+
+    data = dict(data)
+    location = data.pop('current_location', None)
+    timestamp = data.pop('timestamp', None)
+    if location is not None:
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow().timestamp()
+        record_fixes(session_id, [[timestamp, location[0], location[1]]])
+
+    if data:
+        # Read-modify-write under the store's lock, so concurrent updates of a session are not lost
+        _backend.update("sessions", session_id, lambda current: dict(current, **data))
+    return get_running_session(session_id)
+
+def get_running_session(session_id):
+    """Retrieves a running session by its ID, with its latest recorded location and route status."""
+    session_data = _backend.get("sessions", session_id)
     if session_data:
-        session_data.update(data)
+        fix = trace_ingest.last_fix(session_id)
+        if fix is not None:
+            session_data = dict(session_data, current_location=fix[1:])
+        status = off_route.get_status(session_id)
+        if status is not None:
+            session_data = dict(session_data, **status)
     return session_data
 
-def finish_running_session(session_id):
-    """Finishes a running session and calculates final stats."""
-    session_data = _STORE["sessions"].get(session_id)
+def record_fixes(session_id, raw_fixes):
+    """
+    Appends a batch of GPS fixes to a running session's trace and checks them against the route.
+    Returns a dict with the received and accepted counts and the off-route status,
+    or None if there is no such running session. Raises ValueError on malformed fixes
+    and LookupError if the session's stored trace is incomplete.
+    """
+    session_data = _backend.get("sessions", session_id)
+    if not session_data or session_data.get("status") != "started":
+        return None
+
+    fixes = trace_ingest.parse_fixes(raw_fixes)
+    kept = trace_ingest.ingest_fixes(session_id, fixes)
+    result = {"received": len(fixes), "accepted": len(kept)}
+
+    if not len(kept):
+        return result
+
+    route = get_route(session_data["route_id"])
+    if route:
+        result.update(off_route.check_fixes(session_id, session_data["route_id"], route, kept))
+
+    # One update per batch, with the latest position, goes to the crew's live view
+    crew_post_ids = [session_data["crew_post_id"]] if session_data.get("crew_post_id") \
+        else get_route_crews(session_data["route_id"])
+    if crew_post_ids:
+        timestamp, lat, lon = kept[-1].tolist()
+        update = {"session_id": session_id, "location": [lat, lon], "timestamp": timestamp,
+                  "off_route": result.get("off_route", False)}
+        for crew_post_id in crew_post_ids:
+            live_hub.publish(crew_post_id, session_id, update)
+    return result
+
+def finish_running_session(session_id, G=None):
+    """
+    Finishes a running session and calculates final stats from its recorded trace.
+    G is the pathfinding graph, used to score the safety of the nodes the runner passed.
+    Raises LookupError if the session's stored trace is incomplete.
+    """
+    session_data = _backend.get("sessions", session_id)
     if not session_data:
         return None
 
-    session_data["status"] = "finished"
-    session_data["end_time"] = datetime.datetime.utcnow().isoformat() + 'Z'
-    # In a real app, you would calculate total time, average pace, distance, etc.
-    # For this simulation, we'll return a placeholder response.
-    return {
-        "session_id": session_id,
-        "total_time_min": 40,
-        "average_pace_min_per_km": 8.0,
-        "actual_distance_km": 5.2,
-        "safety_score": 88
-    }
+    if session_data.get("status") == "finished" and "stats" in session_data:
+        return dict(session_data["stats"], session_id=session_id)
+
+    stats = compute_session_stats(trace_ingest.get_trace(session_id), G)
+
+    def finish(current):
+        # A concurrent finish may have won the race; keep its stats
+        if current.get("status") != "finished" or "stats" not in current:
+            current["status"] = "finished"
+            current["end_time"] = datetime.datetime.utcnow().isoformat() + 'Z'
+            current["stats"] = stats
+        return current
+
+    session_data = _backend.update("sessions", session_id, finish)
+    if session_data is None:
+        return None
+    # A crew session was pinned while running; once finished it expires like any other
+    _backend.unpin("sessions", session_id)
+    trace_ingest.drop_buffer(session_id)
+    off_route.forget_session(session_id)
 
-def select_route_for_crew(route_id, crew_post_id):
-    """Selects a route for a crew post."""
+    return dict(session_data["stats"], session_id=session_id)
+
+def select_route_for_crew(route_id, crew_post_id, pace_min_per_km=None):
+    """Selects a route for a crew post, at pace_min_per_km if the crew gives one."""
     route = get_route(route_id)
     if not route:
         return None
@@ -103,8 +344,19 @@ def select_route_for_crew(route_id, crew_post_id):
         "route_id": route_id,
         "crew_post_id": crew_post_id,
         "distance_km": route['distance_km'],
-        "pace_min_per_km": (route['estimated_time_min'] / route['distance_km']) if route['distance_km'] > 0 else 0,
+        "pace_min_per_km": pace_min_per_km,
         "safety_score": route['safety_score']
     }
-    _STORE["selected_routes"][selected_id] = selected_route_data
+    _backend.pin("routes", route_id)
+    _backend.put("selected_routes", selected_id, selected_route_data)
+
+    def add_crew(crew_post_ids):
+        return crew_post_ids if crew_post_id in crew_post_ids else crew_post_ids + [crew_post_id]
+
+    if _backend.update("route_crews", route_id, add_crew) is None:
+        _backend.put("route_crews", route_id, [crew_post_id])
     return selected_route_data
+
+def get_route_crews(route_id):
+    """Returns the crew post IDs that selected a route."""
+    return _backend.get("route_crews", route_id) or []
@@ -0,0 +1,659 @@
+# Safety-scoring pipeline.
+# Rebuilds nodes_final_with_safety_score.csv from the facility counts per node and the
+# floating-population grids, and writes the routing weights of every edge in the same run.
+# Every stage works on whole columns with pandas/numpy, and is timed.
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import population_raster
+from data_store import NODE_COLUMN_TYPES, prefer_columnar, read_table, write_table
+from geometry import load_edge_geometry
+
+# Weights of the normalized node features in the safety score
+SAFETY_FEATURE_WEIGHTS = {
+    'convenience_store_count': 0.15,
+    'cctv_count': 0.25,
+    'police_count': 0.25,
+    'lighting_count': 0.2,
+    'population': 0.15
+}
+FACILITY_COLUMNS = [column for column in SAFETY_FEATURE_WEIGHTS if column != 'population']
+
+# Floating-population slot used for the static safety score (22:00-24:00)
+DEFAULT_SLOT = '2223'
+
+# Facilities within this distance of a node count towards its features
+FACILITY_RADIUS_M = 100.0
+# How a facility's contribution falls off with distance: none (plain count), linear or gaussian
+FACILITY_DECAYS = ('none', 'linear', 'gaussian')
+# Coordinate column pairs accepted in facility point files
+FACILITY_COORD_COLUMNS = [('위도', '경도'), ('lat', 'lon'), ('latitude', 'longitude'), ('Lat', 'Lon'), ('y', 'x')]
+
+EARTH_RADIUS_M = 6371008.8
+
+# Spacing of the points sampled along every edge for its edge-level safety (0: use the target node)
+EDGE_SAMPLE_SPACING_M = 20.0
+# Number of nearest nodes the facility part of the score is interpolated from at a sample point
+FACILITY_FIELD_NEIGHBOURS = 4
+
+# Columns of the scored node table, in the order of nodes_final_with_safety_score.csv
+NODE_TABLE_COLUMNS = ['osmid', 'y', 'x', 'street_count', 'highway', 'junction', 'ref', 'railway', 'geometry'] + \
+    FACILITY_COLUMNS + ['population', 'safety_score']
+
+
+@contextmanager
+def stage(timings, name):
+    """Times a pipeline stage and records its duration in seconds under name."""
+    started = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - started
+
+
+def load_facility_nodes(facility_csv_file):
+    """
+    Reads the node table with facility counts (nodes_with_facility_counts.csv),
+    renaming its coordinate columns to y (latitude) and x (longitude).
+    """
+    nodes = read_table(facility_csv_file).rename(columns={'위도': 'y', '경도': 'x'})
+    nodes[FACILITY_COLUMNS] = nodes[FACILITY_COLUMNS].fillna(0)
+    return nodes
+
+
+def load_facility_points(csv_file):
+    """
+    Reads a facility point file (e.g. a CCTV or street-light dataset) and returns an
+    (n, 2) array of (lat, lon). Any of the FACILITY_COORD_COLUMNS pairs may be used.
+    """
+    points = pd.read_csv(csv_file, encoding='utf-8-sig')
+    for lat_column, lon_column in FACILITY_COORD_COLUMNS:
+        if lat_column in points.columns and lon_column in points.columns:
+            coords = points[[lat_column, lon_column]].apply(pd.to_numeric, errors='coerce')
+            coords = coords.to_numpy(dtype=np.float64)
+            return coords[~np.isnan(coords).any(axis=1)]
+    raise ValueError(f"{csv_file} has no latitude/longitude columns")
+
+
+def project(coords, lat0):
+    """Projects (lat, lon) degrees to local equirectangular meters around latitude lat0."""
+    coords = np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    return np.column_stack((EARTH_RADIUS_M * coords[:, 1] * np.cos(np.radians(lat0)),
+                            EARTH_RADIUS_M * coords[:, 0]))
+
+
+def count_facilities(node_coords, facility_coords, radius_m=FACILITY_RADIUS_M, decay='none', lat0=None):
+    """
+    Counts the facilities within radius_m of every node with a KD-tree over projected
+    facility coordinates, answering all nodes in one bulk query.
+    With decay='linear' or 'gaussian', each facility counts less the farther it is
+    (1 - d/r, or exp(-d^2 / 2 sigma^2) with sigma = r/2) and the counts are fractional.
+    lat0 is the latitude of the projection (default: the mean node latitude).
+    """
+    if decay not in FACILITY_DECAYS:
+        raise ValueError(f"decay must be one of {', '.join(FACILITY_DECAYS)}")
+
+    node_coords = np.asarray(node_coords, dtype=np.float64).reshape(-1, 2)
+    counts = np.zeros(len(node_coords))
+    known = ~np.isnan(node_coords).any(axis=1)
+    if len(facility_coords) == 0 or not known.any():
+        return counts
+
+    if lat0 is None:
+        lat0 = float(node_coords[known, 0].mean())
+    node_tree = cKDTree(project(node_coords[known], lat0))
+    facility_tree = cKDTree(project(facility_coords, lat0))
+
+    if decay == 'none':
+        counts[known] = facility_tree.query_ball_point(node_tree.data, radius_m, return_length=True)
+        return counts
+
+    # Every (node, facility) pair within the radius with its distance, without a Python loop
+    pairs = node_tree.sparse_distance_matrix(facility_tree, radius_m, output_type='ndarray')
+    distance = pairs['v']
+    if decay == 'linear':
+        weight = 1 - distance / radius_m
+    else:
+        weight = np.exp(-0.5 * (distance / (radius_m / 2)) ** 2)
+    counts[known] = np.bincount(pairs['i'], weights=weight, minlength=int(known.sum()))
+    return counts
+
+
+def recount_facilities(nodes, facility_files, radius_m=FACILITY_RADIUS_M, decay='none'):
+    """
+    Replaces facility count columns of the node table with counts from point files.
+    facility_files maps a count column (e.g. 'cctv_count') to its facility csv.
+    """
+    nodes = nodes.copy()
+    node_coords = nodes[['y', 'x']].to_numpy(dtype=np.float64)
+    for column, csv_file in facility_files.items():
+        if column not in FACILITY_COLUMNS:
+            raise ValueError(f"Unknown facility column {column}; expected one of {', '.join(FACILITY_COLUMNS)}")
+        nodes[column] = count_facilities(node_coords, load_facility_points(csv_file), radius_m, decay)
+    return nodes
+
+
+def slot_files(floating_pop_dir):
+    """Returns {slot name: csv path} of the floating-population grids in a directory."""
+    return {os.path.splitext(os.path.basename(path))[0]: path
+            for path in sorted(glob.glob(os.path.join(floating_pop_dir, '*.csv')))}
+
+
+def population_source(floating_pop_dir, raster_file):
+    """
+    Returns the floating-population source every score is computed from: the raster file
+    built by population_raster when it exists, else the point grids in floating_pop_dir.
+    The static scores and the time-slot scores must come from the same source.
+    """
+    return raster_file if os.path.exists(raster_file) else floating_pop_dir
+
+
+def population_slots(floating_pop):
+    """
+    Returns the slot names available from a floating-population source: either a
+    directory of point-grid CSVs or a raster file built by population_raster.
+    """
+    if floating_pop.endswith('.npz'):
+        return population_raster.load_rasters(floating_pop)['slots'] if os.path.exists(floating_pop) else []
+    return list(slot_files(floating_pop))
+
+
+def slot_hours(slot):
+    """
+    Returns the (start, end) hours covered by a floating-population slot name:
+    '2223' covers 22:00 to 24:00.
+    """
+    return int(slot[:2]), int(slot[2:]) + 1
+
+
+def normalize(values):
+    """Scales values by their maximum (all zeros if the maximum is not positive)."""
+    values = np.asarray(values, dtype=np.float64)
+    peak = values.max() if len(values) else 0
+    return values / peak if peak > 0 else np.zeros_like(values)
+
+
+def population_features(nodes, grid_files):
+    """
+    Returns a nodes x slots matrix of normalized floating population: each node takes the
+    population of the nearest grid point of the slot, divided by the slot's maximum.
+    """
+    coords = nodes[['y', 'x']].to_numpy(dtype=np.float64)
+    known = ~np.isnan(coords).any(axis=1)
+    matrix = np.zeros((len(nodes), len(grid_files)))
+    for j, grid_file in enumerate(grid_files):
+        grid = pd.read_csv(grid_file)
+        _, nearest = cKDTree(grid[['Lat', 'Lon']].to_numpy()).query(coords[known])
+        matrix[known, j] = grid['Populations'].to_numpy()[nearest]
+        matrix[:, j] = normalize(matrix[:, j])
+    return matrix
+
+
+def raster_population_features(nodes, rasters):
+    """
+    Returns a nodes x slots matrix of normalized floating population from bilinear
+    lookups in population rasters, divided by each slot's maximum.
+    """
+    coords = nodes[['y', 'x']].to_numpy(dtype=np.float64)
+    known = ~np.isnan(coords).any(axis=1)
+    matrix = np.zeros((len(nodes), len(rasters['slots'])))
+    matrix[known] = population_raster.bilinear(rasters, coords[known, 0], coords[known, 1])
+    return np.column_stack([normalize(column) for column in matrix.T])
+
+
+def facility_features(nodes):
+    """Returns the facility counts of every node normalized by the column maxima."""
+    return pd.DataFrame({column: normalize(nodes[column]) for column in FACILITY_COLUMNS}, index=nodes.index)
+
+
+def facility_scores(features):
+    """Weighted sum of the normalized facility features: the part of the score without population."""
+    return sum(features[column].to_numpy() * SAFETY_FEATURE_WEIGHTS[column] for column in FACILITY_COLUMNS)
+
+
+def safety_scores(features, population):
+    """
+    Weighted sum of the normalized features. population may be a vector (one score per
+    node) or a nodes x slots matrix (one score column per slot).
+    """
+    base = facility_scores(features)
+    population = np.asarray(population, dtype=np.float64)
+    if population.ndim == 2:
+        base = base[:, None]
+    return base + population * SAFETY_FEATURE_WEIGHTS['population']
+
+
+def slot_population(nodes, floating_pop):
+    """
+    Returns (slot names, nodes x slots matrix of normalized population).
+    floating_pop is a directory of point-grid CSVs (nearest grid point) or a raster
+    .npz file (bilinear lookup).
+    """
+    if floating_pop.endswith('.npz'):
+        rasters = population_raster.load_rasters(floating_pop)
+        return rasters['slots'], raster_population_features(nodes, rasters)
+    files = slot_files(floating_pop)
+    return list(files), population_features(nodes, list(files.values()))
+
+
+def score_slots(nodes, floating_pop):
+    """
+    Computes the safety score of every node for each floating-population slot.
+    Returns (slot names, nodes x slots matrix of raw scores).
+    """
+    slots, population = slot_population(nodes, floating_pop)
+    return slots, safety_scores(facility_features(nodes), population)
+
+
+def score_nodes(nodes, floating_pop, slot=DEFAULT_SLOT):
+    """
+    Builds the scored node table: normalized features, population of the slot from
+    floating_pop (see sample_population) and safety_score, with the columns of
+    nodes_final_with_safety_score.csv.
+    """
+    features = facility_features(nodes)
+    coords = nodes[['y', 'x']].to_numpy(dtype=np.float64)
+    known = ~np.isnan(coords).any(axis=1)
+    population = np.zeros(len(nodes))
+    population[known] = sample_population(coords[known], floating_pop, slot)
+
+    table = nodes.copy()
+    table['geometry'] = 'POINT (' + nodes['x'].astype(str) + ' ' + nodes['y'].astype(str) + ')'
+    table[FACILITY_COLUMNS] = features
+    table['population'] = population
+    table['safety_score'] = safety_scores(features, population)
+    return table.reindex(columns=NODE_TABLE_COLUMNS)
+
+
+def sample_edges(coords, offsets, spacing_m=EDGE_SAMPLE_SPACING_M):
+    """
+    Places points at equal intervals of at most spacing_m along every edge of a packed
+    geometry buffer ((lat, lon) coords, edge i covering coords[offsets[i]:offsets[i + 1]]),
+    both ends included, for all edges at once.
+    Returns the (lat, lon) samples back to back, the sample offsets of every edge, and the
+    trapezoid weight of every sample (the share of its edge's length it stands for).
+    """
+    lat0 = float(coords[:, 0].mean())
+    xy = project(coords, lat0)
+    steps = np.hypot(*(xy[1:] - xy[:-1]).T)
+    # Steps from the last point of one edge to the first of the next are not part of any edge
+    steps[offsets[1:-1] - 1] = 0
+    cum = np.concatenate(([0.0], np.cumsum(steps)))
+    start, end = offsets[:-1], offsets[1:] - 1
+    lengths = cum[end] - cum[start]
+
+    intervals = np.maximum(np.ceil(lengths / spacing_m), 1).astype(np.int64)
+    sample_offsets = np.zeros(len(intervals) + 1, dtype=np.int64)
+    np.cumsum(intervals + 1, out=sample_offsets[1:])
+    edge = np.repeat(np.arange(len(intervals)), intervals + 1)
+    k = np.arange(sample_offsets[-1]) - sample_offsets[edge]
+    fraction = k / intervals[edge]
+
+    # Locate every sample on its edge's polyline and interpolate between the two points
+    position = cum[start[edge]] + fraction * lengths[edge]
+    segment = np.searchsorted(cum, position, side='right') - 1
+    segment = np.clip(segment, start[edge], np.maximum(end[edge] - 1, start[edge]))
+    following = np.minimum(segment + 1, end[edge])
+    span = cum[following] - cum[segment]
+    t = np.divide(position - cum[segment], span, out=np.zeros_like(span), where=span > 0)
+    samples = coords[segment] + (coords[following] - coords[segment]) * t[:, None]
+
+    weights = np.where((k == 0) | (k == intervals[edge]), 0.5, 1.0) / intervals[edge]
+    return samples, sample_offsets, weights
+
+
+def facility_field(table, coords):
+    """
+    Interpolates the facility part of the node scores at arbitrary (lat, lon) points,
+    weighting the FACILITY_FIELD_NEIGHBOURS nearest nodes (KD-tree over projected
+    coordinates) by inverse squared distance.
+    """
+    node_coords = table[['y', 'x']].to_numpy(dtype=np.float64)
+    known = ~np.isnan(node_coords).any(axis=1)
+    scores = facility_scores(table.loc[known, FACILITY_COLUMNS])
+    lat0 = float(node_coords[known, 0].mean())
+
+    k = min(FACILITY_FIELD_NEIGHBOURS, int(known.sum()))
+    distance, nearest = cKDTree(project(node_coords[known], lat0)).query(project(coords, lat0), k=k)
+    distance, nearest = distance.reshape(len(coords), k), nearest.reshape(len(coords), k)
+    weights = 1 / np.maximum(distance, 1.0) ** 2
+    return (scores[nearest] * weights).sum(axis=1) / weights.sum(axis=1)
+
+
+def sample_population(coords, floating_pop, slot=DEFAULT_SLOT):
+    """
+    Floating population of a slot at arbitrary (lat, lon) points, normalized by the
+    maximum over the points: bilinear from a raster file, else the nearest grid point.
+    """
+    if floating_pop.endswith('.npz'):
+        rasters = population_raster.load_rasters(floating_pop)
+        if slot not in rasters['slots']:
+            raise ValueError(f"No floating population raster for slot {slot} in {floating_pop}")
+        population = population_raster.bilinear(rasters, coords[:, 0], coords[:, 1])[:, rasters['slots'].index(slot)]
+    else:
+        grid_file = slot_files(floating_pop).get(slot)
+        if grid_file is None:
+            raise ValueError(f"No floating population grid for slot {slot} in {floating_pop}")
+        grid = pd.read_csv(grid_file)
+        _, nearest = cKDTree(grid[['Lat', 'Lon']].to_numpy()).query(coords)
+        population = grid['Populations'].to_numpy(dtype=np.float64)[nearest]
+    return normalize(population)
+
+
+def edge_safety(edges_csv_file, table, floating_pop, slot=DEFAULT_SLOT, spacing_m=EDGE_SAMPLE_SPACING_M):
+    """
+    Edge-level safety: the safety score sampled every spacing_m meters along each edge's
+    geometry (facility part interpolated from the nodes, population from the slot's grid)
+    and averaged over the edge's length, so a dark stretch in the middle of a long edge
+    lowers its score. Same raw scale as the node safety_score.
+    Returns a Series indexed by (u, v) of the edges with geometry (the shortest of parallel edges).
+    """
+    geometry = load_edge_geometry(edges_csv_file)
+    samples, sample_offsets, weights = sample_edges(geometry['coords'], geometry['offsets'], spacing_m)
+    scores = facility_field(table, samples) + \
+        sample_population(samples, floating_pop, slot) * SAFETY_FEATURE_WEIGHTS['population']
+    safety = np.add.reduceat(scores * weights, sample_offsets[:-1])
+    return pd.Series(safety, index=pd.MultiIndex.from_tuples(list(geometry['edge_index']), names=['u', 'v']))
+
+
+def edge_weights(edges, table, sampled_safety=None):
+    """
+    Computes the routing weights of every edge, rescaled to 100 like the served model.
+    Edges take their sampled edge-level safety (see edge_safety) when given, and the safety
+    of their target node otherwise. Returns a table of u, v, key, length, edge_safety (the
+    100-point safety the weights were computed from), safe_only_weight,
+    shortest_only_weight and hybrid_weight.
+    """
+    safety = table.set_index('osmid')['safety_score']
+    peak = safety.max()
+    safety_100 = safety / peak * 100 if peak > 0 else safety * 0
+    v_safety = edges['v'].map(safety_100).fillna(0).to_numpy()
+    if sampled_safety is not None:
+        keys = pd.MultiIndex.from_arrays([edges['u'].astype(str), edges['v'].astype(str)])
+        reversed_keys = pd.MultiIndex.from_arrays([edges['v'].astype(str), edges['u'].astype(str)])
+        # The sampled safety is the same in both directions
+        sampled = sampled_safety.reindex(keys).to_numpy()
+        sampled = np.where(np.isnan(sampled), sampled_safety.reindex(reversed_keys).to_numpy(), sampled)
+        sampled = sampled / peak * 100 if peak > 0 else np.zeros(len(edges))
+        v_safety = np.where(np.isnan(sampled), v_safety, sampled)
+
+    weights = edges[['u', 'v', 'key', 'length']].copy()
+    weights['edge_safety'] = v_safety
+    weights['safe_only_weight'] = 1 / (v_safety + 1e-6)
+    weights['shortest_only_weight'] = edges['length']
+    # 안전 점수(safe_only_weight)와 길이를 1:9 비율로 섞음 (path_service와 동일)
+    weights['hybrid_weight'] = weights['safe_only_weight'] * 0.1 + weights['shortest_only_weight'] * 0.9
+    return weights
+
+
+def affected_nodes(node_coords, old_points, new_points, radius_m=FACILITY_RADIUS_M):
+    """
+    Diffs two versions of a facility point set and returns the indices of the nodes
+    within radius_m of any added or removed point, found with a KD-tree over the
+    projected node coordinates.
+    """
+    old_keys = {tuple(p) for p in np.round(old_points, 7)}
+    new_keys = {tuple(p) for p in np.round(new_points, 7)}
+    changed = np.array(sorted(old_keys ^ new_keys), dtype=np.float64).reshape(-1, 2)
+
+    known = np.flatnonzero(~np.isnan(node_coords).any(axis=1))
+    if len(changed) == 0 or len(known) == 0:
+        return np.array([], dtype=np.int64)
+
+    lat0 = float(node_coords[known, 0].mean())
+    node_tree = cKDTree(project(node_coords[known], lat0))
+    hits = node_tree.query_ball_point(project(changed, lat0), radius_m)
+    return known[np.unique(np.concatenate([np.asarray(h, dtype=np.int64) for h in hits]))]
+
+
+def incremental_update(nodes, table, facility_changes, radius_m=FACILITY_RADIUS_M, decay='none'):
+    """
+    Re-scores only the nodes near changed facilities.
+    nodes is the facility count table, table the current scored table (same row order),
+    facility_changes maps a count column to its (old csv, new csv) point files.
+    Raises ValueError unless the counts in nodes are exactly those of the old files with
+    radius_m and decay (e.g. the table was not rewritten by a full run with --facility),
+    since re-scoring from other counts would not give the result of a full run.
+    When a change moves the maximum of a count column, every node's normalized features
+    change, so all nodes are re-scored.
+    Returns (updated nodes, updated table, indices of re-scored nodes, full).
+    """
+    nodes, table = nodes.copy(), table.copy()
+    node_coords = nodes[['y', 'x']].to_numpy(dtype=np.float64)
+    old_maxima = nodes[FACILITY_COLUMNS].max()
+    # Same projection as a full recount, so the counts match it exactly
+    lat0 = float(np.nanmean(node_coords[:, 0]))
+
+    touched = []
+    for column, (old_csv, new_csv) in facility_changes.items():
+        if column not in FACILITY_COLUMNS:
+            raise ValueError(f"Unknown facility column {column}; expected one of {', '.join(FACILITY_COLUMNS)}")
+        old_points, new_points = load_facility_points(old_csv), load_facility_points(new_csv)
+        counts = nodes[column].to_numpy(dtype=np.float64, copy=True)
+        if not np.allclose(counts, count_facilities(node_coords, old_points, radius_m, decay, lat0), atol=1e-6):
+            raise ValueError(f"{column} counts in the facility table are not those of {old_csv} "
+                             f"(radius {radius_m} m, decay {decay}); run the full pipeline with --facility first")
+        affected = affected_nodes(node_coords, old_points, new_points, radius_m)
+        if len(affected):
+            counts[affected] = count_facilities(node_coords[affected], new_points, radius_m, decay, lat0)
+            nodes[column] = counts
+        touched.append(affected)
+    affected = np.unique(np.concatenate(touched)) if touched else np.array([], dtype=np.int64)
+
+    full = not np.allclose(nodes[FACILITY_COLUMNS].max(), old_maxima)
+    if full:
+        affected = np.arange(len(nodes))
+
+    # Normalize by the (unchanged) column maxima, for the affected rows only
+    maxima = nodes[FACILITY_COLUMNS].max()
+    features = pd.DataFrame({column: nodes[column].to_numpy()[affected] / maxima[column] if maxima[column] > 0
+                             else np.zeros(len(affected)) for column in FACILITY_COLUMNS})
+    population = table['population'].to_numpy()[affected]
+
+    rows = table.index[affected]
+    table.loc[rows, FACILITY_COLUMNS] = features.to_numpy()
+    table.loc[rows, 'safety_score'] = safety_scores(features, population)
+    return nodes, table, affected, full
+
+
+def changed_edges(old_weights, weights):
+    """
+    Lists the edge-level safety a server that loaded old_weights needs to match weights:
+    [u, v, edge_safety] (100-point) for every street with a changed row, in the order
+    path_service.load_edge_costs applies the table (the shortest of parallel edges, later
+    rows of the same street last), so applying the list in order gives the same weights.
+    """
+    weights = weights.assign(u=weights['u'].astype(str), v=weights['v'].astype(str))
+    changed = np.ones(len(weights), dtype=bool)
+    if old_weights is not None and 'edge_safety' in old_weights.columns:
+        keys = ['u', 'v', 'key']
+        old = old_weights.assign(u=old_weights['u'].astype(str), v=old_weights['v'].astype(str))
+        old = old.drop_duplicates(keys).set_index(keys)['edge_safety']
+        previous = old.reindex(pd.MultiIndex.from_frame(weights[keys])).to_numpy(dtype=np.float64)
+        current = weights['edge_safety'].to_numpy(dtype=np.float64)
+        changed = ~(np.isclose(current, previous, rtol=0, atol=1e-9) | (np.isnan(current) & np.isnan(previous)))
+
+    # Every row of a changed street, so a later unchanged row still wins as it does on load
+    streets = {frozenset(uv) for uv in zip(weights['u'].to_numpy()[changed], weights['v'].to_numpy()[changed])}
+    rows = weights.sort_values('length', kind='stable').drop_duplicates(['u', 'v'])
+    touched = np.array([frozenset(uv) in streets for uv in zip(rows['u'], rows['v'])], dtype=bool)
+    rows = rows[touched & rows['edge_safety'].notna().to_numpy()]
+    return [[u, v, float(s)] for u, v, s in zip(rows['u'], rows['v'], rows['edge_safety'])]
+
+
+def safety_delta(table, affected, full, old_weights=None, weights=None):
+    """
+    Builds the delta a running server applies with path_service.apply_safety_delta:
+    the new safety_score and facility-only score of every re-scored node, the
+    maximum safety_score the served 100-point scale is based on and, when the edge
+    weight table was rewritten, its changed edge-level safety (see changed_edges).
+    """
+    features = pd.DataFrame({column: table[column].to_numpy()[affected] for column in FACILITY_COLUMNS})
+    facility = facility_scores(features)
+    safety = table['safety_score'].to_numpy()[affected]
+    osmids = table['osmid'].to_numpy()[affected]
+    return {
+        "created": datetime.datetime.utcnow().isoformat() + 'Z',
+        "full": bool(full),
+        "max_safety_score": float(table['safety_score'].max()),
+        "nodes": {str(osmid): {"safety_score": float(s), "facility_score": float(f)}
+                  for osmid, s, f in zip(osmids, safety, facility)},
+        "edges": changed_edges(old_weights, weights) if weights is not None else []
+    }
+
+
+def incremental_edge_weights(edges, table, weights, affected, old_max):
+    """
+    Updates target-node edge weights for re-scored nodes: only the edges leading to them
+    change, unless the 100-point scale moved (or there are no previous weights).
+    """
+    if weights is None or 'edge_safety' not in weights.columns or \
+            not np.isclose(table['safety_score'].max(), old_max):
+        # The 100-point scale moved, so every edge weight changes
+        return edge_weights(edges, table)
+    rows = edges['v'].isin(table['osmid'].to_numpy()[affected]).to_numpy()
+    weights.loc[rows] = edge_weights(edges[rows], table).to_numpy()
+    return weights
+
+
+def run_incremental(facility_csv_file, nodes_csv_file, edges_csv_file, edges_out, delta_out, facility_changes,
+                    radius_m=FACILITY_RADIUS_M, decay='none', floating_pop=None, slot=DEFAULT_SLOT,
+                    spacing_m=EDGE_SAMPLE_SPACING_M):
+    """
+    Incremental run: re-scores the nodes near changed facilities, rewrites the count
+    table, the scored node table and the weights of the edges leading to re-scored
+    nodes, and writes the delta for running servers, with the node scores and the
+    changed edge-level safety. Returns the duration of each stage.
+    With floating_pop and spacing_m > 0, every edge is re-sampled instead: the sampled
+    field near a node depends on its nearest nodes, not only on the edge's own ends.
+    """
+    timings = {}
+    with stage(timings, 'load'):
+        nodes = load_facility_nodes(facility_csv_file)
+        table = read_table(nodes_csv_file)
+        if not (table['osmid'].to_numpy() == nodes['osmid'].to_numpy()).all():
+            raise ValueError(f"{nodes_csv_file} and {facility_csv_file} list different nodes")
+        edges = read_table(edges_csv_file, columns=['u', 'v', 'key', 'length'])
+        weights = read_table(edges_out) if os.path.exists(edges_out) else None
+        old_weights = None if weights is None else weights.copy()
+    with stage(timings, 'rescore_nodes'):
+        old_max = table['safety_score'].max()
+        nodes, table, affected, full = incremental_update(nodes, table, facility_changes, radius_m, decay)
+    if floating_pop and spacing_m > 0:
+        with stage(timings, 'edge_safety'):
+            sampled = edge_safety(edges_csv_file, table, floating_pop, slot, spacing_m)
+        with stage(timings, 'edge_weights'):
+            weights = edge_weights(edges, table, sampled)
+    else:
+        with stage(timings, 'edge_weights'):
+            weights = incremental_edge_weights(edges, table, weights, affected, old_max)
+    with stage(timings, 'write'):
+        write_table(nodes.rename(columns={'y': '위도', 'x': '경도'}), facility_csv_file, NODE_COLUMN_TYPES)
+        write_table(table, nodes_csv_file, NODE_COLUMN_TYPES)
+        write_table(weights, edges_out)
+        with open(delta_out, 'w') as f:
+            json.dump(safety_delta(table, affected, full, old_weights, weights), f)
+    timings['affected_nodes'] = len(affected)
+    return timings
+
+
+def run_pipeline(facility_csv_file, floating_pop, edges_csv_file, nodes_out, edges_out, slot=DEFAULT_SLOT,
+                 facility_files=None, radius_m=FACILITY_RADIUS_M, decay='none', spacing_m=EDGE_SAMPLE_SPACING_M):
+    """
+    Runs the whole pipeline and writes the scored node table and the edge weights.
+    facility_files ({count column: point csv}) recounts those facilities within radius_m
+    of every node instead of using the counts in facility_csv_file, and the recounted
+    table is written back to facility_csv_file so incremental runs start from it.
+    Node and edge scores take the population of the slot from floating_pop (a directory of
+    point grids or a raster file, see population_source). Edge weights use the safety
+    sampled every spacing_m meters along the edges, or the target node's safety when
+    spacing_m is 0. Returns the duration of each stage in seconds.
+    """
+    timings = {}
+    with stage(timings, 'load'):
+        nodes = load_facility_nodes(facility_csv_file)
+        edges = read_table(edges_csv_file, columns=['u', 'v', 'key', 'length'])
+    if facility_files:
+        with stage(timings, 'count_facilities'):
+            nodes = recount_facilities(nodes, facility_files, radius_m, decay)
+    with stage(timings, 'score_nodes'):
+        table = score_nodes(nodes, floating_pop, slot)
+    sampled = None
+    if spacing_m > 0:
+        with stage(timings, 'edge_safety'):
+            sampled = edge_safety(edges_csv_file, table, floating_pop, slot, spacing_m)
+    with stage(timings, 'edge_weights'):
+        weights = edge_weights(edges, table, sampled)
+    with stage(timings, 'write'):
+        if facility_files:
+            write_table(nodes.rename(columns={'y': '위도', 'x': '경도'}), facility_csv_file, NODE_COLUMN_TYPES)
+        write_table(table, nodes_out, NODE_COLUMN_TYPES)
+        write_table(weights, edges_out)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute node safety scores and edge weights.")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--slot', default=DEFAULT_SLOT, help="Floating population slot of the static score")
+    parser.add_argument('--nodes-out', default=None, help="Scored node table (default: the served node CSV)")
+    parser.add_argument('--edges-out', default=None, help="Edge weight table")
+    parser.add_argument('--facility', action='append', default=[], metavar='COLUMN=CSV',
+                        help="Recount a facility column from a point file, e.g. cctv_count=cctv.csv")
+    parser.add_argument('--radius-m', type=float, default=FACILITY_RADIUS_M)
+    parser.add_argument('--decay', choices=FACILITY_DECAYS, default='none')
+    parser.add_argument('--previous-facility', action='append', default=[], metavar='COLUMN=CSV',
+                        help="Previous version of a --facility file; re-scores only the nodes near changes")
+    parser.add_argument('--delta-out', default=None, help="Delta for running servers (incremental runs)")
+    parser.add_argument('--edge-spacing-m', type=float, default=EDGE_SAMPLE_SPACING_M,
+                        help="Spacing of the safety samples along edges (0: weights from the target node)")
+    args = parser.parse_args()
+
+    facility_files = {}
+    for spec in args.facility:
+        column, _, csv_file = spec.partition('=')
+        if not csv_file:
+            parser.error(f"--facility expects COLUMN=CSV, got {spec}")
+        facility_files[column] = csv_file
+
+    # Parquet conversions (see data_store) are used when they are up to date
+    facility_csv_file = prefer_columnar(os.path.join(args.data_dir, 'nodes_with_facility_counts.csv'))
+    edges_csv_file = prefer_columnar(os.path.join(args.data_dir, 'dalseo_edges_corrected.csv'))
+    nodes_out = args.nodes_out or prefer_columnar(os.path.join(args.data_dir, 'nodes_final_with_safety_score.csv'))
+    edges_out = args.edges_out or os.path.join(args.data_dir, 'edge_weights.csv')
+    floating_pop = population_source(os.path.join(args.data_dir, 'floating_pop'),
+                                     os.path.join(args.data_dir, 'floating_pop.npz'))
+
+    if args.previous_facility:
+        previous = dict(spec.partition('=')[::2] for spec in args.previous_facility)
+        missing = set(previous) - set(facility_files)
+        if missing:
+            parser.error(f"--previous-facility given without --facility for {', '.join(sorted(missing))}")
+        timings = run_incremental(facility_csv_file, nodes_out, edges_csv_file, edges_out,
+                                  args.delta_out or os.path.join(args.data_dir, 'safety_delta.json'),
+                                  {column: (previous[column], facility_files[column]) for column in previous},
+                                  radius_m=args.radius_m, decay=args.decay, floating_pop=floating_pop,
+                                  slot=args.slot, spacing_m=args.edge_spacing_m)
+        print(f"re-scored {timings.pop('affected_nodes')} nodes")
+        for name, seconds in timings.items():
+            print(f"{name:>16}: {seconds * 1000:8.1f} ms")
+        return
+
+    timings = run_pipeline(facility_csv_file, floating_pop, edges_csv_file, nodes_out, edges_out,
+                           slot=args.slot, facility_files=facility_files, radius_m=args.radius_m,
+                           decay=args.decay, spacing_m=args.edge_spacing_m)
+    for name, seconds in timings.items():
+        print(f"{name:>16}: {seconds * 1000:8.1f} ms")
+    print(f"{'total':>16}: {sum(timings.values()) * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Statistics of finished running sessions, computed from the recorded GPS trace.
+# Everything works on whole numpy arrays so multi-hour traces stay cheap.
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+# Below this speed a segment counts as standing still
+PAUSE_SPEED_MPS = 0.5
+# A gap between fixes longer than this is a pause, whatever the distance covered
+PAUSE_GAP_S = 30.0
+# Shorter stops are not reported as pauses (they still do not count as moving time)
+MIN_PAUSE_S = 10.0
+# Fixes farther than this from every graph node are left out of the safety score
+SAFETY_MATCH_RADIUS_M = 50.0
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters between coordinate arrays (degrees).
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _pace(minutes, km):
+    return round(minutes / km, 2) if km > 0 else 0
+
+
+def detect_pauses(t, paused):
+    """
+    Groups consecutive paused segments into pauses of at least MIN_PAUSE_S.
+    Returns a list of {"start", "end", "duration_s"} with epoch-second timestamps.
+    """
+    edges = np.diff(np.concatenate(([0], paused.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    durations = t[ends] - t[starts]
+    long_enough = durations >= MIN_PAUSE_S
+    return [{"start": float(t[s]), "end": float(t[e]), "duration_s": round(float(d), 1)}
+            for s, e, d in zip(starts[long_enough], ends[long_enough], durations[long_enough])]
+
+
+def trace_safety_score(G, lat, lon, weights):
+    """
+    Matches every fix to its nearest graph node and returns the weighted mean node safety
+    of the fixes within SAFETY_MATCH_RADIUS_M, or None when none of them match.
+    """
+    node_index = G.graph.get('node_index') if G is not None else None
+    arrays = G.graph.get('arrays') if G is not None else None
+    if node_index is None or arrays is None:
+        return None
+
+    tree, node_ids = node_index
+    _, nearest = tree.query(np.column_stack((lat, lon)))
+    node_pos = np.fromiter((arrays['node_pos'][node_ids[i]] for i in nearest), dtype=np.int64, count=len(nearest))
+
+    dist = haversine_m(lat, lon, arrays['lat'][node_pos], arrays['lon'][node_pos])
+    matched = dist <= SAFETY_MATCH_RADIUS_M
+    if not matched.any() or weights[matched].sum() == 0:
+        return None
+    return float(np.average(arrays['safety'][node_pos[matched]], weights=weights[matched]))
+
+
+def compute_session_stats(trace, G=None):
+    """
+    Computes the totals of a session from its (n, 3) trace of (timestamp, lat, lon):
+    elapsed and moving time, distance while moving, average and per-km split paces,
+    pauses, and the safety score of the nodes along the trace.
+    """
+    trace = np.asarray(trace, dtype=np.float64).reshape(-1, 3)
+    stats = {
+        "total_time_min": 0,
+        "moving_time_min": 0,
+        "average_pace_min_per_km": 0,
+        "actual_distance_km": 0,
+        "safety_score": 0,
+        "splits": [],
+        "pauses": []
+    }
+    if len(trace) < 2:
+        return stats
+
+    t, lat, lon = trace[:, 0], trace[:, 1], trace[:, 2]
+    dt = np.diff(t)
+    dist = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    speed = np.divide(dist, dt, out=np.zeros_like(dist), where=dt > 0)
+
+    paused = (speed < PAUSE_SPEED_MPS) | (dt > PAUSE_GAP_S)
+    moving_dt = np.where(paused, 0.0, dt)
+    moving_dist = np.where(paused, 0.0, dist)
+
+    distance_km = moving_dist.sum() / 1000
+    moving_min = moving_dt.sum() / 60
+
+    # Split paces: moving time at every full kilometer of moving distance
+    cum_dist = np.concatenate(([0.0], np.cumsum(moving_dist)))
+    cum_time = np.concatenate(([0.0], np.cumsum(moving_dt)))
+    marks = np.arange(1000.0, cum_dist[-1] + 1e-9, 1000.0)
+    split_times = np.diff(np.concatenate(([0.0], np.interp(marks, cum_dist, cum_time)))) / 60
+
+    # Each fix stands for half of the segments on either side of it
+    weights = np.concatenate(([0.0], dist)) / 2 + np.concatenate((dist, [0.0])) / 2
+    safety = trace_safety_score(G, lat, lon, weights)
+
+    stats.update({
+        "total_time_min": round((t[-1] - t[0]) / 60, 2),
+        "moving_time_min": round(moving_min, 2),
+        "average_pace_min_per_km": _pace(moving_min, distance_km),
+        "actual_distance_km": round(distance_km, 2),
+        "safety_score": round(safety, 2) if safety is not None else 0,
+        "splits": [{"km": i + 1, "pace_min_per_km": round(float(m), 2)} for i, m in enumerate(split_times)],
+        "pauses": detect_pauses(t, paused)
+    })
+    return stats
@@ -0,0 +1,478 @@
+# Storage backends for run_manager.
+# Every backend stores JSON-serializable records by (collection, key) and offers the same
+# get / put / put_many / update / delete / pin / unpin interface, so run_manager does not
+# depend on where data lives.
+
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def _record_size(value):
+    """Approximate memory cost of a record: the length of its compact JSON form."""
+    return len(json.dumps(value, separators=(',', ':'), default=float))
+
+
+class _Stripe:
+    """
+    One independently locked part of the in-memory store, with its own LRU order.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Evictable records in least-recently-used order: (collection, key) -> (value, expires_at, size)
+        self.lru = OrderedDict()
+        # Records that expire but are never evicted, same layout as lru
+        self.kept = {}
+        # Pinned and protected records: (collection, key) -> (value, size)
+        self.pinned = {}
+        self.bytes = 0
+        self.lru_bytes = 0
+
+    def remove(self, cache_key):
+        record = self.lru.pop(cache_key, None)
+        if record is not None:
+            self.bytes -= record[2]
+            self.lru_bytes -= record[2]
+            return
+        record = self.kept.pop(cache_key, None)
+        if record is not None:
+            self.bytes -= record[2]
+            return
+        record = self.pinned.pop(cache_key, None)
+        if record is not None:
+            self.bytes -= record[1]
+
+    def add_evictable(self, cache_key, record):
+        self.lru[cache_key] = record
+        self.bytes += record[2]
+        self.lru_bytes += record[2]
+
+    def evict_oldest(self):
+        _, (_, _, size) = self.lru.popitem(last=False)
+        self.bytes -= size
+        self.lru_bytes -= size
+
+
+class MemoryBackend:
+    """
+    Keeps records in process memory. Data is lost on restart and is not shared between workers.
+    Records expire after their collection's TTL, and once the estimated size of all records
+    passes max_bytes, least recently used ones are evicted. Pinned records and records of
+    protected collections are never expired or evicted; records of unevictable collections
+    expire but are never evicted. A record larger than max_bytes is rejected.
+
+    Records are spread over lock stripes by key, so threads working on different sessions or
+    routes rarely wait on each other. The byte budget covers all stripes together: when it
+    is exceeded, the least recently used record of the stripe holding the most evictable
+    bytes goes first.
+    """
+
+    def __init__(self, ttls=None, max_bytes=None, protected_collections=(), unevictable_collections=(),
+                 stripes=16):
+        self.ttls = dict(ttls or {})
+        self.max_bytes = max_bytes
+        self.protected_collections = set(protected_collections)
+        self.unevictable_collections = set(unevictable_collections)
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._sweeper = None
+
+    def _stripe(self, cache_key):
+        return self._stripes[hash(cache_key) % len(self._stripes)]
+
+    def _expires_at(self, collection, ttl):
+        ttl = self.ttls.get(collection) if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+    def _get(self, stripe, cache_key):
+        # Caller holds the stripe lock
+        record = stripe.pinned.get(cache_key)
+        if record is not None:
+            return record[0]
+
+        record = stripe.lru.get(cache_key) or stripe.kept.get(cache_key)
+        if record is None:
+            return None
+
+        value, expires_at, _ = record
+        if expires_at is not None and expires_at <= time.time():
+            stripe.remove(cache_key)
+            return None
+        if cache_key in stripe.lru:
+            stripe.lru.move_to_end(cache_key)
+        return value
+
+    def _store(self, stripe, cache_key, value, expires_at, size):
+        # Caller holds the stripe lock; places an unpinned record by its collection
+        if cache_key[0] in self.unevictable_collections:
+            stripe.kept[cache_key] = (value, expires_at, size)
+            stripe.bytes += size
+        else:
+            stripe.add_evictable(cache_key, (value, expires_at, size))
+
+    def _put(self, stripe, cache_key, value, ttl):
+        # Caller holds the stripe lock
+        collection = cache_key[0]
+        size = _record_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise ValueError(f"A {size} byte record does not fit the store's {self.max_bytes} byte budget")
+        pinned = cache_key in stripe.pinned or collection in self.protected_collections
+        stripe.remove(cache_key)
+        if pinned:
+            stripe.pinned[cache_key] = (value, size)
+            stripe.bytes += size
+        else:
+            self._store(stripe, cache_key, value, self._expires_at(collection, ttl), size)
+
+    def _enforce_budget(self, keep=None):
+        """
+        Evicts records until all stripes together fit max_bytes, never the record just
+        written (keep). Called without any stripe lock held, and takes one stripe lock at a
+        time, so it cannot deadlock with writers.
+        """
+        if self.max_bytes is None:
+            return
+        while sum(stripe.bytes for stripe in self._stripes) > self.max_bytes:
+            for stripe in sorted(self._stripes, key=lambda s: s.lru_bytes, reverse=True):
+                with stripe.lock:
+                    if keep in stripe.lru:
+                        stripe.lru.move_to_end(keep)
+                    if stripe.lru and next(iter(stripe.lru)) != keep:
+                        stripe.evict_oldest()
+                        break
+            else:
+                # Only pinned, unevictable and just-written records are left
+                return
+
+    def get(self, collection, key):
+        cache_key = (collection, key)
+        stripe = self._stripe(cache_key)
+        with stripe.lock:
+            return self._get(stripe, cache_key)
+
+    def put(self, collection, key, value, ttl=None):
+        """
+        Stores a record. ttl (seconds) overrides the collection default; 0 means no expiry.
+        A pinned record stays pinned when it is overwritten.
+        """
+        cache_key = (collection, key)
+        stripe = self._stripe(cache_key)
+        with stripe.lock:
+            self._put(stripe, cache_key, value, ttl)
+        self._enforce_budget(keep=cache_key)
+
+    def put_many(self, collection, items, ttl=None):
+        for key, value in items.items():
+            self.put(collection, key, value, ttl)
+
+    def update(self, collection, key, fn, ttl=None):
+        """
+        Atomically replaces a record with fn(value), where value is a shallow copy of the
+        stored record. Returns the new value, or None (without calling fn) if there is no record.
+        """
+        cache_key = (collection, key)
+        stripe = self._stripe(cache_key)
+        with stripe.lock:
+            value = self._get(stripe, cache_key)
+            if value is None:
+                return None
+            value = fn(copy.copy(value))
+            self._put(stripe, cache_key, value, ttl)
+        self._enforce_budget(keep=cache_key)
+        return value
+
+    def delete(self, collection, key):
+        cache_key = (collection, key)
+        stripe = self._stripe(cache_key)
+        with stripe.lock:
+            stripe.remove(cache_key)
+
+    def pin(self, collection, key):
+        """
+        Protects a record from expiry and eviction. Returns False if the record does not exist.
+        """
+        cache_key = (collection, key)
+        stripe = self._stripe(cache_key)
+        with stripe.lock:
+            if cache_key in stripe.pinned:
+                return True
+            if self._get(stripe, cache_key) is None:
+                return False
+            value, _, size = stripe.lru.get(cache_key) or stripe.kept[cache_key]
+            stripe.remove(cache_key)
+            stripe.pinned[cache_key] = (value, size)
+            stripe.bytes += size
+            return True
+
+    def unpin(self, collection, key, ttl=None):
+        """
+        Makes a pinned record evictable again, restarting its TTL.
+        """
+        cache_key = (collection, key)
+        stripe = self._stripe(cache_key)
+        with stripe.lock:
+            if collection in self.protected_collections or cache_key not in stripe.pinned:
+                return
+            value, size = stripe.pinned[cache_key]
+            stripe.remove(cache_key)
+            self._store(stripe, cache_key, value, self._expires_at(collection, ttl), size)
+        self._enforce_budget(keep=cache_key)
+
+    def purge_expired(self):
+        """
+        Removes expired records and enforces the byte budget. Returns the number of records removed.
+        Stripes are swept one at a time, so requests on other stripes are not blocked.
+        """
+        removed = 0
+        for stripe in self._stripes:
+            now = time.time()
+            with stripe.lock:
+                expired = [cache_key for records in (stripe.lru, stripe.kept)
+                           for cache_key, (_, expires_at, _) in records.items()
+                           if expires_at is not None and expires_at <= now]
+                for cache_key in expired:
+                    stripe.remove(cache_key)
+            removed += len(expired)
+        self._enforce_budget()
+        return removed
+
+    def start_sweeper(self, interval_s=60):
+        """
+        Starts a daemon thread that purges expired records every interval_s seconds,
+        so requests only pay for the cheap LRU bookkeeping.
+        """
+        if self._sweeper is not None:
+            return self._sweeper
+
+        def sweep():
+            while True:
+                time.sleep(interval_s)
+                self.purge_expired()
+
+        self._sweeper = threading.Thread(target=sweep, name='run-store-sweeper', daemon=True)
+        self._sweeper.start()
+        return self._sweeper
+
+    def stats(self):
+        """Returns the number of stored records and their estimated size in bytes."""
+        records = pinned = size = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                records += len(stripe.lru) + len(stripe.kept) + len(stripe.pinned)
+                pinned += len(stripe.pinned)
+                size += stripe.bytes
+        return {"records": records, "pinned": pinned, "bytes": size}
+
+
+class SQLiteBackend:
+    """
+    Stores records in a SQLite database in WAL mode, so every worker process sees the same data
+    and it survives restarts. Records in collections with a TTL expire and are purged periodically.
+
+    A small per-process LRU of recently used objects sits in front of the database, for the
+    cached_collections only: other workers' writes never reach it, so it may only hold records
+    whose content does not change once written (content-addressed routes, trace chunks).
+    A cached record that looks expired is read again, since another worker may have pinned it.
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS records (
+            collection TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL,
+            PRIMARY KEY (collection, key)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS records_expires_at ON records (expires_at) WHERE expires_at IS NOT NULL",
+    )
+
+    # Statements are kept as constants so sqlite3's per-connection statement cache reuses them
+    SELECT_SQL = "SELECT value, expires_at FROM records WHERE collection = ? AND key = ?"
+    # Pinned rows (expires_at NULL) stay pinned when they are overwritten
+    UPSERT_SQL = ("INSERT INTO records (collection, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                  "ON CONFLICT (collection, key) DO UPDATE SET value = excluded.value, "
+                  "expires_at = CASE WHEN records.expires_at IS NULL THEN NULL ELSE excluded.expires_at END")
+    DELETE_SQL = "DELETE FROM records WHERE collection = ? AND key = ?"
+    SET_EXPIRY_SQL = "UPDATE records SET expires_at = ? WHERE collection = ? AND key = ?"
+    PURGE_SQL = "DELETE FROM records WHERE expires_at IS NOT NULL AND expires_at <= ?"
+
+    # Expired rows are purged after this many writes
+    PURGE_EVERY_WRITES = 1000
+
+    def __init__(self, path, ttls=None, hot_cache_size=1024, cached_collections=()):
+        self.path = path
+        self.ttls = dict(ttls or {})
+        self.hot_cache_size = hot_cache_size
+        self.cached_collections = set(cached_collections)
+        self._local = threading.local()
+        self._hot = OrderedDict()
+        self._hot_lock = threading.Lock()
+        self._writes = 0
+
+        with self._connection() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads, so each thread opens its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _expires_at(self, collection, ttl):
+        ttl = self.ttls.get(collection) if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+    def _cache(self, collection, key, value, expires_at):
+        if collection not in self.cached_collections:
+            return
+        with self._hot_lock:
+            self._hot[(collection, key)] = (value, expires_at)
+            self._hot.move_to_end((collection, key))
+            while len(self._hot) > self.hot_cache_size:
+                self._hot.popitem(last=False)
+
+    def _after_writes(self, count):
+        self._writes += count
+        if self._writes >= self.PURGE_EVERY_WRITES:
+            self._writes = 0
+            self.purge_expired()
+
+    def get(self, collection, key):
+        now = time.time()
+        record = None
+        if collection in self.cached_collections:
+            with self._hot_lock:
+                record = self._hot.get((collection, key))
+                if record is not None:
+                    if record[1] is not None and record[1] <= now:
+                        # The expiry may have been cleared by another worker since it was cached
+                        del self._hot[(collection, key)]
+                        record = None
+                    else:
+                        self._hot.move_to_end((collection, key))
+
+        if record is None:
+            row = self._connection().execute(self.SELECT_SQL, (collection, key)).fetchone()
+            if row is None:
+                return None
+            record = (json.loads(row[0]), row[1])
+            self._cache(collection, key, *record)
+
+        value, expires_at = record
+        if expires_at is not None and expires_at <= now:
+            self.delete(collection, key)
+            return None
+        return value
+
+    def put(self, collection, key, value, ttl=None):
+        """
+        Stores a record. ttl (seconds) overrides the collection default; 0 means no expiry.
+        """
+        self.put_many(collection, {key: value}, ttl)
+
+    def put_many(self, collection, items, ttl=None):
+        """
+        Stores several records of one collection in a single transaction.
+        """
+        expires_at = self._expires_at(collection, ttl)
+        rows = [(collection, key, json.dumps(value, separators=(',', ':'), default=float), expires_at)
+                for key, value in items.items()]
+
+        with self._connection() as conn:
+            conn.executemany(self.UPSERT_SQL, rows)
+        # The stored expiry may differ from ours for pinned rows, so the next read refreshes the cache
+        with self._hot_lock:
+            for key in items:
+                self._hot.pop((collection, key), None)
+        self._after_writes(len(rows))
+
+    def update(self, collection, key, fn, ttl=None):
+        """
+        Atomically replaces a record with fn(value) inside one write transaction.
+        Returns the new value, or None (without calling fn) if there is no live record.
+        """
+        conn = self._connection()
+        with conn:
+            # BEGIN IMMEDIATE takes the write lock before reading, so no other writer can interleave
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(self.SELECT_SQL, (collection, key)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= time.time()):
+                return None
+            value = fn(json.loads(row[0]))
+            conn.execute(self.UPSERT_SQL, (collection, key, json.dumps(value, separators=(',', ':'), default=float),
+                                           self._expires_at(collection, ttl)))
+        with self._hot_lock:
+            self._hot.pop((collection, key), None)
+        return value
+
+    def delete(self, collection, key):
+        with self._hot_lock:
+            self._hot.pop((collection, key), None)
+        with self._connection() as conn:
+            conn.execute(self.DELETE_SQL, (collection, key))
+
+    def _set_expiry(self, collection, key, expires_at):
+        value = self.get(collection, key)
+        if value is None:
+            return False
+        with self._connection() as conn:
+            conn.execute(self.SET_EXPIRY_SQL, (expires_at, collection, key))
+        self._cache(collection, key, value, expires_at)
+        return True
+
+    def pin(self, collection, key):
+        """
+        Clears a record's expiry. Returns False if the record does not exist.
+        """
+        return self._set_expiry(collection, key, None)
+
+    def unpin(self, collection, key, ttl=None):
+        """
+        Restarts a record's TTL.
+        """
+        self._set_expiry(collection, key, self._expires_at(collection, ttl))
+
+    def purge_expired(self):
+        """
+        Deletes expired records. Returns the number of rows removed.
+        """
+        now = time.time()
+        with self._hot_lock:
+            for cache_key in [k for k, (_, expires_at) in self._hot.items()
+                              if expires_at is not None and expires_at <= now]:
+                del self._hot[cache_key]
+        with self._connection() as conn:
+            return conn.execute(self.PURGE_SQL, (now,)).rowcount
+
+
+def create_backend(kind=None, path=None, ttls=None, max_bytes=None, protected_collections=(),
+                   immutable_collections=(), unevictable_collections=()):
+    """
+    Creates the storage backend named by kind ('memory' or 'sqlite').
+    Defaults come from the RUN_STORE_BACKEND, RUN_STORE_PATH and RUN_STORE_MAX_BYTES
+    environment variables. immutable_collections hold records never changed after being
+    written; only those are cached in the SQLite backend's per-process LRU.
+    unevictable_collections expire but are never evicted by the memory backend's byte budget.
+    """
+    kind = kind or os.environ.get('RUN_STORE_BACKEND', 'memory')
+    if kind == 'memory':
+        if max_bytes is None and os.environ.get('RUN_STORE_MAX_BYTES'):
+            max_bytes = int(os.environ['RUN_STORE_MAX_BYTES'])
+        return MemoryBackend(ttls=ttls, max_bytes=max_bytes, protected_collections=protected_collections,
+                             unevictable_collections=unevictable_collections)
+    if kind == 'sqlite':
+        path = path or os.environ.get('RUN_STORE_PATH', os.path.join('data', 'run_store.sqlite3'))
+        return SQLiteBackend(path, ttls=ttls, cached_collections=immutable_collections)
+    raise ValueError(f"Unknown run store backend: {kind}")
@@ -0,0 +1,311 @@
+# GPS trace ingestion for running sessions.
+# Fixes are appended to compact per-session numpy buffers, thinned on the fly when they are
+# denser than needed, and written to the run store in bulk by a write-behind thread.
+
+import base64
+import itertools
+import threading
+import time
+import uuid
+import numpy as np
+
+# Fixes closer than this to the last kept one (and within TRACE_MAX_GAP_S of it) are dropped
+TRACE_MIN_SPACING_M = 3.0
+# A fix is always kept once this much time has passed, so pauses still show up in the trace
+TRACE_MAX_GAP_S = 5.0
+# How often the write-behind thread flushes new points to the store
+TRACE_FLUSH_INTERVAL_S = 5.0
+# Buffers of sessions without new fixes for this long (run_manager's session TTL) are released
+# once flushed, so abandoned sessions do not stay in memory; the trace remains in the store
+TRACE_BUFFER_IDLE_S = 12 * 60 * 60
+
+EARTH_RADIUS_M = 6371008.8
+
+_store = None
+_buffers = {}
+_dirty = set()
+# Guards only _buffers and _dirty; each buffer has its own lock for its points
+_lock = threading.Lock()
+# Serializes flushes, so chunk metadata is never written out of order
+_flush_lock = threading.Lock()
+_flusher = None
+# Called with the session ID of every released idle buffer (see on_release)
+_release_listeners = []
+
+# Chunk keys are "<session>:<worker>:<n>": every process numbers its own chunks, so
+# workers flushing the same session never write to the same key
+WORKER_ID = uuid.uuid4().hex[:12]
+_chunk_numbers = itertools.count()
+
+
+def set_store(backend):
+    """Sets the storage backend traces are flushed to (the run_manager store)."""
+    global _store
+    _store = backend
+
+
+def on_release(listener):
+    """Registers a function called with the session ID whenever an idle buffer is released."""
+    _release_listeners.append(listener)
+
+
+class TraceBuffer:
+    """
+    Growable (time, lat, lon) buffer for one session.
+    Also keeps the state of the thinning filter so it continues across batches.
+    """
+
+    def __init__(self, capacity=256):
+        self.lock = threading.Lock()
+        self.data = np.empty((capacity, 3), dtype=np.float64)
+        self.size = 0
+        self.flushed = 0
+        self.touched = time.monotonic()
+        # Set when the buffer is released; writers then start over with a fresh buffer
+        self.released = False
+
+    def append(self, fixes):
+        needed = self.size + len(fixes)
+        if needed > len(self.data):
+            grown = np.empty((max(needed, 2 * len(self.data)), 3), dtype=np.float64)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:needed] = fixes
+        self.size = needed
+
+    def view(self):
+        return self.data[:self.size]
+
+
+def parse_fixes(raw_fixes):
+    """
+    Converts fixes sent by a client to an (n, 3) float array of (timestamp, lat, lon).
+    Each fix is either [timestamp, lat, lon] or {"timestamp": ..., "lat": ..., "lon": ...},
+    with timestamps in seconds since the epoch. Raises ValueError on malformed input.
+    """
+    if not isinstance(raw_fixes, list):
+        raise ValueError("fixes must be a list")
+
+    try:
+        rows = [(f['timestamp'], f['lat'], f['lon']) if isinstance(f, dict) else tuple(f) for f in raw_fixes]
+        fixes = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Each fix must be [timestamp, lat, lon] or an object with timestamp, lat and lon")
+
+    if not np.isfinite(fixes).all():
+        raise ValueError("Fixes must contain finite numbers")
+    if (np.abs(fixes[:, 1]) > 90).any() or (np.abs(fixes[:, 2]) > 180).any():
+        raise ValueError("Fix coordinates are out of range")
+    return fixes
+
+
+def _thin(fixes, last_fix):
+    """
+    Drops fixes that add little to the trace: those within TRACE_MIN_SPACING_M and
+    TRACE_MAX_GAP_S of the previous kept fix. Works on the whole batch at once by
+    bucketing cumulative distance and time, so the result is close to a greedy filter.
+    """
+    fixes = fixes[np.argsort(fixes[:, 0], kind='stable')]
+    if last_fix is not None:
+        fixes = fixes[fixes[:, 0] > last_fix[0]]
+        points = np.vstack((last_fix, fixes))
+    else:
+        points = fixes
+    if len(fixes) == 0:
+        return fixes
+
+    lat = np.radians(points[:, 1])
+    lon = np.radians(points[:, 2])
+    dx = np.diff(lon) * np.cos((lat[1:] + lat[:-1]) / 2)
+    dy = np.diff(lat)
+    step = EARTH_RADIUS_M * np.hypot(dx, dy)
+    cum_dist = np.concatenate(([0.0], np.cumsum(step)))
+    elapsed = points[:, 0] - points[0, 0]
+
+    dist_bucket = np.floor(cum_dist / TRACE_MIN_SPACING_M)
+    time_bucket = np.floor(elapsed / TRACE_MAX_GAP_S)
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = (np.diff(dist_bucket) > 0) | (np.diff(time_bucket) > 0)
+
+    if last_fix is not None:
+        keep = keep[1:]
+    return fixes[keep]
+
+
+def ingest_fixes(session_id, fixes):
+    """
+    Appends a batch of fixes (as returned by parse_fixes) to a session's trace.
+    Returns the fixes kept after thinning. Raises LookupError if the stored trace is incomplete.
+    """
+    while True:
+        buffer = _get_buffer(session_id)
+        with buffer.lock:
+            if buffer.released:
+                # Released by the flusher meanwhile; reload it from the store
+                continue
+            last_fix = buffer.data[buffer.size - 1] if buffer.size else None
+            kept = _thin(fixes, last_fix)
+            if len(kept):
+                buffer.append(kept)
+            buffer.touched = time.monotonic()
+            break
+    if len(kept):
+        with _lock:
+            _dirty.add(session_id)
+
+    _ensure_flusher()
+    return kept
+
+
+def _get_buffer(session_id):
+    with _lock:
+        buffer = _buffers.get(session_id)
+    if buffer is not None:
+        return buffer
+
+    # Loading from the store happens outside the global lock; the first loader wins
+    loaded = _load_buffer(session_id)
+    with _lock:
+        return _buffers.setdefault(session_id, loaded)
+
+
+def last_fix(session_id):
+    """Returns the most recent (timestamp, lat, lon) of a session, or None."""
+    with _lock:
+        buffer = _buffers.get(session_id)
+    if buffer is None:
+        return None
+    with buffer.lock:
+        if buffer.size == 0:
+            return None
+        return buffer.data[buffer.size - 1].tolist()
+
+
+def get_trace(session_id):
+    """
+    Returns a session's full trace as an (n, 3) array of (timestamp, lat, lon),
+    including points that have not been flushed yet.
+    """
+    with _lock:
+        buffer = _buffers.get(session_id)
+    if buffer is None:
+        return _load_buffer(session_id).view().copy()
+    with buffer.lock:
+        return buffer.view().copy()
+
+
+def _encode_points(points):
+    return base64.b64encode(np.ascontiguousarray(points, dtype='<f8').tobytes()).decode('ascii')
+
+
+def _decode_points(encoded):
+    return np.frombuffer(base64.b64decode(encoded), dtype='<f8').reshape(-1, 3)
+
+
+def _load_buffer(session_id):
+    """
+    Rebuilds a session's buffer from the chunks already flushed to the store, in time order.
+    Raises LookupError if a chunk listed in the session's metadata is missing.
+    """
+    buffer = TraceBuffer()
+    meta = _store.get("trace_meta", session_id) if _store is not None else None
+    if meta:
+        for key in meta['chunks']:
+            encoded = _store.get("trace_chunks", key)
+            if encoded is None:
+                raise LookupError(f"Trace chunk {key} of session {session_id} is missing")
+            buffer.append(_decode_points(encoded))
+        # Chunks flushed by different workers may overlap in time
+        buffer.data[:buffer.size] = buffer.view()[np.argsort(buffer.view()[:, 0], kind='stable')]
+        buffer.flushed = buffer.size
+    return buffer
+
+
+def flush_traces():
+    """
+    Writes the points added since the last flush to the store: one new chunk per dirty
+    session, all chunks written as one batched put, then appended to each session's metadata.
+    Afterwards, buffers idle for TRACE_BUFFER_IDLE_S with nothing left to flush are released.
+    Returns the number of sessions flushed.
+    """
+    if _store is None:
+        return 0
+
+    with _flush_lock:
+        flushed = _flush()
+    _release_idle()
+    return flushed
+
+
+def _flush():
+    with _lock:
+        dirty = [(session_id, _buffers[session_id]) for session_id in _dirty if session_id in _buffers]
+        _dirty.clear()
+
+    chunks, added = {}, {}
+    for session_id, buffer in dirty:
+        with buffer.lock:
+            if buffer.size == buffer.flushed:
+                continue
+            key = f"{session_id}:{WORKER_ID}:{next(_chunk_numbers)}"
+            chunks[key] = _encode_points(buffer.data[buffer.flushed:buffer.size])
+            added[session_id] = (key, buffer.size - buffer.flushed)
+            buffer.flushed = buffer.size
+
+    if not chunks:
+        return 0
+    # Chunks go first, so metadata never lists a chunk that is not stored yet
+    _store.put_many("trace_chunks", chunks)
+    for session_id, (key, points) in added.items():
+        def append_chunk(meta):
+            return {"chunks": meta['chunks'] + [key], "points": meta['points'] + points}
+
+        if _store.update("trace_meta", session_id, append_chunk) is None:
+            _store.put("trace_meta", session_id, {"chunks": [key], "points": points})
+    return len(added)
+
+
+def _release_idle():
+    """Releases the flushed buffers of sessions that received no fixes for TRACE_BUFFER_IDLE_S."""
+    cutoff = time.monotonic() - TRACE_BUFFER_IDLE_S
+    released = []
+    with _lock:
+        for session_id, buffer in list(_buffers.items()):
+            if session_id in _dirty or buffer.touched > cutoff:
+                continue
+            with buffer.lock:
+                if buffer.size != buffer.flushed or buffer.touched > cutoff:
+                    continue
+                buffer.released = True
+            del _buffers[session_id]
+            released.append(session_id)
+    for session_id in released:
+        for listener in _release_listeners:
+            listener(session_id)
+    return len(released)
+
+
+def drop_buffer(session_id):
+    """Flushes and releases the in-memory buffer of a session that has finished."""
+    flush_traces()
+    with _lock:
+        _buffers.pop(session_id, None)
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(TRACE_FLUSH_INTERVAL_S)
+            try:
+                flush_traces()
+            except Exception as e:
+                print(f"Trace flush failed: {e}")
+
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=run, name='trace-flusher', daemon=True)
+            _flusher.start()
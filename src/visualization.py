@@ -1,13 +1,159 @@
 import folium
 import json
+import hashlib
+from html import escape as html_escape
+import threading
+from collections import OrderedDict
+
+# Number of rendered map pages kept in memory, keyed by route content hash
+MAP_CACHE_SIZE = 256
+
+_MAP_CACHE = OrderedDict()
+_MAP_CACHE_LOCK = threading.Lock()
+
+ROUTE_COLORS = {
+    'safe': 'green',
+    'shortest': 'yellow',
+    'balanced': 'orange'
+}
+
+# Route fields sent to the map page; everything else in a stored route is left out
+MAP_ROUTE_FIELDS = ('type', 'distance_km', 'safety_score', 'estimated_time_min', 'pace_min_per_km', 'waypoints',
+                    'geometry')
+
+# Static map page shell. Only the route data is injected at the placeholder;
+# when it is null the page loads the routes from the URL in data-route-url instead.
+MAP_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"/>
+<script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+<style>html, body, #map { width: 100%; height: 100%; margin: 0; padding: 0; }</style>
+</head>
+<body>
+<div id="map" data-route-url="__ROUTE_URL__"></div>
+<script>
+var COLORS = __ROUTE_COLORS__;
+var DATA = __ROUTE_DATA__;
+
+function draw(data) {
+  var routes = data.routes || [];
+  if (!routes.length) { return; }
+  var start = routes[0].waypoints[0];
+  var map = L.map('map').setView(start, 13);
+  L.tileLayer('https://{s}.basemaps.cartocdn.com/dark_all/{z}/{x}/{y}{r}.png', {
+    attribution: '&copy; OpenStreetMap contributors &copy; CARTO', maxZoom: 20
+  }).addTo(map);
+  routes.forEach(function (r) {
+    var label = r.type.charAt(0).toUpperCase() + r.type.slice(1);
+    L.polyline(r.geometry || r.waypoints, {color: COLORS[r.type] || 'gray', weight: 6, opacity: 0.8})
+      .bindTooltip('<b>경로 종류: ' + label + '</b><br>거리: ' + r.distance_km + ' km<br>' +
+                   '안전 점수: ' + r.safety_score + '점' +
+                   (r.estimated_time_min != null ? '<br>예상 시간: ' + r.estimated_time_min + ' 분<br>' +
+                    '페이스: ' + r.pace_min_per_km + ' 분/km' : ''))
+      .addTo(map);
+  });
+  L.circleMarker(start, {radius: 8, color: 'red', fillOpacity: 1}).bindTooltip('출발/도착 지점').addTo(map);
+}
+
+if (DATA) {
+  draw(DATA);
+} else {
+  fetch(document.getElementById('map').dataset.routeUrl)
+    .then(function (res) { return res.json(); })
+    .then(function (route) { draw({routes: [route]}); });
+}
+</script>
+</body>
+</html>
+"""
+
+# Split the shell once at import so rendering is plain string concatenation
+_TEMPLATE_HEAD, _TEMPLATE_TAIL = MAP_TEMPLATE.replace(
+    '__ROUTE_COLORS__', json.dumps(ROUTE_COLORS, sort_keys=True, separators=(',', ':'))
+).split('__ROUTE_DATA__')
+
+def _script_json(value):
+    """
+    Serializes a value as compact JSON that is safe to embed inside a <script> tag.
+    """
+    payload = json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=float)
+    return payload.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
+def render_template_html(api_response, route_url=''):
+    """
+    Renders the static map shell with the route data injected as compact JSON.
+    The output only depends on the route content, so it is byte-identical for equal routes.
+    When api_response is None the page fetches its route from route_url instead.
+    """
+    data = None
+    if api_response is not None:
+        routes = [{key: route[key] for key in MAP_ROUTE_FIELDS if key in route}
+                  for route in api_response.get('routes', [])]
+        data = {"routes": routes}
+
+    head = _TEMPLATE_HEAD.replace('__ROUTE_URL__', html_escape(route_url, quote=True))
+    return head + _script_json(data) + _TEMPLATE_TAIL
+
+def route_content_hash(route):
+    """
+    Returns a stable hash of a route's content, used as the map cache key.
+    """
+    payload = json.dumps(route, sort_keys=True, separators=(',', ':'), default=float)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def render_route_map(route, renderer='template'):
+    """
+    Renders the map page for a single stored route, reusing the cached HTML
+    when a route with the same content has been rendered before.
+    The 'folium' renderer builds a full Folium map and is kept for debugging.
+    Returns a tuple of (html, content_hash).
+    """
+    if renderer not in ('template', 'folium'):
+        raise ValueError(f"Unknown map renderer: {renderer}")
+
+    content_hash = route_content_hash(route)
+    if renderer == 'folium':
+        content_hash = 'folium-' + content_hash
+
+    with _MAP_CACHE_LOCK:
+        html = _MAP_CACHE.get(content_hash)
+        if html is not None:
+            _MAP_CACHE.move_to_end(content_hash)
+            return html, content_hash
+
+    if renderer == 'folium':
+        html = render_visualization_html({"routes": [route]})
+    else:
+        html = render_template_html({"routes": [route]})
+
+    with _MAP_CACHE_LOCK:
+        _MAP_CACHE[content_hash] = html
+        while len(_MAP_CACHE) > MAP_CACHE_SIZE:
+            _MAP_CACHE.popitem(last=False)
+    return html, content_hash
 
 def create_visualization(api_response, output_html_file):
     """
     Creates an HTML file with a Folium map to visualize the paths based on API response data.
     """
+    html = render_visualization_html(api_response)
+    if html is None:
+        return
+
+    with open(output_html_file, 'w', encoding='utf-8') as f:
+        f.write(html)
+    print(f"HTML 지도 파일 '{output_html_file}'이(가) 성공적으로 생성되었습니다.")
+
+def render_visualization_html(api_response):
+    """
+    Builds a Folium map for the paths in the API response data and returns it as an HTML string.
+    """
     if not api_response.get('routes'):
         print("시각화할 경로가 없습니다.")
-        return
+        return None
 
     # Set map center based on the starting point of the first route
     first_route = api_response['routes'][0]
@@ -16,32 +162,28 @@ def create_visualization(api_response, output_html_file):
     # Create a Folium map with a darker base map for better visibility
     m = folium.Map(location=start_point, zoom_start=13, tiles="CartoDB dark_matter")
 
-    colors = {
-        'safe': 'green',
-        'shortest': 'yellow',
-        'balanced': 'orange'
-    }
-
     # Plot each path with a tooltip
     for route in api_response['routes']:
         path_type = route['type']
-        waypoints = route['waypoints']
+        waypoints = route.get('geometry') or route['waypoints']
         distance = route['distance_km']
         safety_score = route['safety_score']
-        estimated_time = route['estimated_time_min']
-        pace = route['pace_min_per_km']
+        estimated_time = route.get('estimated_time_min')
+        pace = route.get('pace_min_per_km')
 
         tooltip_html = f"""
         <b>경로 종류: {path_type.capitalize()}</b><br>
         거리: {distance} km<br>
-        안전 점수: {safety_score}점<br>
-        예상 시간: {estimated_time} 분<br>
-        페이스: {pace} 분/km
+        안전 점수: {safety_score}점
         """
+        # Stored routes carry no pace; only a recommendation response has time estimates
+        if estimated_time is not None:
+            tooltip_html += f"<br>예상 시간: {estimated_time} 분<br>페이스: {pace} 분/km"
+
 
         folium.PolyLine(
             waypoints,
-            color=colors.get(path_type, 'gray'),
+            color=ROUTE_COLORS.get(path_type, 'gray'),
             weight=6,
             opacity=0.8,
             tooltip=tooltip_html,
@@ -54,5 +196,4 @@ def create_visualization(api_response, output_html_file):
         icon=folium.Icon(color='red', icon='play', prefix='fa')
     ).add_to(m)
 
-    m.save(output_html_file)
-    print(f"HTML 지도 파일 '{output_html_file}'이(가) 성공적으로 생성되었습니다.")
+    return m.get_root().render()
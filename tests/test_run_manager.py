@@ -0,0 +1,71 @@
+# Lifetime of run records: sessions on crew routes are kept while running and expire once finished.
+
+import os
+import time
+
+import networkx as nx
+import pytest
+
+import run_manager
+from path_service import apply_safety_delta, create_pathfinding_model, format_route_data, scores_version
+from storage import MemoryBackend, SQLiteBackend
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'data')
+
+SESSION_TTL_S = 0.2
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    ttls = dict(run_manager.COLLECTION_TTLS, sessions=SESSION_TTL_S)
+    if request.param == 'memory':
+        backend = MemoryBackend(ttls=ttls, protected_collections=run_manager.PROTECTED_COLLECTIONS)
+    else:
+        backend = SQLiteBackend(str(tmp_path / 'run_store.sqlite3'), ttls=ttls)
+    previous = run_manager._backend
+    run_manager.configure_store(backend)
+    yield backend
+    run_manager.configure_store(previous)
+
+
+def test_finished_crew_session_expires(store):
+    route = {"type": "safe", "distance_km": 1.0, "safety_score": 50.0, "min_safety_score": 40.0,
+             "worst_stretch": None, "km_markers": [], "waypoints": [[35.83, 128.53], [35.84, 128.54]]}
+    route_id = run_manager.store_routes([route])['safe']
+    run_manager.select_route_for_crew(route_id, 'crew-1')
+    session_id = run_manager.start_running_session(route_id, 6.0)['session_id']
+
+    time.sleep(SESSION_TTL_S * 2)
+    assert run_manager.get_running_session(session_id) is not None, "running crew session expired"
+
+    assert run_manager.finish_running_session(session_id) is not None
+    time.sleep(SESSION_TTL_S * 2)
+    assert store.get("sessions", session_id) is None, "finished crew session never expires"
+
+
+def test_stored_route_follows_safety_delta(store):
+    G = create_pathfinding_model(os.path.join(DATA_DIR, 'dalseo_real_graph.graphml'),
+                                 os.path.join(DATA_DIR, 'nodes_final_with_safety_score.csv'))
+    G.graph['model_version'] = 1
+    run_manager.configure_route_scoring(lambda: G)
+    try:
+        nodes = list(G.nodes)
+        path = nx.shortest_path(G, nodes[0], nodes[200], weight='length')
+        route = format_route_data(G, {"safe": path})['routes'][0]
+        route_id = run_manager.store_routes([route], scores_version(G))['safe']
+
+        # Darken the middle of the route on a running server
+        max_safety_score = G.graph['max_safety_score']
+        apply_safety_delta(G, {"max_safety_score": max_safety_score, "nodes": {
+            node_id: {"safety_score": 0.0} for node_id in path[1:-1]}})
+        rescored = format_route_data(G, {"safe": path})['routes'][0]
+        assert rescored['safety_score'] < route['safety_score']
+
+        stored = run_manager.get_route(route_id)
+        for field in run_manager.ROUTE_SCORE_FIELDS:
+            assert stored[field] == rescored[field], field
+        assert stored['scores_version'] == scores_version(G)
+        favorite = run_manager.add_favorite(route_id, 'evening loop')
+        assert favorite['safety_score'] == rescored['safety_score']
+    finally:
+        run_manager.configure_route_scoring(None)
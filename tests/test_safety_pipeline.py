@@ -0,0 +1,110 @@
+# An incremental run must leave the same tables as a full run over the new facility data.
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_store import read_table
+from path_service import apply_safety_delta, create_pathfinding_model
+from safety_pipeline import EDGE_SAMPLE_SPACING_M, count_facilities, run_incremental, run_pipeline
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'data')
+FACILITY_CSV_FILE = os.path.join(DATA_DIR, 'nodes_with_facility_counts.csv')
+EDGES_CSV_FILE = os.path.join(DATA_DIR, 'dalseo_edges_corrected.csv')
+GRAPH_FILE = os.path.join(DATA_DIR, 'dalseo_real_graph.graphml')
+FLOATING_POP_DIR = os.path.join(DATA_DIR, 'floating_pop')
+
+
+@pytest.fixture
+def cctv_files(tmp_path):
+    """
+    An old CCTV point file near the nodes and two new versions: 'local' moves, removes and
+    adds cameras away from the busiest node, so only nearby nodes are re-scored, and
+    'rescale' also changes the busiest area, which moves the count maximum.
+    """
+    nodes = pd.read_csv(FACILITY_CSV_FILE)
+    coords = np.column_stack((nodes['위도'].to_numpy(), nodes['경도'].to_numpy()))
+    rng = np.random.default_rng(0)
+    old = coords[rng.choice(len(nodes), 300, replace=False)] + rng.normal(0, 3e-4, (300, 2))
+
+    busiest = coords[np.argmax(count_facilities(coords, old))]
+    far = np.flatnonzero(np.hypot(*(old - busiest).T) > 3e-3)
+    local = old.copy()
+    local[far[:20]] += 5e-4
+    local = np.vstack((np.delete(local, far[20:30], axis=0), old[far[30:35]] + 2e-4))
+
+    rescale = old.copy()
+    rescale[:20] += 5e-4
+    rescale = np.vstack((rescale[:-10], old[:10] + 2e-4))
+
+    files = {}
+    for name, points in (('old', old), ('local', local), ('rescale', rescale)):
+        files[name] = str(tmp_path / f'cctv_{name}.csv')
+        pd.DataFrame({'lat': points[:, 0], 'lon': points[:, 1]}).to_csv(files[name], index=False)
+    return files
+
+
+def full_run(run_dir, cctv_csv, spacing_m):
+    run_dir.mkdir()
+    shutil.copy(FACILITY_CSV_FILE, run_dir)
+    run_pipeline(str(run_dir / 'nodes_with_facility_counts.csv'), FLOATING_POP_DIR, EDGES_CSV_FILE,
+                 str(run_dir / 'nodes.csv'), str(run_dir / 'edges.csv'),
+                 facility_files={'cctv_count': cctv_csv}, spacing_m=spacing_m)
+    return run_dir
+
+
+@pytest.mark.parametrize('change, rescaled', [('local', False), ('rescale', True)])
+@pytest.mark.parametrize('spacing_m', [0, EDGE_SAMPLE_SPACING_M])
+def test_incremental_run_matches_full_run(tmp_path, cctv_files, spacing_m, change, rescaled):
+    incremental = full_run(tmp_path / 'incremental', cctv_files['old'], spacing_m)
+    run_incremental(str(incremental / 'nodes_with_facility_counts.csv'), str(incremental / 'nodes.csv'),
+                    EDGES_CSV_FILE, str(incremental / 'edges.csv'), str(incremental / 'delta.json'),
+                    {'cctv_count': (cctv_files['old'], cctv_files[change])},
+                    floating_pop=FLOATING_POP_DIR, spacing_m=spacing_m)
+    full = full_run(tmp_path / 'full', cctv_files[change], spacing_m)
+
+    with open(incremental / 'delta.json') as f:
+        assert json.load(f)['full'] == rescaled
+
+    for name in ('nodes_with_facility_counts.csv', 'nodes.csv', 'edges.csv'):
+        pd.testing.assert_frame_equal(read_table(str(incremental / name)), read_table(str(full / name)),
+                                      check_exact=False, rtol=1e-9, atol=1e-12)
+
+
+def test_incremental_run_refuses_counts_of_other_files(tmp_path, cctv_files):
+    # The committed counts were not made from these point files
+    shutil.copy(FACILITY_CSV_FILE, tmp_path)
+    shutil.copy(os.path.join(DATA_DIR, 'nodes_final_with_safety_score.csv'), tmp_path)
+    with pytest.raises(ValueError, match='run the full pipeline'):
+        run_incremental(str(tmp_path / 'nodes_with_facility_counts.csv'),
+                        str(tmp_path / 'nodes_final_with_safety_score.csv'), EDGES_CSV_FILE,
+                        str(tmp_path / 'edges.csv'), str(tmp_path / 'delta.json'),
+                        {'cctv_count': (cctv_files['old'], cctv_files['local'])}, spacing_m=0)
+
+
+@pytest.mark.parametrize('change', ['local', 'rescale'])
+def test_delta_gives_the_weights_of_a_reloaded_model(tmp_path, cctv_files, change):
+    # A server with edge-level weights applies the delta instead of reloading the new tables
+    run = full_run(tmp_path / 'run', cctv_files['old'], EDGE_SAMPLE_SPACING_M)
+    served = create_pathfinding_model(GRAPH_FILE, str(run / 'nodes.csv'), edge_weights_file=str(run / 'edges.csv'))
+    run_incremental(str(run / 'nodes_with_facility_counts.csv'), str(run / 'nodes.csv'), EDGES_CSV_FILE,
+                    str(run / 'edges.csv'), str(run / 'delta.json'),
+                    {'cctv_count': (cctv_files['old'], cctv_files[change])},
+                    floating_pop=FLOATING_POP_DIR, spacing_m=EDGE_SAMPLE_SPACING_M)
+    with open(run / 'delta.json') as f:
+        delta = json.load(f)
+    assert delta['edges']
+    apply_safety_delta(served, delta)
+    reloaded = create_pathfinding_model(GRAPH_FILE, str(run / 'nodes.csv'), edge_weights_file=str(run / 'edges.csv'))
+
+    for u, v, data in reloaded.edges(data=True):
+        for attr in ('edge_safety', 'hybrid_weight', 'safe_only_weight'):
+            assert served[u][v].get(attr) == pytest.approx(data.get(attr), rel=1e-9), (u, v, attr)
+    served_chains = served.graph['contraction']['graph']
+    for a, b, data in reloaded.graph['contraction']['graph'].edges(data=True):
+        if 'via' in data:
+            assert served_chains[a][b]['hybrid_weight'] == pytest.approx(data['hybrid_weight'], rel=1e-9)
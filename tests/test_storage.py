@@ -0,0 +1,42 @@
+# Concurrency checks for the storage backends: no update may be lost under contention.
+
+import concurrent.futures
+
+from storage import MemoryBackend, SQLiteBackend
+
+
+def stress(backend, threads=16, sessions_per_thread=50, updates=200):
+    """
+    Every thread updates its own sessions while all threads also increment one shared
+    counter, then every count is checked.
+    """
+    backend.put("sessions", "shared", {"count": 0})
+
+    def increment(value):
+        value["count"] += 1
+        return value
+
+    def worker(t):
+        keys = [f"{t}-{i}" for i in range(sessions_per_thread)]
+        for key in keys:
+            backend.put("sessions", key, {"count": 0})
+        for _ in range(updates):
+            for key in keys[:5]:
+                backend.update("sessions", key, increment)
+            backend.update("sessions", "shared", increment)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(worker, range(threads)))
+
+    assert backend.get("sessions", "shared")["count"] == threads * updates, "lost shared updates"
+    for t in range(threads):
+        for i in range(5):
+            assert backend.get("sessions", f"{t}-{i}")["count"] == updates, "lost session updates"
+
+
+def test_memory_backend_loses_no_updates():
+    stress(MemoryBackend())
+
+
+def test_sqlite_backend_loses_no_updates(tmp_path):
+    stress(SQLiteBackend(str(tmp_path / 'stress.sqlite3')), threads=4, updates=20)
@@ -0,0 +1,54 @@
+# Trace buffers: idle sessions are released from memory without losing points, and a trace
+# with a missing chunk is reported instead of being silently shortened.
+
+import numpy as np
+import pytest
+
+import trace_ingest
+from storage import MemoryBackend
+
+
+@pytest.fixture
+def store(monkeypatch):
+    backend = MemoryBackend()
+    monkeypatch.setattr(trace_ingest, '_store', backend)
+    monkeypatch.setattr(trace_ingest, '_buffers', {})
+    monkeypatch.setattr(trace_ingest, '_dirty', set())
+    monkeypatch.setattr(trace_ingest, '_release_listeners', [])
+    # No background flusher: the tests flush explicitly
+    monkeypatch.setattr(trace_ingest, '_flusher', object())
+    return backend
+
+
+def fixes(start, n=5):
+    return np.array([[start + 10.0 * i, 35.83 + 1e-3 * i, 128.53] for i in range(n)])
+
+
+def test_idle_buffers_are_released_after_flush(store, monkeypatch):
+    released = []
+    trace_ingest.on_release(released.append)
+    trace_ingest.ingest_fixes('s1', fixes(0))
+
+    trace_ingest.flush_traces()
+    assert 's1' in trace_ingest._buffers, "a buffer in use was released"
+
+    monkeypatch.setattr(trace_ingest, 'TRACE_BUFFER_IDLE_S', 0)
+    trace_ingest.flush_traces()
+    assert 's1' not in trace_ingest._buffers
+    assert released == ['s1']
+
+    # The session continues from the stored trace
+    trace_ingest.ingest_fixes('s1', fixes(100))
+    trace_ingest.flush_traces()
+    assert len(trace_ingest.get_trace('s1')) == 10
+
+
+def test_missing_chunk_raises(store):
+    trace_ingest.ingest_fixes('s2', fixes(0))
+    trace_ingest.drop_buffer('s2')
+    store.delete("trace_chunks", store.get("trace_meta", 's2')['chunks'][0])
+
+    with pytest.raises(LookupError):
+        trace_ingest.get_trace('s2')
+    with pytest.raises(LookupError):
+        trace_ingest.ingest_fixes('s2', fixes(100))